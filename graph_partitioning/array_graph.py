@@ -0,0 +1,947 @@
+import numbers
+import os
+import tempfile
+from collections.abc import MutableMapping
+
+import networkx as nx
+import numpy as np
+
+import graph_partitioning.utils as gputils
+
+
+class _Attributes():
+    """
+    Node or edge attributes of an ArrayGraph, one array per attribute indexed
+    by node or edge id. Numbers are stored as float64 with NaN where the
+    attribute is not set, any other value in an object array with None.
+    """
+
+    __slots__ = ('arrays', 'length')
+
+    def __init__(self, length, arrays=None):
+        self.length = length
+        self.arrays = {} if arrays is None else arrays
+
+    def array(self, name, numeric=True):
+        array = self.arrays.get(name)
+        if array is None:
+            if numeric:
+                array = np.full(self.length, np.nan)
+            else:
+                array = np.full(self.length, None, dtype=object)
+            self.arrays[name] = array
+        elif not numeric and array.dtype != object:
+            unset = np.isnan(array)
+            array = array.astype(object)
+            array[unset] = None
+            self.arrays[name] = array
+        return array
+
+    def has(self, name, index):
+        array = self.arrays.get(name)
+        if array is None:
+            return False
+        value = array[index]
+        return value is not None and value == value
+
+    def get(self, name, index):
+        if not self.has(name, index):
+            raise KeyError(name)
+        value = self.arrays[name][index]
+        if isinstance(value, np.floating):
+            return float(value)
+        return value
+
+    def set(self, name, index, value):
+        numeric = isinstance(value, numbers.Real) and not isinstance(value, bool)
+        self.array(name, numeric)[index] = value
+
+    def delete(self, name, index):
+        if not self.has(name, index):
+            raise KeyError(name)
+        array = self.arrays[name]
+        array[index] = None if array.dtype == object else np.nan
+
+    def names(self, index):
+        return [name for name in self.arrays if self.has(name, index)]
+
+    def grow(self, length):
+        for name, array in self.arrays.items():
+            pad = np.full(length - self.length, None if array.dtype == object else np.nan, dtype=array.dtype)
+            self.arrays[name] = np.concatenate((array, pad))
+        self.length = length
+
+    def copy(self):
+        return _Attributes(self.length, {name: array.copy() for name, array in self.arrays.items()})
+
+
+class _AttributeMap(MutableMapping):
+    """
+    The attribute dictionary of one node or edge, read from and written to
+    the attribute arrays.
+    """
+
+    __slots__ = ('attributes', 'index')
+
+    def __init__(self, attributes, index):
+        self.attributes = attributes
+        self.index = index
+
+    def __getitem__(self, name):
+        return self.attributes.get(name, self.index)
+
+    def __setitem__(self, name, value):
+        self.attributes.set(name, self.index, value)
+
+    def __delitem__(self, name):
+        self.attributes.delete(name, self.index)
+
+    def __contains__(self, name):
+        return self.attributes.has(name, self.index)
+
+    def __iter__(self):
+        return iter(self.attributes.names(self.index))
+
+    def __len__(self):
+        return len(self.attributes.names(self.index))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class _NodeView():
+    """
+    G.node
+    """
+
+    __slots__ = ('graph',)
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __getitem__(self, node):
+        if node not in self.graph:
+            raise KeyError(node)
+        return _AttributeMap(self.graph._node_attributes, node)
+
+    def __contains__(self, node):
+        return node in self.graph
+
+    def __iter__(self):
+        return iter(self.graph)
+
+    def __len__(self):
+        return len(self.graph)
+
+    def items(self):
+        return ((node, _AttributeMap(self.graph._node_attributes, node)) for node in self.graph)
+
+
+class _AdjacencyView():
+    """
+    G.adj and G.edge
+    """
+
+    __slots__ = ('graph',)
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __getitem__(self, node):
+        return self.graph[node]
+
+    def __contains__(self, node):
+        return node in self.graph
+
+    def __iter__(self):
+        return iter(self.graph)
+
+    def __len__(self):
+        return len(self.graph)
+
+    def items(self):
+        return ((node, self.graph[node]) for node in self.graph)
+
+
+class _NeighborView():
+    """
+    G[node], the neighbors of node mapped to the attributes of the edges
+    """
+
+    __slots__ = ('graph', 'positions')
+
+    def __init__(self, graph, node):
+        self.graph = graph
+        self.positions = graph._neighbor_positions(node)
+
+    def _edge(self, neighbor):
+        found = self.positions[self.graph._indices[self.positions] == neighbor]
+        if len(found) == 0:
+            return None
+        return self.graph._entry_edges[found[0]]
+
+    def __getitem__(self, neighbor):
+        edge = self._edge(neighbor)
+        if edge is None:
+            raise KeyError(neighbor)
+        return _AttributeMap(self.graph._edge_attributes, edge)
+
+    def __contains__(self, neighbor):
+        return self._edge(neighbor) is not None
+
+    def __iter__(self):
+        return iter(self.graph._indices[self.positions].tolist())
+
+    def __len__(self):
+        return len(self.positions)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        attributes = self.graph._edge_attributes
+        return [(neighbor, _AttributeMap(attributes, edge))
+                for neighbor, edge in zip(self.graph._indices[self.positions].tolist(),
+                                          self.graph._entry_edges[self.positions].tolist())]
+
+    def values(self):
+        return [data for neighbor, data in self.items()]
+
+
+class ArrayGraph():
+    """
+    Undirected graph stored in arrays, with the part of the networkx 1.x
+    Graph API used by this package.
+
+    Node ids are ints indexing the arrays. The neighbors of every id are held
+    in CSR arrays, where each entry also points at the id of its edge, and
+    node and edge attributes are held in one array per attribute (see
+    node_array() and edge_array()). Numeric attributes are returned as
+    floats. Nodes are iterated in the order they were added and neighbors
+    in the order their edges were added, as networkx does.
+
+    Removing a node only marks it as absent. subgraph() shares the attribute
+    arrays of its graph, so changes to the attributes of one are seen by the
+    other as with networkx subgraphs. The CSR arrays are never written in
+    place, adding edges replaces them.
+
+    to_networkx() converts the graph when networkx is needed, for example to
+    write GML files.
+    """
+
+    __slots__ = ('graph', '_indptr', '_indices', '_entry_edges', '_present', '_order', '_num_nodes',
+                 '_node_attributes', '_edge_attributes')
+
+    def __init__(self, **attr):
+        self.graph = dict(attr)
+        self._indptr = np.zeros(1, dtype=np.int32)
+        self._indices = np.zeros(0, dtype=np.int32)
+        self._entry_edges = np.zeros(0, dtype=np.int32)
+        self._present = np.zeros(0, dtype=bool)
+        self._order = np.zeros(0, dtype=np.int64)
+        self._num_nodes = 0
+        self._node_attributes = _Attributes(0)
+        self._edge_attributes = _Attributes(0)
+
+    @classmethod
+    def from_csr(cls, csr, nodes=None):
+        """
+        Builds the graph from undirected (indptr, indices, edge_weights,
+        node_weights) arrays as returned by utils.graph_to_csr(), where every
+        edge is stored in both directions and self loops once.
+
+        nodes: Node ids in the order they are iterated, defaults to every
+               row in id order.
+        """
+        indptr, indices, edge_weights, node_weights = csr
+        capacity = len(indptr) - 1
+        indices = np.asarray(indices, dtype=np.int32)
+        rows = np.repeat(np.arange(capacity, dtype=np.int64), np.diff(indptr))
+
+        # number the edges, both entries of an edge get the same id
+        key = np.minimum(rows, indices) * capacity + np.maximum(rows, indices)
+        edges, first, entry_edges = np.unique(key, return_index=True, return_inverse=True)
+
+        G = cls()
+        G._indptr = np.asarray(indptr, dtype=np.int32)
+        G._indices = indices
+        G._entry_edges = entry_edges.astype(np.int32)
+        G._edge_attributes = _Attributes(len(edges), {'weight': np.array(edge_weights, dtype=np.float64)[first]})
+        G._node_attributes = _Attributes(capacity, {'weight': np.array(node_weights, dtype=np.float64)})
+
+        G._order = np.arange(capacity, dtype=np.int64) if nodes is None else np.asarray(nodes, dtype=np.int64)
+        G._present = np.zeros(capacity, dtype=bool)
+        G._present[G._order] = True
+        G._num_nodes = len(G._order)
+        return G
+
+    @classmethod
+    def from_store(cls, store):
+        """
+        Builds the graph over the memory-mapped arrays of a
+        graph_store.GraphStore without copying them, with the node order of
+        the store. Only the node and edge weights, which are written in
+        place, are read into memory.
+        """
+        capacity = store.number_of_nodes()
+        edge_weights = np.empty(store.number_of_edge_ids(), dtype=np.float64)
+        for start in range(0, len(store.indices), store.BLOCK_SIZE):
+            stop = start + store.BLOCK_SIZE
+            edge_weights[store.entry_edges[start:stop]] = store.edge_weights[start:stop]
+
+        G = cls()
+        G._indptr = store.indptr
+        G._indices = store.indices
+        G._entry_edges = store.entry_edges
+        G._edge_attributes = _Attributes(len(edge_weights), {'weight': edge_weights})
+        G._node_attributes = _Attributes(capacity, {'weight': np.array(store.node_weights, dtype=np.float64)})
+
+        G._order = np.array(store.node_order, dtype=np.int64)
+        G._present = np.zeros(capacity, dtype=bool)
+        G._present[G._order] = True
+        G._num_nodes = len(G._order)
+        return G
+
+    @classmethod
+    def from_networkx(cls, graph):
+        """
+        Copies an undirected networkx graph with int node ids, keeping the
+        node order, the neighbor order and all attributes.
+        """
+        assert not graph.is_directed(), "ArrayGraph is undirected"
+        G = cls(**graph.graph)
+        G.add_nodes_from(graph.nodes_iter(data=True))
+
+        edge_data = [data for u, v, data in graph.edges_iter(data=True)]
+        edge_ids = {id(data): edge for edge, data in enumerate(edge_data)}
+        G._edge_attributes = _Attributes(len(edge_data))
+        for edge, data in enumerate(edge_data):
+            for name, value in data.items():
+                G._edge_attributes.set(name, edge, value)
+
+        degree = np.zeros(len(G._present), dtype=np.int32)
+        indices = []
+        entry_edges = []
+        for node in range(len(G._present)):
+            if node not in graph:
+                continue
+            adj = graph.adj[node]
+            degree[node] = len(adj)
+            for neighbor, data in adj.items():
+                indices.append(neighbor)
+                entry_edges.append(edge_ids[id(data)])
+        np.cumsum(degree, out=G._indptr[1:])
+        G._indices = np.array(indices, dtype=np.int32)
+        G._entry_edges = np.array(entry_edges, dtype=np.int32)
+        return G
+
+    def to_networkx(self):
+        """
+        Converts the graph to a networkx Graph with the same node order,
+        neighbor order and attributes.
+        """
+        H = nx.Graph(**self.graph)
+        H.add_nodes_from((node, dict(data)) for node, data in self.nodes_iter(data=True))
+
+        source, target, edges = self._edges()
+        edge_data = {}
+        for edge in np.unique(edges).tolist():
+            edge_data[edge] = dict(_AttributeMap(self._edge_attributes, edge))
+
+        # fill the adjacency in entry order, so the neighbors of every node
+        # are in the same order as here
+        positions, rows = self._rows(self._nodes())
+        neighbors = self._indices[positions]
+        keep = self._present[neighbors]
+        adj = H.adj
+        for u, v, edge in zip(rows[keep].tolist(), neighbors[keep].tolist(), self._entry_edges[positions[keep]].tolist()):
+            adj[u][v] = edge_data[edge]
+        return H
+
+    def copy(self):
+        """
+        Copy of the graph and its attributes. The CSR arrays are shared as
+        they are never written in place.
+        """
+        H = ArrayGraph.__new__(ArrayGraph)
+        H.graph = self.graph.copy()
+        H._indptr = self._indptr
+        H._indices = self._indices
+        H._entry_edges = self._entry_edges
+        H._present = self._present.copy()
+        H._order = self._nodes().copy()
+        H._num_nodes = self._num_nodes
+        H._node_attributes = self._node_attributes.copy()
+        H._edge_attributes = self._edge_attributes.copy()
+        return H
+
+    def subgraph(self, nbunch):
+        """
+        The graph induced by the nodes in nbunch, iterated in the order of
+        nbunch. The attributes are shared with this graph.
+
+        Like networkx, the subgraph adds the edges of each node to nodes
+        already added, in the order of its neighbors, so neighbors are not
+        always in the order of this graph.
+        """
+        nodes = self._nbunch(nbunch)
+        rank = np.full(len(self._present), -1, dtype=np.int64)
+        rank[nodes] = np.arange(len(nodes))
+
+        H = ArrayGraph.__new__(ArrayGraph)
+        H.graph = self.graph
+        H._present = np.zeros(len(self._present), dtype=bool)
+        H._set_entries(*self._induced_entries(nodes, rank))
+        H._node_attributes = self._node_attributes
+        H._edge_attributes = self._edge_attributes
+        H._order = nodes
+        H._present[nodes] = True
+        H._num_nodes = len(nodes)
+        return H
+
+    def csr(self, num_nodes=None, nodes=None):
+        """
+        (indptr, indices, edge_weights, node_weights) as returned by
+        utils.graph_to_csr(): only the neighbors of nodes are filled in when
+        given, nodes not in the graph have a weight of 0 and missing weights
+        count as 1.
+        """
+        present = self._nodes()
+        if num_nodes is None:
+            num_nodes = int(present.max()) + 1 if len(present) else 0
+        if nodes is None and len(present) == len(self._present) == num_nodes:
+            # every row is filled, the CSR arrays are returned as they are
+            edge_weights = self._edge_attributes.array('weight')[self._entry_edges]
+            node_weights = self._node_attributes.array('weight')
+            return (self._indptr, self._indices, np.where(np.isnan(edge_weights), 1.0, edge_weights),
+                    np.where(np.isnan(node_weights), 1.0, node_weights))
+        rows = np.sort(present if nodes is None else self._nbunch(nodes))
+
+        positions, source = self._rows(rows)
+        keep = self._present[self._indices[positions]]
+        positions = positions[keep]
+
+        indptr = np.zeros(num_nodes + 1, dtype=np.int32)
+        np.cumsum(np.bincount(source[keep], minlength=num_nodes), out=indptr[1:])
+        edge_weights = self._edge_attributes.array('weight')[self._entry_edges[positions]]
+        node_weights = np.zeros(num_nodes, dtype=np.float64)
+        node_weights[present] = self._node_attributes.array('weight')[present]
+
+        return (indptr, self._indices[positions], np.where(np.isnan(edge_weights), 1.0, edge_weights),
+                np.where(np.isnan(node_weights), 1.0, node_weights))
+
+    def node_array(self, name):
+        """
+        Writable array of attribute name indexed by node id, NaN where it is
+        not set. Ids of nodes that are not in the graph are included.
+        """
+        return self._node_attributes.array(name)
+
+    def edge_array(self, name):
+        """
+        Writable array of attribute name indexed by edge id, see edge_ids().
+        """
+        return self._edge_attributes.array(name)
+
+    def nodes_array(self):
+        """
+        The nodes of the graph as an array, in iteration order.
+        """
+        return self._nodes().copy()
+
+    def edge_ids(self):
+        """
+        Returns (edges, source, target): the ids of the edges in the graph
+        and their end nodes.
+        """
+        source, target, edges = self._edges()
+        return (edges, source, target)
+
+    def _nodes(self):
+        nodes = self._order[self._present[self._order]]
+        if len(nodes) < len(self._order):
+            # drop removed nodes
+            self._order = nodes
+        return nodes
+
+    def _nbunch(self, nbunch):
+        """
+        The nodes of nbunch in the graph, in order and without repeats.
+        """
+        if isinstance(nbunch, numbers.Integral):
+            if nbunch not in self:
+                raise nx.NetworkXError("nbunch is not a node or a sequence of nodes.")
+            return np.array([nbunch], dtype=np.int64)
+        nodes = np.fromiter(nbunch, dtype=np.int64)
+        nodes = nodes[(nodes >= 0) & (nodes < len(self._present))]
+        nodes = nodes[self._present[nodes]]
+        nodes = nodes[np.sort(np.unique(nodes, return_index=True)[1])]
+        return nodes
+
+    def _rows(self, nodes):
+        """
+        Entry positions of the neighbor lists of nodes, and the node of each.
+        """
+        positions = gputils.csr_positions(self._indptr, nodes)
+        source = np.repeat(nodes, self._indptr[nodes + 1] - self._indptr[nodes])
+        return (positions, source)
+
+    def _neighbor_positions(self, node):
+        if node not in self:
+            raise KeyError(node)
+        positions = np.arange(self._indptr[node], self._indptr[node + 1])
+        return positions[self._present[self._indices[positions]]]
+
+    def _edges(self, nbunch=None):
+        """
+        Edges in networkx order: for each node, its neighbors that have not
+        been visited as a node yet. Returns (source, target, edge ids).
+        """
+        nodes = self._nodes() if nbunch is None else self._nbunch(nbunch)
+        positions, source = self._rows(nodes)
+        target = self._indices[positions]
+        rank = np.full(len(self._present), len(nodes), dtype=np.int64)
+        rank[nodes] = np.arange(len(nodes))
+        keep = self._present[target] & (rank[target] >= rank[source])
+        return (source[keep], target[keep], self._entry_edges[positions[keep]])
+
+    def _induced_entries(self, nodes, rank):
+        """
+        Entries added to a subgraph when nodes are added to it in order:
+        the edges of each node to nodes of lower or equal rank, where nodes
+        not in the subgraph have a rank of -1. Returns (rows, indices,
+        entry_edges) sorted by row, each row in the order networkx would add
+        the entries.
+        """
+        positions, source = self._rows(nodes)
+        target = self._indices[positions]
+        added = (rank[target] >= 0) & (rank[target] <= rank[source])
+        source = source[added]
+        target = target[added]
+        edges = self._entry_edges[positions[added]]
+
+        # both directions of every edge, at the time its node is added
+        loop = source == target
+        rows = np.concatenate((source, target[~loop]))
+        time = np.concatenate((np.arange(len(source)), np.flatnonzero(~loop)))
+        order = np.lexsort((time, rows))
+        return (rows[order], np.concatenate((target, source[~loop]))[order],
+                np.concatenate((edges, edges[~loop]))[order])
+
+    def _grow(self, capacity):
+        pad = capacity - len(self._present)
+        self._indptr = np.concatenate((self._indptr, np.repeat(self._indptr[-1:], pad)))
+        self._present = np.concatenate((self._present, np.zeros(pad, dtype=bool)))
+        self._node_attributes.grow(capacity)
+
+    def _set_entries(self, rows, indices, entry_edges):
+        self._indptr = np.zeros(len(self._present) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(rows, minlength=len(self._present)), out=self._indptr[1:])
+        self._indices = indices.astype(np.int32)
+        self._entry_edges = entry_edges.astype(np.int32)
+
+    def _isolate(self, nodes):
+        """
+        Drops the entries of nodes that are added back after being removed,
+        or added to a subgraph, so they come back without edges.
+        """
+        rows = np.repeat(np.arange(len(self._present)), np.diff(self._indptr))
+        keep = ~(np.isin(rows, nodes) | np.isin(self._indices, nodes))
+        self._set_entries(rows[keep], self._indices[keep], self._entry_edges[keep])
+
+    @property
+    def name(self):
+        return self.graph.get('name', '')
+
+    @name.setter
+    def name(self, name):
+        self.graph['name'] = name
+
+    @property
+    def node(self):
+        return _NodeView(self)
+
+    @property
+    def adj(self):
+        return _AdjacencyView(self)
+
+    edge = adj
+
+    def __iter__(self):
+        return iter(self._nodes().tolist())
+
+    def __len__(self):
+        return self._num_nodes
+
+    def __contains__(self, node):
+        return (isinstance(node, numbers.Integral) and 0 <= node < len(self._present)
+                and bool(self._present[node]))
+
+    def __getitem__(self, node):
+        return _NeighborView(self, node)
+
+    def is_directed(self):
+        return False
+
+    def is_multigraph(self):
+        return False
+
+    def has_node(self, node):
+        return node in self
+
+    def has_edge(self, u, v):
+        return u in self and v in self[u]
+
+    def get_edge_data(self, u, v, default=None):
+        try:
+            return self[u][v]
+        except KeyError:
+            return default
+
+    def number_of_nodes(self):
+        return self._num_nodes
+
+    def number_of_edges(self):
+        return len(self._edges()[0])
+
+    def size(self, weight=None):
+        if weight is None:
+            return self.number_of_edges()
+        weights = self._edge_attributes.array(weight)[self._edges()[2]]
+        return float(np.where(np.isnan(weights), 1.0, weights).sum())
+
+    def nodes_iter(self, data=False):
+        if data:
+            return self.node.items()
+        return iter(self)
+
+    def nodes(self, data=False):
+        return list(self.nodes_iter(data))
+
+    def edges_iter(self, nbunch=None, data=False):
+        source, target, edges = self._edges(nbunch)
+        if data:
+            attributes = self._edge_attributes
+            return ((u, v, _AttributeMap(attributes, edge))
+                    for u, v, edge in zip(source.tolist(), target.tolist(), edges.tolist()))
+        return zip(source.tolist(), target.tolist())
+
+    def edges(self, nbunch=None, data=False):
+        return list(self.edges_iter(nbunch, data))
+
+    def neighbors(self, node):
+        if node not in self:
+            raise nx.NetworkXError("The node %s is not in the graph." % (node,))
+        return list(self[node])
+
+    def neighbors_iter(self, node):
+        return iter(self.neighbors(node))
+
+    def degree(self, nbunch=None, weight=None):
+        """
+        Degree of a node, or a dict of degrees of the nodes in nbunch. Self
+        loops count twice.
+        """
+        nodes = self._nodes() if nbunch is None else self._nbunch(nbunch)
+        positions, source = self._rows(nodes)
+        target = self._indices[positions]
+        keep = self._present[target]
+        if weight is None:
+            weights = np.ones(np.count_nonzero(keep), dtype=np.int64)
+        else:
+            weights = self._edge_attributes.array(weight)[self._entry_edges[positions[keep]]]
+            weights = np.where(np.isnan(weights), 1.0, weights)
+        weights = weights * np.where(source[keep] == target[keep], 2, 1)
+        degree = np.zeros(len(self._present), dtype=weights.dtype)
+        np.add.at(degree, source[keep], weights)
+
+        if nbunch in self:
+            return degree[nbunch].item()
+        return dict(zip(nodes.tolist(), degree[nodes].tolist()))
+
+    def add_node(self, n, attr_dict=None, **attr):
+        self.add_nodes_from([(n, attr_dict or {})], **attr)
+
+    def add_nodes_from(self, nodes, **attr):
+        nodes = [n if isinstance(n, tuple) else (n, {}) for n in nodes]
+        if not nodes:
+            return
+        ids = np.fromiter((n for n, data in nodes), dtype=np.int64, count=len(nodes))
+        if ids.max() >= len(self._present):
+            self._grow(int(ids.max()) + 1)
+
+        unique, first = np.unique(ids, return_index=True)
+        new = ids[np.sort(first)]
+        new = new[~self._present[new]]
+        if len(new):
+            stale = new[self._indptr[new + 1] > self._indptr[new]]
+            if len(stale):
+                self._isolate(stale)
+            self._order = np.concatenate((self._nodes(), new))
+            self._present[new] = True
+            self._num_nodes += len(new)
+
+        for name, value in attr.items():
+            self._node_attributes.set(name, ids, value)
+        for n, data in nodes:
+            for name, value in data.items():
+                self._node_attributes.set(name, n, value)
+
+    def add_edge(self, u, v, attr_dict=None, **attr):
+        self.add_edges_from([(u, v, attr_dict or {})], **attr)
+
+    def add_edges_from(self, ebunch, **attr):
+        """
+        Adds edges given as (u, v) or (u, v, data) tuples, adding their nodes
+        when needed. The CSR arrays are rebuilt once per call.
+        """
+        ebunch = [e if len(e) == 3 else (e[0], e[1], {}) for e in ebunch]
+        if not ebunch:
+            return
+        missing = []
+        for u, v, data in ebunch:
+            for n in (u, v):
+                if n not in self and n not in missing:
+                    missing.append(n)
+        self.add_nodes_from(missing)
+
+        u = np.fromiter((e[0] for e in ebunch), dtype=np.int64, count=len(ebunch))
+        v = np.fromiter((e[1] for e in ebunch), dtype=np.int64, count=len(ebunch))
+        capacity = len(self._present)
+        key = np.minimum(u, v) * capacity + np.maximum(u, v)
+
+        # ids of the edges already in the graph
+        positions, source = self._rows(np.unique(u))
+        target = self._indices[positions]
+        keep = self._present[target]
+        source = source[keep]
+        target = target[keep]
+        existing_key = np.minimum(source, target) * capacity + np.maximum(source, target)
+        existing_edges = self._entry_edges[positions[keep]]
+        exists = np.zeros(len(key), dtype=bool)
+        edges = np.full(len(key), -1, dtype=np.int64)
+        if len(existing_key):
+            by_key = np.argsort(existing_key)
+            sorted_key = existing_key[by_key]
+            found = np.minimum(np.searchsorted(sorted_key, key), len(sorted_key) - 1)
+            exists = sorted_key[found] == key
+            edges[exists] = existing_edges[by_key[found[exists]]]
+
+        # number the new edges in the order they are first given
+        new_keys, first, inverse = np.unique(key[~exists], return_index=True, return_inverse=True)
+        by_first = np.argsort(first)
+        rank = np.empty(len(new_keys), dtype=np.int64)
+        rank[by_first] = np.arange(len(new_keys))
+        base = self._edge_attributes.length
+        edges[~exists] = base + rank[inverse]
+
+        new_first = np.flatnonzero(~exists)[first[by_first]]
+        new_u = u[new_first]
+        new_v = v[new_first]
+        self._edge_attributes.grow(base + len(new_u))
+
+        # new entries go after the existing neighbors of their rows
+        loop = new_u == new_v
+        new_edges = base + np.arange(len(new_u))
+        rows = np.repeat(np.arange(capacity), np.diff(self._indptr))
+        add_rows = np.column_stack((new_u, new_v))
+        add_indices = np.column_stack((new_v, new_u))
+        add_edges = np.column_stack((new_edges, new_edges))
+        single = np.column_stack((np.ones(len(new_u), dtype=bool), ~loop))
+        all_rows = np.concatenate((rows, add_rows[single]))
+        order = np.argsort(all_rows, kind='stable')
+        self._set_entries(all_rows[order],
+                          np.concatenate((self._indices, add_indices[single]))[order],
+                          np.concatenate((self._entry_edges, add_edges[single]))[order])
+
+        for name, value in attr.items():
+            self._edge_attributes.set(name, edges, value)
+        for edge, (u, v, data) in zip(edges.tolist(), ebunch):
+            for name, value in data.items():
+                self._edge_attributes.set(name, edge, value)
+
+    def remove_node(self, n):
+        if n not in self:
+            raise nx.NetworkXError("The node %s is not in the graph." % (n,))
+        self._present[n] = False
+        self._num_nodes -= 1
+
+    def remove_nodes_from(self, nodes):
+        nodes = self._nbunch(nodes)
+        self._present[nodes] = False
+        self._num_nodes -= len(nodes)
+
+
+class _ArrivedView(ArrayGraph):
+    """
+    ArrayGraph returned by ArrivedSubgraph.subgraph(). Its rows have the
+    slots of the graph's rows, filled from the start with the edges to
+    arrived nodes. The other slots of the rows of arrived nodes point at an
+    id that is never present. csr(), copy() and number_of_edges() read the
+    filled slots directly.
+    """
+
+    __slots__ = ('_num_edges', '_fill')
+
+    def number_of_edges(self):
+        return self._num_edges
+
+    def _filled_positions(self, rows):
+        lengths = self._fill[rows]
+        within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return np.repeat(self._indptr[rows], lengths) + within
+
+    def copy(self):
+        """
+        Copy with CSR arrays of its own that only hold the filled slots, as
+        the other slots are not always initialised.
+        """
+        rows = np.flatnonzero(self._fill)
+        positions = self._filled_positions(rows)
+        H = ArrayGraph.__new__(ArrayGraph)
+        H.graph = self.graph.copy()
+        H._present = self._present[:-1].copy()
+        H._set_entries(np.repeat(rows, self._fill[rows]), self._indices[positions], self._entry_edges[positions])
+        H._order = self._nodes().copy()
+        H._num_nodes = self._num_nodes
+        H._node_attributes = self._node_attributes.copy()
+        H._edge_attributes = self._edge_attributes.copy()
+        return H
+
+    def csr(self, num_nodes=None, nodes=None):
+        capacity = len(self._present) - 1
+        if nodes is not None or (num_nodes is not None and num_nodes < capacity):
+            return ArrayGraph.csr(self, num_nodes, nodes)
+        if num_nodes is None:
+            num_nodes = int(self._order.max()) + 1 if len(self._order) else 0
+
+        # the filled slots of every row, in id order
+        # rows of ids above the largest arrived id are empty
+        fill = self._fill[:num_nodes]
+        indptr = np.zeros(num_nodes + 1, dtype=np.int32)
+        indptr[1:len(fill) + 1] = fill
+        np.cumsum(indptr, out=indptr)
+        positions = self._filled_positions(np.flatnonzero(fill))
+
+        edge_weights = self._edge_attributes.array('weight')[self._entry_edges[positions]]
+        node_weights = np.zeros(num_nodes, dtype=np.float64)
+        node_weights[self._order] = self._node_attributes.array('weight')[self._order]
+
+        return (indptr, self._indices[positions], np.where(np.isnan(edge_weights), 1.0, edge_weights),
+                np.where(np.isnan(node_weights), 1.0, node_weights))
+
+
+class ArrivedSubgraph():
+    """
+    The subgraph of an ArrayGraph induced by the nodes that have arrived,
+    grown as nodes arrive instead of calling subgraph() for every batch.
+
+    The CSR arrays use the graph's indptr, so every row has room for all of
+    its edges. When nodes arrive, their edges to nodes that arrived earlier
+    are written into the free slots at the end of the rows at both ends.
+    The order of the arrived nodes and their mask are also kept and
+    extended. Adding a batch costs time in the degrees of its nodes, not in
+    the number of nodes that arrived before. Rows are in the same order as
+    in graph.subgraph() of the arrived nodes in arrival order.
+
+    The slots of a row are only initialised when its node arrives, so
+    memory is only touched for the rows of arrived nodes. When the graph's
+    CSR arrays are memory-mapped, as with ArrayGraph.from_store(), the
+    slots are kept in a temporary file next to them rather than in memory.
+
+    Weights are read from the graph when csr() is called. The arrays are
+    built again, from every arrived node, if edges or nodes are added to
+    the graph. Arrived nodes must not be removed from it.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self._clear()
+
+    def _clear(self):
+        capacity = len(self.graph._present)
+        self._graph_indices = self.graph._indices
+        self.arrival = np.full(capacity, -1, dtype=np.int64)
+        self.num_nodes = 0
+        self.num_entries = 0
+        self.num_loops = 0
+        # an extra id that is never present marks the free slots
+        self.present = np.zeros(capacity + 1, dtype=bool)
+        self.order = np.zeros(1024, dtype=np.int64)
+        self.fill = np.zeros(capacity, dtype=np.int32)
+        self.indices = self._slots()
+        self.entry_edges = self._slots()
+
+    def _slots(self):
+        """
+        Uninitialised array with a slot for every entry of the graph
+        """
+        length = len(self._graph_indices)
+        if isinstance(self._graph_indices, np.memmap) and length > 0:
+            scratch = tempfile.TemporaryFile(dir=os.path.dirname(self._graph_indices.filename))
+            return np.memmap(scratch, dtype=np.int32, mode='w+', shape=(length,))
+        return np.empty(length, dtype=np.int32)
+
+    def add(self, nodes):
+        """
+        Adds the nodes that have not arrived yet, in order.
+        """
+        graph = self.graph
+        if graph._indices is not self._graph_indices or len(graph._present) != len(self.arrival):
+            arrived = self.order[:self.num_nodes].copy()
+            self._clear()
+            self.add(arrived)
+
+        nodes = np.asarray(nodes, dtype=np.int64)
+        nodes = nodes[self.arrival[nodes] < 0]
+        nodes = nodes[np.sort(np.unique(nodes, return_index=True)[1])]
+        if len(nodes) == 0:
+            return
+
+        first = self.num_nodes
+        self.num_nodes += len(nodes)
+        if self.num_nodes > len(self.order):
+            self.order = np.concatenate((self.order, np.zeros(max(self.num_nodes, len(self.order)), dtype=np.int64)))
+        self.order[first:self.num_nodes] = nodes
+        self.present[nodes] = True
+        self.arrival[nodes] = first + np.arange(len(nodes))
+
+        # every slot of the rows of the new nodes starts free
+        self.indices[gputils.csr_positions(graph._indptr, nodes)] = len(self.arrival)
+
+        rows, indices, entry_edges = graph._induced_entries(nodes, self.arrival)
+        self.num_entries += len(rows)
+        self.num_loops += int(np.count_nonzero(rows == indices))
+
+        # the new entries go in the next free slots of their rows
+        changed, start, count = np.unique(rows, return_index=True, return_counts=True)
+        within = np.arange(len(rows)) - np.repeat(start, count)
+        slots = graph._indptr[rows] + self.fill[rows] + within
+        self.indices[slots] = indices
+        self.entry_edges[slots] = entry_edges
+        self.fill[changed] += count.astype(np.int32)
+
+    def subgraph(self, order=None):
+        """
+        The subgraph induced by the arrived nodes as an ArrayGraph that
+        shares the CSR arrays and the attributes. It sees nodes added later,
+        so take a new one after add(), and it should not be modified.
+
+        order: Every arrived node, in the order the subgraph iterates them.
+               Defaults to arrival order. Neighbors stay in the order of
+               graph.subgraph() of the arrived nodes in arrival order.
+        """
+        graph = self.graph
+        H = _ArrivedView.__new__(_ArrivedView)
+        H.graph = graph.graph
+        H._indptr = graph._indptr
+        H._indices = self.indices
+        H._entry_edges = self.entry_edges
+        H._node_attributes = graph._node_attributes
+        H._edge_attributes = graph._edge_attributes
+        H._present = self.present
+        H._order = self.order[:self.num_nodes] if order is None else np.asarray(order, dtype=np.int64)
+        H._num_nodes = self.num_nodes
+        H._num_edges = (self.num_entries + self.num_loops) // 2
+        H._fill = self.fill
+        return H
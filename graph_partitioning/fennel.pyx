@@ -1,20 +1,545 @@
 import numpy as np
 import networkx as nx
+from concurrent.futures import ThreadPoolExecutor
+from scipy import sparse
+cimport cython
 from cpython cimport bool
-from utils import bincount_assigned, score
+from libc.math cimport pow
+from utils import bincount_assigned, csr_neighbors, csr_rows_changed, edges_cut_csr, graph_to_csr, score
 
 cdef int UNMAPPED = -1
 cdef bool DEBUG = False
 #cdef bool FRIEND_OF_FRIEND_ENABLED = False
 
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int csr_votes(int node,
+                   int[::] indptr,
+                   int[::] indices,
+                   double[::] edge_weights,
+                   int[::] partition,
+                   float[::] partition_votes,
+                   int num_partitions) nogil:
+    '''
+    CSR version of FennelPartitioner.get_votes(), fills partition_votes
+    '''
+    cdef int arg = 0
+    cdef int i = 0
+    cdef int right_node = 0
+    cdef double weight = 0.0
+
+    for arg in range(num_partitions):
+        partition_votes[arg] = 0.0
+
+    for i in range(indptr[node], indptr[node + 1]):
+        right_node = indices[i]
+        if partition[right_node] != UNMAPPED:
+            weight = edge_weights[i]
+            if weight <= 0.0:
+                weight = 1.0
+            partition_votes[partition[right_node]] = partition_votes[partition[right_node]] + weight
+
+    return 0
+
+
+cdef inline double marginal_cost(double size, float alpha, double gamma, bint linear) nogil:
+    '''
+    Cost of adding to a partition of the given size. The FENNEL objective
+    alpha x size^gamma has marginal cost alpha x gamma x size^(gamma - 1).
+    linear selects the original penalty alpha x size instead, and gamma is
+    then ignored.
+    '''
+    cdef float cost = 0
+    if linear:
+        cost = alpha * <float>size
+        return cost
+    if size <= 0.0:
+        return 0.0
+    return alpha * gamma * pow(size, gamma - 1.0)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int csr_assignment(int previous_assignment,
+                        float[::] partition_votes,
+                        double[::] partition_sizes,
+                        double[::] partition_costs,
+                        double[::] own_costs,
+                        int num_partitions,
+                        float alpha,
+                        double gamma,
+                        bint linear,
+                        double node_weight) nogil:
+    '''
+    CSR version of FennelPartitioner.get_assignment(), without debug output.
+    partition_costs holds marginal_cost() of every partition size and
+    own_costs that of every size less 1, which costs a node of weight 1 in
+    its own partition.
+    '''
+    cdef int arg = 0
+    cdef int max_arg = 0
+    cdef float max_val = 0
+    cdef float val = 0
+
+    for arg in range(num_partitions):
+        val = partition_votes[arg] - <float>partition_costs[arg]
+        if previous_assignment == arg:
+            # the node is removed from its partition before deciding
+            if linear:
+                val += alpha
+            elif node_weight == 1.0:
+                val = partition_votes[arg] - <float>own_costs[arg]
+            else:
+                val = partition_votes[arg] - <float>marginal_cost(partition_sizes[arg] - node_weight, alpha, gamma, linear)
+        if arg == 0 or val > max_val:
+            max_arg = arg
+            max_val = val
+
+    return max_arg
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int csr_move(int node,
+                  int previous_assignment,
+                  int new_assignment,
+                  double[::] node_weights,
+                  int[::] assignments,
+                  double[::] partition_sizes,
+                  double[::] partition_costs,
+                  double[::] own_costs,
+                  float alpha,
+                  double gamma,
+                  bint linear) nogil:
+    '''
+    Moves node and updates the size and marginal costs of both partitions.
+    A node of weight 1 shifts the sizes by one, so half of the new costs
+    are already in the tables.
+    '''
+    cdef bint unit = node_weights[node] == 1.0
+    if previous_assignment != UNMAPPED:
+        partition_sizes[previous_assignment] -= node_weights[node]
+        if unit:
+            partition_costs[previous_assignment] = own_costs[previous_assignment]
+        else:
+            partition_costs[previous_assignment] = marginal_cost(partition_sizes[previous_assignment], alpha, gamma, linear)
+        own_costs[previous_assignment] = marginal_cost(partition_sizes[previous_assignment] - 1.0, alpha, gamma, linear)
+    partition_sizes[new_assignment] += node_weights[node]
+    if unit:
+        own_costs[new_assignment] = partition_costs[new_assignment]
+    else:
+        own_costs[new_assignment] = marginal_cost(partition_sizes[new_assignment] - 1.0, alpha, gamma, linear)
+    partition_costs[new_assignment] = marginal_cost(partition_sizes[new_assignment], alpha, gamma, linear)
+    assignments[node] = new_assignment
+    return 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int csr_stream(int[::] order,
+                    int start,
+                    int end,
+                    int[::] indptr,
+                    int[::] indices,
+                    double[::] edge_weights,
+                    double[::] node_weights,
+                    int num_partitions,
+                    int[::] assignments,
+                    int[::] fixed,
+                    float alpha,
+                    double gamma,
+                    bint linear,
+                    double[::] partition_sizes,
+                    double[::] partition_costs,
+                    double[::] own_costs,
+                    float[::] partition_votes) nogil:
+    '''
+    Assigns the nodes in order[start:end] that have neighbors, skipping fixed nodes
+    '''
+    cdef int i = 0
+    cdef int node = 0
+    cdef int previous_assignment = 0
+    cdef int new_assignment = 0
+
+    for i in range(start, end):
+        node = order[i]
+
+        # Skip fixed nodes and single nodes, the latter are dealt with separately
+        if fixed[node] != UNMAPPED or indptr[node] == indptr[node + 1]:
+            continue
+
+        csr_votes(node, indptr, indices, edge_weights, assignments, partition_votes, num_partitions)
+        previous_assignment = assignments[node]
+        new_assignment = csr_assignment(previous_assignment, partition_votes, partition_sizes, partition_costs,
+                                        own_costs, num_partitions, alpha, gamma, linear, node_weights[node])
+        if new_assignment != previous_assignment:
+            csr_move(node, previous_assignment, new_assignment, node_weights, assignments,
+                     partition_sizes, partition_costs, own_costs, alpha, gamma, linear)
+
+    return 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int csr_single_nodes(int[::] order,
+                          int[::] indptr,
+                          double[::] node_weights,
+                          int num_partitions,
+                          int[::] assignments,
+                          int[::] fixed,
+                          float alpha,
+                          double gamma,
+                          bint linear,
+                          double[::] partition_sizes,
+                          double[::] partition_costs,
+                          double[::] own_costs) nogil:
+    '''
+    Assigns unmapped nodes that have no neighbors to the smallest partition
+    '''
+    cdef int i = 0
+    cdef int arg = 0
+    cdef int node = 0
+    cdef int smallest = 0
+
+    for i in range(order.shape[0]):
+        node = order[i]
+        if fixed[node] != UNMAPPED or indptr[node] != indptr[node + 1]:
+            continue
+        if assignments[node] == UNMAPPED:
+            smallest = 0
+            for arg in range(1, num_partitions):
+                if partition_sizes[arg] < partition_sizes[smallest]:
+                    smallest = arg
+            csr_move(node, UNMAPPED, smallest, node_weights, assignments,
+                     partition_sizes, partition_costs, own_costs, alpha, gamma, linear)
+
+    return 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int csr_assign_block(int[::] block_nodes,
+                          float[:, ::1] block_votes,
+                          double[::] node_weights,
+                          int num_partitions,
+                          int[::] assignments,
+                          float alpha,
+                          double gamma,
+                          bint linear,
+                          double[::] partition_sizes,
+                          double[::] partition_costs,
+                          double[::] own_costs,
+                          float[:, ::1] onehot) nogil:
+    '''
+    Greedily assigns block_nodes using the votes computed for the whole block
+    '''
+    cdef int i = 0
+    cdef int node = 0
+    cdef int previous_assignment = 0
+    cdef int new_assignment = 0
+
+    for i in range(block_nodes.shape[0]):
+        node = block_nodes[i]
+        previous_assignment = assignments[node]
+        new_assignment = csr_assignment(previous_assignment, block_votes[i], partition_sizes, partition_costs,
+                                        own_costs, num_partitions, alpha, gamma, linear, node_weights[node])
+        if new_assignment != previous_assignment:
+            if previous_assignment != UNMAPPED:
+                onehot[node, previous_assignment] = 0.0
+            onehot[node, new_assignment] = 1.0
+            csr_move(node, previous_assignment, new_assignment, node_weights, assignments,
+                     partition_sizes, partition_costs, own_costs, alpha, gamma, linear)
+
+    return 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double csr_vote_margin(int node,
+                            int[::] indptr,
+                            int[::] indices,
+                            double[::] edge_weights,
+                            int[::] assignments,
+                            float[::] partition_votes,
+                            int num_partitions) nogil:
+    '''
+    Difference between the highest and second highest partition votes of node
+    '''
+    cdef int arg = 0
+    cdef double first = 0.0
+    cdef double second = 0.0
+
+    csr_votes(node, indptr, indices, edge_weights, assignments, partition_votes, num_partitions)
+    # votes are never negative, so starting from 0 gives the right margin
+    # for a single partition too
+    for arg in range(num_partitions):
+        if partition_votes[arg] > first:
+            second = first
+            first = partition_votes[arg]
+        elif partition_votes[arg] > second:
+            second = partition_votes[arg]
+
+    return first - second
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline bint heap_before(int a, int b, double[::] keys, int[::] arrival) nogil:
+    # highest key first, earliest arrival on ties
+    return keys[a] > keys[b] or (keys[a] == keys[b] and arrival[a] < arrival[b])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int heap_sift_up(int i, int[::] heap, int[::] heap_pos, double[::] keys, int[::] arrival) nogil:
+    cdef int node = heap[i]
+    cdef int parent = 0
+
+    while i > 0:
+        parent = (i - 1) // 2
+        if not heap_before(node, heap[parent], keys, arrival):
+            break
+        heap[i] = heap[parent]
+        heap_pos[heap[i]] = i
+        i = parent
+    heap[i] = node
+    heap_pos[node] = i
+    return 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int heap_sift_down(int i, int size, int[::] heap, int[::] heap_pos, double[::] keys, int[::] arrival) nogil:
+    cdef int node = heap[i]
+    cdef int child = 0
+
+    while True:
+        child = 2 * i + 1
+        if child >= size:
+            break
+        if child + 1 < size and heap_before(heap[child + 1], heap[child], keys, arrival):
+            child += 1
+        if not heap_before(heap[child], node, keys, arrival):
+            break
+        heap[i] = heap[child]
+        heap_pos[heap[i]] = i
+        i = child
+    heap[i] = node
+    heap_pos[node] = i
+    return 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int csr_buffered_stream(int[::] order,
+                             int buffer_size,
+                             int[::] indptr,
+                             int[::] indices,
+                             double[::] edge_weights,
+                             double[::] node_weights,
+                             int num_partitions,
+                             int[::] assignments,
+                             int[::] fixed,
+                             float alpha,
+                             double gamma,
+                             bint linear,
+                             double[::] partition_sizes,
+                             double[::] partition_costs,
+                             double[::] own_costs,
+                             float[::] partition_votes,
+                             int[::] heap,
+                             int[::] heap_pos,
+                             double[::] keys,
+                             int[::] arrival) nogil:
+    '''
+    Streams order through a buffer of buffer_size nodes held in an indexed
+    max-heap keyed on vote margin. Once the buffer is full, every arrival
+    places the buffered node with the highest margin, then re-keys its
+    buffered neighbors. heap_pos must be -1 for every node.
+    '''
+    cdef int i = 0
+    cdef int j = 0
+    cdef int n = order.shape[0]
+    cdef int size = 0
+    cdef int node = 0
+    cdef int neighbor = 0
+    cdef int last = 0
+    cdef int previous_assignment = 0
+    cdef int new_assignment = 0
+
+    while True:
+        if i < n:
+            node = order[i]
+            i += 1
+
+            # Skip fixed nodes and single nodes, the latter are dealt with separately
+            if fixed[node] != UNMAPPED or indptr[node] == indptr[node + 1]:
+                continue
+
+            keys[node] = csr_vote_margin(node, indptr, indices, edge_weights, assignments,
+                                         partition_votes, num_partitions)
+            arrival[node] = i
+            heap[size] = node
+            size += 1
+            heap_sift_up(size - 1, heap, heap_pos, keys, arrival)
+            if size < buffer_size:
+                continue
+        elif size == 0:
+            break
+
+        # take the most confident node out of the buffer
+        node = heap[0]
+        heap_pos[node] = -1
+        size -= 1
+        if size > 0:
+            last = heap[size]
+            heap[0] = last
+            heap_sift_down(0, size, heap, heap_pos, keys, arrival)
+
+        csr_votes(node, indptr, indices, edge_weights, assignments, partition_votes, num_partitions)
+        previous_assignment = assignments[node]
+        new_assignment = csr_assignment(previous_assignment, partition_votes, partition_sizes, partition_costs,
+                                        own_costs, num_partitions, alpha, gamma, linear, node_weights[node])
+        if new_assignment == previous_assignment:
+            continue
+        csr_move(node, previous_assignment, new_assignment, node_weights, assignments,
+                 partition_sizes, partition_costs, own_costs, alpha, gamma, linear)
+
+        # votes of buffered neighbors changed
+        for j in range(indptr[node], indptr[node + 1]):
+            neighbor = indices[j]
+            if heap_pos[neighbor] < 0:
+                continue
+            keys[neighbor] = csr_vote_margin(neighbor, indptr, indices, edge_weights, assignments,
+                                             partition_votes, num_partitions)
+            heap_sift_up(heap_pos[neighbor], heap, heap_pos, keys, arrival)
+            heap_sift_down(heap_pos[neighbor], size, heap, heap_pos, keys, arrival)
+
+    return 0
+
+
+def csr_adjacency(tuple csr):
+    '''
+    Weighted adjacency matrix of the CSR arrays, with the same weight rules as
+    FennelPartitioner.get_votes()
+    '''
+    indptr, indices, edge_weights, node_weights = csr
+    data = np.where(edge_weights <= 0.0, 1.0, edge_weights)
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(node_weights), len(node_weights)))
+
+
 class FennelPartitioner():
 
-    def __init__(self, alpha=None, FRIEND_OF_FRIEND_ENABLED=False):
+    def __init__(self, alpha=None, FRIEND_OF_FRIEND_ENABLED=False, CSR_ENABLED=False, THREADS=1, SYNC_INTERVAL=1024,
+                 BATCHED_VOTES_ENABLED=False, VOTE_BLOCK_SIZE=1024,
+                 CONVERGENCE_THRESHOLD=0.0, CUT_CONVERGENCE_THRESHOLD=0.0, ACTIVE_SET_ENABLED=False,
+                 GAMMA=None, BUFFER_SIZE=0):
         if alpha:
             self.PREDICTION_MODEL_ALPHA = alpha
         self.original_graph = None
         self.FENNEL_FRIEND_OF_A_FRIEND_ENABLED = FRIEND_OF_FRIEND_ENABLED
+        # run the passes with the compiled CSR kernel instead of networkx
+        self.FENNEL_CSR_ENABLED = CSR_ENABLED
+        # parallel CSR kernel, see fennel_parallel()
+        self.FENNEL_THREADS = THREADS
+        self.FENNEL_SYNC_INTERVAL = SYNC_INTERVAL
+        # restream passes compute votes a block at a time, see fennel_batched_votes()
+        self.FENNEL_BATCHED_VOTES_ENABLED = BATCHED_VOTES_ENABLED
+        self.FENNEL_VOTE_BLOCK_SIZE = VOTE_BLOCK_SIZE
+        # stop restreaming when the fraction of nodes moved in a pass, or the
+        # relative change in edges cut, is at most this value
+        self.FENNEL_CONVERGENCE_THRESHOLD = CONVERGENCE_THRESHOLD
+        self.FENNEL_CUT_CONVERGENCE_THRESHOLD = CUT_CONVERGENCE_THRESHOLD
+        # number of passes made by the last call to generate_prediction_model()
+        self.passes_run = 0
+        # only re-score nodes whose neighborhood changed, see active_set()
+        self.FENNEL_ACTIVE_SET_ENABLED = ACTIVE_SET_ENABLED
+        self.active_set_state = None
         self.batch_node_order = []
+        # total node weight per partition, seeded once per call to
+        # generate_prediction_model() and updated as nodes move
+        self.partition_sizes = None
+        # exponent of the FENNEL objective alpha x size^gamma, None keeps the
+        # original linear penalty alpha x size
+        assert GAMMA is None or GAMMA > 1, "FENNEL_GAMMA must be greater than 1, got {}".format(GAMMA)
+        self.FENNEL_GAMMA = GAMMA
+        # marginal_cost() of every entry in partition_sizes for cost_alpha,
+        # and of every entry less 1 for nodes of weight 1 in their own
+        # partition, maintained alongside the sizes so nodes are scored
+        # without pow()
+        self.partition_costs = None
+        self.partition_own_costs = None
+        self.cost_alpha = None
+        # the first pass places nodes from a buffer of this many arrivals,
+        # most confident first, see fennel_buffered()
+        self.FENNEL_BUFFER_SIZE = BUFFER_SIZE
+
+    def node_weight(self, object graph, int node):
+        # same default as bincount_assigned() for nodes without a weight
+        return graph.node[node].get('weight', 1)
+
+    def init_partition_sizes(self, object graph, int num_partitions, int[::] partition):
+        s = bincount_assigned(graph, partition, num_partitions)
+        self.partition_sizes = np.array(s, dtype=np.float64)
+        self.partition_costs = None
+        self.partition_own_costs = None
+        self.cost_alpha = None
+        return self.partition_sizes
+
+    def gamma(self):
+        # the linear penalty alpha x size is the marginal cost of gamma = 2
+        # with alpha halved
+        if self.FENNEL_GAMMA is None:
+            return 2.0
+        return float(self.FENNEL_GAMMA)
+
+    def linear_cost(self):
+        # selects the linear penalty in marginal_cost()
+        return self.FENNEL_GAMMA is None
+
+    def marginal_costs(self, double[::] sizes, float alpha):
+        cdef double gamma = self.gamma()
+        cdef bint linear = self.linear_cost()
+        cdef int arg = 0
+        costs = np.zeros(sizes.shape[0], dtype=np.float64)
+        cdef double[::] costs_view = costs
+        for arg in range(sizes.shape[0]):
+            costs_view[arg] = marginal_cost(sizes[arg], alpha, gamma, linear)
+        return costs
+
+    def init_partition_costs(self, float alpha):
+        '''
+        Recomputes the marginal cost tables from partition_sizes. Called at
+        the start of every pass as alpha changes between batches.
+        '''
+        self.partition_costs = self.marginal_costs(self.partition_sizes, alpha)
+        self.partition_own_costs = self.marginal_costs(self.partition_sizes - 1.0, alpha)
+        self.cost_alpha = alpha
+        return self.partition_costs
+
+    def move_node(self, object graph, int node, int previous_assignment, int new_assignment, object sizes=None):
+        '''
+        Updates partition_sizes (or sizes, if given) when node moves from
+        previous_assignment to new_assignment
+        '''
+        global UNMAPPED
+        if sizes is None:
+            sizes = self.partition_sizes
+        if previous_assignment == new_assignment or sizes is None:
+            return
+        weight = self.node_weight(graph, node)
+        if previous_assignment != UNMAPPED:
+            sizes[previous_assignment] -= weight
+        if new_assignment != UNMAPPED:
+            sizes[new_assignment] += weight
+
+        if sizes is self.partition_sizes and self.cost_alpha is not None:
+            for arg in (previous_assignment, new_assignment):
+                if arg != UNMAPPED:
+                    self.partition_costs[arg] = marginal_cost(sizes[arg], self.cost_alpha, self.gamma(), self.linear_cost())
+                    self.partition_own_costs[arg] = marginal_cost(sizes[arg] - 1.0, self.cost_alpha, self.gamma(),
+                                                                  self.linear_cost())
 
     def get_votes(self, object graph, int node, int num_partitions, int[::] partition):
         global UNMAPPED
@@ -43,7 +568,8 @@ class FennelPartitioner():
                        int num_partitions,
                        int[::] partition,
                        float[::] partition_votes,
-                       float alpha):
+                       float alpha,
+                       object sizes=None):
 
         global DEBUG, UNMAPPED
         cdef int arg = 0
@@ -51,58 +577,62 @@ class FennelPartitioner():
         cdef float max_val = 0
         cdef float val = 0
         cdef int previous_assignment = 0
+        cdef double gamma = self.gamma()
+        cdef bint linear = self.linear_cost()
 
         assert partition is not None, "Blank partition passed"
 
-        cdef float[::] partition_sizes = np.zeros(num_partitions, dtype=np.float32)
-        s = bincount_assigned(graph, partition, num_partitions)
-        partition_sizes = np.fromiter(s, dtype=np.float32)
+        # use the sizes tracked by the partitioner when available, rather
+        # than counting the whole graph again for every node
+        tracked = sizes is None and self.partition_sizes is not None
+        if sizes is None:
+            sizes = self.partition_sizes
+        if sizes is None:
+            sizes = bincount_assigned(graph, partition, num_partitions)
+        cdef double[::] partition_sizes = np.asarray(sizes, dtype=np.float64)
+
+        # the marginal costs of the tracked sizes are kept up to date by
+        # move_node(), anything else is costed here
+        own_costs = None
+        if tracked and self.cost_alpha == alpha:
+            costs = self.partition_costs
+            own_costs = self.partition_own_costs
+        else:
+            costs = self.marginal_costs(partition_sizes, alpha)
+        cdef double[::] partition_costs = costs
 
         if DEBUG:
             print("Assigning node {}".format(node))
-            print("\tPn = Votes - Alpha x Size")
+            print("\tPn = Votes - Cost(Size)")
 
         # Remember placement of node in the previous assignment
         previous_assignment = partition[node]
 
-        max_arg = 0
-        max_val = partition_votes[0] - alpha * partition_sizes[0]
-        # XXX Loneliness score
-        #if partition_votes[arg] > 0:
-        #    max_val = 1 / partition_votes[arg]^n
-        #else:
-        #    max_val = 0
-
-        if DEBUG:
-            print("\tP{} = {} - {} x {} = {}".format(0,
-                                                     partition_votes[0],
-                                                     alpha,
-                                                     partition_sizes[0],
-                                                     max_val))
-
-        if previous_assignment == 0:
-            # We remove the node from its current partition before
-            # deciding to re-add it, so subtract alpha to give
-            # result of 1 lower partition size.
-            max_val += alpha
-
-        for arg in range(1, num_partitions):
-            val = partition_votes[arg] - alpha * partition_sizes[arg]
+        for arg in range(num_partitions):
+            val = partition_votes[arg] - <float>partition_costs[arg]
             #if partition_votes[arg] > 0:
             #    val = 1 / partition_votes[arg]^n
             #else:
             #    val = 0
 
             if DEBUG:
-                print("\tP{} = {} - {} x {} = {}".format(arg,
-                                                         partition_votes[arg],
-                                                         alpha,
-                                                         partition_sizes[arg],
-                                                         val))
+                print("\tP{} = {} - {}({}) = {}".format(arg,
+                                                       partition_votes[arg],
+                                                       alpha,
+                                                       partition_sizes[arg],
+                                                       val))
             if previous_assignment == arg:
-                # See comment above
-                val += alpha
-            if val > max_val: # XXX take account of partition_sizes
+                # We remove the node from its current partition before
+                # deciding to re-add it, so cost it at the size it would
+                # have without the node.
+                if linear:
+                    val += alpha
+                elif own_costs is not None and self.node_weight(graph, node) == 1:
+                    val = partition_votes[arg] - <float>own_costs[arg]
+                else:
+                    val = partition_votes[arg] - <float>marginal_cost(
+                        partition_sizes[arg] - self.node_weight(graph, node), alpha, gamma, linear)
+            if arg == 0 or val > max_val: # XXX take account of partition_sizes
                 max_arg = arg
                 max_val = val
 
@@ -120,6 +650,14 @@ class FennelPartitioner():
 
         global DEBUG, UNMAPPED
         cdef int node = 0
+        cdef int previous_assignment = 0
+
+        # when called outside of generate_prediction_model(), count the
+        # partition sizes for this pass only
+        standalone = self.partition_sizes is None
+        if standalone:
+            self.init_partition_sizes(graph, num_partitions, assignments)
+        self.init_partition_costs(alpha)
 
         single_nodes = []
         for node in graph.nodes_iter():
@@ -137,15 +675,244 @@ class FennelPartitioner():
                 continue
 
             partition_votes = self.get_votes(graph, node, num_partitions, assignments)
+            previous_assignment = assignments[node]
             assignments[node] = self.get_assignment(graph, node, num_partitions, assignments, partition_votes, alpha)
+            self.move_node(graph, node, previous_assignment, assignments[node])
 
         # Assign single nodes that have no neighbors
         node = 0
         for node in single_nodes:
             if assignments[node] == UNMAPPED:
-                parts = bincount_assigned(graph, assignments, num_partitions)
-                smallest = parts.index(min(parts))
+                smallest = int(np.argmin(self.partition_sizes))
                 assignments[node] = smallest
+                self.move_node(graph, node, UNMAPPED, smallest)
+
+        if standalone:
+            self.partition_sizes = None
+            self.partition_costs = None
+            self.partition_own_costs = None
+            self.cost_alpha = None
+
+        return np.asarray(assignments)
+
+    def fennel_csr(self,
+                   tuple csr,
+                   int[::] order,
+                   int num_partitions,
+                   int[::] assignments,
+                   int[::] fixed,
+                   float alpha):
+        '''
+        Same as fennel() but works on the CSR arrays returned by
+        utils.graph_to_csr(), visiting nodes in order. The pass runs without
+        the GIL. partition_sizes must have been initialised.
+        '''
+        cdef int[::] indptr = csr[0]
+        cdef int[::] indices = csr[1]
+        cdef double[::] edge_weights = csr[2]
+        cdef double[::] node_weights = csr[3]
+        cdef double[::] partition_sizes = self.partition_sizes
+        cdef double[::] partition_costs = self.init_partition_costs(alpha)
+        cdef double[::] own_costs = self.partition_own_costs
+        cdef double gamma = self.gamma()
+        cdef bint linear = self.linear_cost()
+        cdef float[::] partition_votes = np.zeros(num_partitions, dtype=np.float32)
+
+        with nogil:
+            csr_stream(order, 0, order.shape[0], indptr, indices, edge_weights, node_weights,
+                       num_partitions, assignments, fixed, alpha, gamma, linear, partition_sizes, partition_costs,
+                       own_costs, partition_votes)
+            csr_single_nodes(order, indptr, node_weights, num_partitions, assignments, fixed, alpha, gamma, linear,
+                             partition_sizes, partition_costs, own_costs)
+
+        return np.asarray(assignments)
+
+    def fennel_buffered(self,
+                        tuple csr,
+                        int[::] order,
+                        int num_partitions,
+                        int[::] assignments,
+                        int[::] fixed,
+                        float alpha):
+        '''
+        Version of fennel_csr() where nodes arriving in order enter a buffer of
+        FENNEL_BUFFER_SIZE nodes instead of being assigned straight away. When
+        the buffer is full the node with the largest vote margin (votes for
+        its best partition minus votes for the second best) is assigned first,
+        so nodes with little information wait for their neighbors to be
+        placed. The buffer is an indexed heap, each arrival costs O(log B)
+        plus O(degree x log B) to re-key the buffered neighbors of the node
+        placed. A buffer size of 1 gives the same result as fennel_csr().
+        '''
+        cdef int[::] indptr = csr[0]
+        cdef int[::] indices = csr[1]
+        cdef double[::] edge_weights = csr[2]
+        cdef double[::] node_weights = csr[3]
+        cdef double[::] partition_sizes = self.partition_sizes
+        cdef double[::] partition_costs = self.init_partition_costs(alpha)
+        cdef double[::] own_costs = self.partition_own_costs
+        cdef double gamma = self.gamma()
+        cdef bint linear = self.linear_cost()
+        cdef int buffer_size = max(1, self.FENNEL_BUFFER_SIZE)
+        cdef float[::] partition_votes = np.zeros(num_partitions, dtype=np.float32)
+        cdef int[::] heap = np.zeros(buffer_size, dtype=np.int32)
+        cdef int[::] heap_pos = np.repeat(np.int32(-1), len(node_weights))
+        cdef double[::] keys = np.zeros(len(node_weights), dtype=np.float64)
+        cdef int[::] arrival = np.zeros(len(node_weights), dtype=np.int32)
+
+        with nogil:
+            csr_buffered_stream(order, buffer_size, indptr, indices, edge_weights, node_weights,
+                                num_partitions, assignments, fixed, alpha, gamma, linear, partition_sizes,
+                                partition_costs, own_costs, partition_votes, heap, heap_pos, keys, arrival)
+            csr_single_nodes(order, indptr, node_weights, num_partitions, assignments, fixed, alpha, gamma, linear,
+                             partition_sizes, partition_costs, own_costs)
+
+        return np.asarray(assignments)
+
+    def fennel_parallel(self,
+                        tuple csr,
+                        int[::] order,
+                        int num_partitions,
+                        int[::] assignments,
+                        int[::] fixed,
+                        float alpha):
+        '''
+        Parallel version of fennel_csr() using FENNEL_THREADS worker threads.
+
+        The stream is processed in rounds. In each round every worker takes the
+        next FENNEL_SYNC_INTERVAL nodes and assigns them against its own copy
+        of partition_sizes, the copies are merged back at the end of the round.
+        Workers share the assignments array, so they see each other's moves of
+        neighbors as they happen, but not each other's changes to the sizes.
+
+        Quality bound: within a round a worker misses at most the moves made by
+        the other T - 1 workers, so every partition size it sees is off by at
+        most D = (T - 1) x FENNEL_SYNC_INTERVAL x max node weight, and the
+        score it computes for a partition by at most the change of
+        marginal_cost() over D. For the linear penalty that is alpha x D.
+        With FENNEL_GAMMA set it is at most alpha x gamma x (gamma - 1) x
+        S^(gamma - 2) x D for gamma >= 2, where S is the largest partition
+        size, and alpha x gamma x D^(gamma - 1) for gamma < 2. Each node is
+        therefore placed in a partition whose score is within twice that of
+        the one the sequential pass would have picked from the same state.
+        With one thread this is identical to fennel_csr(). Results can vary
+        between runs as they depend on thread scheduling.
+        '''
+        cdef int[::] indptr = csr[0]
+        cdef double[::] node_weights = csr[3]
+        cdef double[::] partition_sizes = self.partition_sizes
+        cdef double[::] partition_costs
+        cdef double[::] own_costs
+        cdef double gamma = self.gamma()
+        cdef bint linear = self.linear_cost()
+        cdef int num_order = order.shape[0]
+        cdef int num_threads = self.FENNEL_THREADS
+        cdef int interval = self.FENNEL_SYNC_INTERVAL
+        cdef int start = 0
+
+        if num_threads <= 1:
+            return self.fennel_csr(csr, order, num_partitions, assignments, fixed, alpha)
+
+        worker_sizes = [np.zeros(num_partitions, dtype=np.float64) for t in range(num_threads)]
+        worker_costs = [np.zeros(num_partitions, dtype=np.float64) for t in range(num_threads)]
+        worker_own_costs = [np.zeros(num_partitions, dtype=np.float64) for t in range(num_threads)]
+        worker_votes = [np.zeros(num_partitions, dtype=np.float32) for t in range(num_threads)]
+
+        def worker(int t, int worker_start, int worker_end):
+            cdef int[::] w_indptr = csr[0]
+            cdef int[::] w_indices = csr[1]
+            cdef double[::] w_edge_weights = csr[2]
+            cdef double[::] w_node_weights = csr[3]
+            cdef double[::] w_sizes = worker_sizes[t]
+            cdef double[::] w_costs = worker_costs[t]
+            cdef double[::] w_own_costs = worker_own_costs[t]
+            cdef float[::] w_votes = worker_votes[t]
+            with nogil:
+                csr_stream(order, worker_start, worker_end, w_indptr, w_indices, w_edge_weights,
+                           w_node_weights, num_partitions, assignments, fixed, alpha, gamma, linear,
+                           w_sizes, w_costs, w_own_costs, w_votes)
+
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            while start < num_order:
+                # snapshot the shared sizes for every worker
+                snapshot = np.array(self.partition_sizes, copy=True)
+                costs = self.init_partition_costs(alpha)
+                jobs = []
+                for t in range(num_threads):
+                    worker_start = min(start + t * interval, num_order)
+                    worker_end = min(worker_start + interval, num_order)
+                    worker_sizes[t][:] = snapshot
+                    worker_costs[t][:] = costs
+                    worker_own_costs[t][:] = self.partition_own_costs
+                    jobs.append(pool.submit(worker, t, worker_start, worker_end))
+                for job in jobs:
+                    job.result()
+
+                # merge the changes each worker made to the sizes
+                for t in range(num_threads):
+                    self.partition_sizes += worker_sizes[t] - snapshot
+                start += num_threads * interval
+
+        partition_costs = self.init_partition_costs(alpha)
+        own_costs = self.partition_own_costs
+        with nogil:
+            csr_single_nodes(order, indptr, node_weights, num_partitions, assignments, fixed, alpha, gamma, linear,
+                             partition_sizes, partition_costs, own_costs)
+
+        return np.asarray(assignments)
+
+    def fennel_batched_votes(self,
+                             tuple csr,
+                             object adjacency,
+                             int[::] order,
+                             int num_partitions,
+                             int[::] assignments,
+                             int[::] fixed,
+                             float alpha):
+        '''
+        Restreaming version of fennel_csr() where votes are computed for
+        FENNEL_VOTE_BLOCK_SIZE nodes at a time as adjacency[block] @ onehot,
+        onehot being the one-hot encoding of the current assignments. Nodes in a
+        block are then assigned in order using those votes and the up to date
+        partition sizes, so a node does not see moves made earlier in its own
+        block. A block size of 1 gives the same result as fennel_csr().
+        '''
+        cdef int[::] indptr = csr[0]
+        cdef double[::] node_weights = csr[3]
+        cdef double[::] partition_sizes = self.partition_sizes
+        cdef double[::] partition_costs = self.init_partition_costs(alpha)
+        cdef double[::] own_costs = self.partition_own_costs
+        cdef double gamma = self.gamma()
+        cdef bint linear = self.linear_cost()
+        cdef int[::] block_nodes
+        cdef float[:, ::1] block_votes
+        cdef float[:, ::1] onehot_view
+        cdef int block_size = max(1, self.FENNEL_VOTE_BLOCK_SIZE)
+        cdef int start = 0
+
+        nodes = np.asarray(order)
+        degree = np.diff(np.asarray(indptr))
+        nodes = nodes[(np.asarray(fixed)[nodes] == UNMAPPED) & (degree[nodes] > 0)]
+
+        assigned = np.flatnonzero(np.asarray(assignments) != UNMAPPED)
+        onehot = np.zeros((len(node_weights), num_partitions), dtype=np.float32)
+        onehot[assigned, np.asarray(assignments)[assigned]] = 1.0
+        onehot_view = onehot
+
+        # rows of the nodes being streamed, in stream order
+        streamed = adjacency[nodes]
+
+        for start in range(0, len(nodes), block_size):
+            block_nodes = nodes[start:start + block_size]
+            block_votes = np.ascontiguousarray(streamed[start:start + block_size] @ onehot, dtype=np.float32)
+            with nogil:
+                csr_assign_block(block_nodes, block_votes, node_weights, num_partitions,
+                                 assignments, alpha, gamma, linear, partition_sizes, partition_costs, own_costs,
+                                 onehot_view)
+
+        with nogil:
+            csr_single_nodes(order, indptr, node_weights, num_partitions, assignments, fixed, alpha, gamma, linear,
+                             partition_sizes, partition_costs, own_costs)
 
         return np.asarray(assignments)
 
@@ -165,15 +932,112 @@ class FennelPartitioner():
             if(len(current_batch_n) != len(current_batch)):
                 current_batch = current_batch_n
 
+        # count the partition sizes once, fennel() keeps them up to date
+        self.init_partition_sizes(graph, num_partitions, assignments)
+
+        use_csr = (self.FENNEL_CSR_ENABLED or self.FENNEL_THREADS > 1 or self.FENNEL_BATCHED_VOTES_ENABLED
+                   or self.FENNEL_ACTIVE_SET_ENABLED or self.FENNEL_BUFFER_SIZE > 0
+                   # array backed graphs such as GraphStore only support the CSR kernels
+                   or hasattr(graph, 'csr'))
+        csr = None
+        adjacency = None
+        if use_csr or self.FENNEL_CUT_CONVERGENCE_THRESHOLD > 0:
+            csr = graph_to_csr(graph, len(assignments))
+        if self.FENNEL_BATCHED_VOTES_ENABLED:
+            adjacency = csr_adjacency(csr)
+
+        order = np.fromiter(graph.nodes_iter(), dtype=np.int32)
+        streamed = order[np.asarray(fixed)[order] == UNMAPPED]
+        # nodes scored by the next pass, in stream order
+        worklist = streamed
+        if self.FENNEL_ACTIVE_SET_ENABLED:
+            worklist = self.initial_active_set(csr, streamed, assignments)
+        previous_cut = None
+        self.passes_run = 0
+
         for i in range(num_iterations):
-            assignments = self.fennel(graph, num_partitions, assignments, fixed, self.PREDICTION_MODEL_ALPHA)
+            if len(worklist) == 0:
+                break
+            previous = np.asarray(assignments)[worklist]
+
+            if self.FENNEL_BUFFER_SIZE > 0 and i == 0:
+                # the first pass decides the order nodes are placed in
+                assignments = self.fennel_buffered(csr, worklist, num_partitions, assignments, fixed, self.PREDICTION_MODEL_ALPHA)
+            elif adjacency is not None and i > 0:
+                # restream passes, the first pass streams node by node
+                assignments = self.fennel_batched_votes(csr, adjacency, worklist, num_partitions, assignments, fixed, self.PREDICTION_MODEL_ALPHA)
+            elif use_csr:
+                assignments = self.fennel_parallel(csr, worklist, num_partitions, assignments, fixed, self.PREDICTION_MODEL_ALPHA)
+            else:
+                assignments = self.fennel(graph, num_partitions, assignments, fixed, self.PREDICTION_MODEL_ALPHA)
+            self.passes_run += 1
+
+            # Stop restreaming once few enough nodes move. With a threshold of
+            # 0 this only stops when a pass changes nothing, after which every
+            # further pass would give the same assignments.
+            moved = worklist[previous != np.asarray(assignments)[worklist]]
+            if len(moved) <= self.FENNEL_CONVERGENCE_THRESHOLD * len(streamed):
+                worklist = worklist[:0]
+                break
+
+            # or once the number of edges cut stops changing
+            if self.FENNEL_CUT_CONVERGENCE_THRESHOLD > 0:
+                cut = edges_cut_csr(csr[0], csr[1], assignments)
+                if previous_cut is not None and abs(cut - previous_cut) <= self.FENNEL_CUT_CONVERGENCE_THRESHOLD * max(previous_cut, 1):
+                    worklist = worklist[:0]
+                    break
+                previous_cut = cut
+
+            if self.FENNEL_ACTIVE_SET_ENABLED:
+                worklist = self.active_set(csr, streamed, moved)
+
+        if self.FENNEL_ACTIVE_SET_ENABLED:
+            # remembered so the next call only re-scores what changed since
+            self.active_set_state = (csr, np.array(assignments, copy=True), worklist)
 
         if self.FENNEL_FRIEND_OF_A_FRIEND_ENABLED:
             # compute improved assignment for everyone in the current batch that has no friends in a partition
             self.friend_of_friend_lonely_node_partition_assignment(graph, num_partitions, current_batch, assignments, fixed)
 
+        # sizes are only valid for this graph and assignment
+        self.partition_sizes = None
+        self.partition_costs = None
+        self.partition_own_costs = None
+        self.cost_alpha = None
+
         return np.asarray(assignments)
 
+    def active_set(self, tuple csr, object streamed, object moved):
+        '''
+        Returns the nodes in streamed, in stream order, that have a neighbor in
+        moved. Votes only change for these nodes. This ignores the change in
+        partition sizes caused by the moves, which on its own can change the
+        decision of any node, so the result can differ from a full restream.
+        '''
+        dirty = np.zeros(len(csr[3]), dtype=bool)
+        dirty[csr_neighbors(csr[0], csr[1], moved)] = True
+        return streamed[dirty[streamed]]
+
+    def initial_active_set(self, tuple csr, object streamed, int[::] assignments):
+        '''
+        Returns the nodes in streamed that need scoring in the first pass, given
+        the state left by the previous call to generate_prediction_model(): nodes
+        that are unassigned, whose own weight, edges or assignment changed, that
+        have a neighbor whose assignment changed, or that were still dirty.
+        '''
+        global UNMAPPED
+        if self.active_set_state is None or len(self.active_set_state[0][3]) != len(csr[3]):
+            return streamed
+
+        previous_csr, previous_assignments, previous_worklist = self.active_set_state
+        current = np.asarray(assignments)
+
+        moved = current != previous_assignments
+        dirty = csr_rows_changed(previous_csr, csr) | moved | (current == UNMAPPED)
+        dirty[csr_neighbors(csr[0], csr[1], np.flatnonzero(moved))] = True
+        dirty[previous_worklist] = True
+        return streamed[dirty[streamed]]
+
     def current_batch_nodes(self, object graph, int [::] fixed):
         '''
         Returns the list of nodes in graph that currently haven't been assigned to any single partition just yet
@@ -192,109 +1056,105 @@ class FennelPartitioner():
                                   int [::] assignments,
                                   int [::] fixed):
         '''
-        This function determines the optimal partition for a node that is lonely.
-
-1. for each fennel batch, I run fennel with all of its iterations, which produces the assignments
-2. once that is done, i make a list of nodes, from the latest batch that have just been assigned and from that list, I extract the nodes that have no friends in any of the partitions, the lonely_nodes list
-2.a the way the lonely nodes are found is: i call get_votes() from FENNEL, which, given a node, makes the sum of edge weights between that node and all nodes in each partition. so a partition with score 0.0 = a partition where this node has no edges, so if the sum of partition_votes = 0 across all partitions, then that node has no friends in any partition
-3. for each lonely node, i perform the following
-3.a find all the neighbours of that node, whether they have been assigned already or not, i then remove the neighbours that are already in a partition (a case that should never happen given 2a above)
-3.b for each neighbour, I compute the partition_scores for that neighbour, as if I were trying to assign it now, given the partition score, i remove any neighbour that has NO friends currently assigned by fennel
-3.c at this point, the neighbour has at least a friend in any partition, so I compute the FENNEL assignment, calling get_assignment() which assigns that node to their hypothetical partition
-3.d i store a count of where friends of the lonely node get partitioned: example 'lonely_node friend counts', 50, {2: 3, 0: 2}. This means that node 50 is a lonely_node and 3 of its friends have been assigned by fennel to partition 2 and 2 of its friends have been assigned to partition 0
-3.e at this point, I should relocate node 50 from its currently assigned partition, to partition 2
+        This function determines the optimal partition for nodes that are lonely.
 
-MISSING: node relocation out of current assignment to find neighbor scores and then relocation after scores computed
+        1. find the nodes of the current batch that have no friends in any
+           partition of graph, the lonely nodes
+        2. take each lonely node out of its partition and compute the votes of
+           its unfixed neighbors in the full graph (original_graph when set)
+        3. move each lonely node to the partition with the highest sum of its
+           neighbors' votes
+        4. for each neighbor with friends in a partition, compute the FENNEL
+           assignment it would get, and move the lonely node to the partition
+           most of its neighbors would end up in
 
+        Every step is computed for all lonely nodes at once with sparse
+        products of adjacency rows and the one-hot encoded assignments. Each
+        lonely node is scored against the assignments before any lonely node
+        is moved, so it does not see where lonely nodes sharing a neighbor
+        with it go.
         '''
+        global UNMAPPED
+        cdef double gamma = self.gamma()
+        cdef bint linear = self.linear_cost()
+        cdef float alpha = self.PREDICTION_MODEL_ALPHA
 
-        #print('STARTING friend_of_friend_lonely_node_partition_assignment')
+        if not current_batch_nodes:
+            return
 
-        # obtain list of friendless nodes
-        lonely_nodes = []
-        for node in current_batch_nodes:
-            # check how many friends are assigned to partitions for the current node and current subgraph
-            partition_scores = list(self.get_votes(graph, node, num_partitions, assignments))
-            if self.node_has_friends_in_partitions(partition_scores) == False:
-                # check if node has any edges at all in whole graph
-                lonely_nodes.append(node)
+        source = self.original_graph if self.original_graph else graph
+        num_nodes = len(assignments)
+        partition = np.asarray(assignments)
+        is_fixed = np.asarray(fixed) != UNMAPPED
 
-        #print('lonely nodes:', lonely_nodes)
+        assigned = np.flatnonzero(partition != UNMAPPED)
+        onehot = sparse.csr_matrix((np.ones(len(assigned), dtype=np.float32), (assigned, partition[assigned])),
+                                   shape=(num_nodes, num_partitions))
 
-        for lonely_node in lonely_nodes:
-            neighbors = []
+        # 1. lonely nodes have no votes for any partition
+        batch = np.asarray(current_batch_nodes, dtype=np.int32)
+        batch_csr = graph_to_csr(graph, num_nodes, current_batch_nodes)
+        batch_votes = csr_adjacency(batch_csr)[batch] @ onehot
+        lonely = batch[np.asarray(batch_votes.sum(axis=1)).ravel() == 0.0]
+        if len(lonely) == 0:
+            return
 
-            if self.original_graph:
-                # use the full graph
-                neighbors = list(nx.all_neighbors(self.original_graph, lonely_node))
-            else:
-                neighbors = list(nx.all_neighbors(graph, lonely_node))
-
-            #print('lonely_node_neighbors', lonely_node, neighbors)
-
-            if len(neighbors) > 0:
-                # this is a single node, a random assignment is OK
-                #print('Found FENNEL node that has no friends in partitions, but that has some friends in network', lonely_node, neighbors)
-                friend_count_per_partition = {}
-                # check where these neighbors are more likely to end up
-                #cdef int neighbor = 0
-                # on a first pass over the neighbors, compute the total partition scores and move the lonely_node to that partition
-                total_neighbor_partition_scores = {}
-                neighbor_partition_scores = {}
-                original_partition = assignments[lonely_node]
-                assignments[lonely_node] = -1
-
-                for neighbor in neighbors:
-                    if fixed[neighbor] != UNMAPPED:
-                        continue # neighbor is in network - should never be the case
-                    neighbor_partition_scores[neighbor] = self.get_votes(self.original_graph, neighbor, num_partitions, assignments)
-                    for i, score in enumerate(list(neighbor_partition_scores[neighbor])):
-                        if i in total_neighbor_partition_scores:
-                            total_neighbor_partition_scores[i] += score
-                        else:
-                            total_neighbor_partition_scores[i] = score
-
-                # move lonely node to partition with highest neighbor score
-                max_score = 0.0
-                max_score_partition = -1
-                for partition in total_neighbor_partition_scores.keys():
-                    if total_neighbor_partition_scores[partition] > max_score:
-                        max_score_partition = partition
-                        max_score = total_neighbor_partition_scores[partition]
-
-                # relocate node
-                if(max_score_partition >= 0):
-                    #print('relocating lonely_node', lonely_node, original_partition, max_score_partition, total_neighbor_partition_scores)
-                    assignments[lonely_node] = max_score_partition
-                else:
-                    assignments[lonely_node] = original_partition
-
-                for neighbor in neighbors:
-                    if fixed[neighbor] != UNMAPPED:
-                        continue # neighbor is in network - should never be the case
-                    #partition_scores = self.get_votes(self.original_graph, neighbor, num_partitions, assignments)
-                    if self.node_has_friends_in_partitions(list(neighbor_partition_scores[neighbor])) == True:
-                    #if self.node_has_friends_in_partitions(list(partition_scores)) == True:
-                        # this neighbor has at least one friend in any one of the partitions
-                        # determine in which partition this friend would end up
-                        partition = self.get_assignment(self.original_graph, neighbor, num_partitions, assignments, neighbor_partition_scores[neighbor], self.PREDICTION_MODEL_ALPHA)
-                        if partition in friend_count_per_partition:
-                            friend_count_per_partition[partition] += 1
-                        else:
-                            friend_count_per_partition[partition] = 1
-                    #print('friend', neighbor, list(partition_scores))
-                #print('lonely_node friend counts', lonely_node, friend_count_per_partition)
-                # relocate lonely_node based on friend_count_per_partition
-                max_count = 0
-                best_partition = -1
-                for partition in friend_count_per_partition.keys():
-                    if friend_count_per_partition[partition] > max_count:
-                        max_count = friend_count_per_partition[partition]
-                        best_partition = partition
-
-                if best_partition >= 0:
-                    #print('relocating lonely_node to best partition', lonely_node, max_count, best_partition)
-                    assignments[lonely_node] = best_partition
+        # one row per (lonely node, unfixed neighbor) pair
+        lonely_csr = graph_to_csr(source, num_nodes, lonely.tolist())
+        pairs = csr_adjacency(lonely_csr)[lonely].tocoo()
+        keep = ~is_fixed[pairs.col]
+        pair_lonely = pairs.row[keep]
+        pair_neighbor = pairs.col[keep]
+        pair_weight = pairs.data[keep]
+        original = partition[lonely]
+
+        # 2. votes of the neighbors, without the lonely node itself
+        neighbors = np.unique(pair_neighbor)
+        neighbor_csr = graph_to_csr(source, num_nodes, neighbors.tolist())
+        neighbor_votes = np.asarray((csr_adjacency(neighbor_csr)[neighbors] @ onehot).todense(), dtype=np.float64)
+        votes = neighbor_votes[np.searchsorted(neighbors, pair_neighbor)]
+        was_assigned = original[pair_lonely] != UNMAPPED
+        votes[np.flatnonzero(was_assigned), original[pair_lonely][was_assigned]] -= pair_weight[was_assigned]
+        votes = votes.astype(np.float32)
+
+        # 3. partition with the highest total neighbor votes
+        totals = np.zeros((len(lonely), num_partitions), dtype=np.float64)
+        np.add.at(totals, pair_lonely, votes)
+        relocated = np.where(totals.max(axis=1) > 0.0, totals.argmax(axis=1), original)
+
+        # sizes of the full graph seen by the neighbors of each lonely node
+        weights = neighbor_csr[3]
+        sizes = np.tile(np.asarray(bincount_assigned(source, partition, num_partitions), dtype=np.float64),
+                        (len(lonely), 1))
+        rows = np.arange(len(lonely))
+        sizes[rows[original != UNMAPPED], original[original != UNMAPPED]] -= weights[lonely[original != UNMAPPED]]
+        sizes[rows[relocated != UNMAPPED], relocated[relocated != UNMAPPED]] += weights[lonely[relocated != UNMAPPED]]
+        costs = self.marginal_costs(sizes.ravel(), alpha).reshape(sizes.shape)
+
+        # 4. FENNEL assignment of every neighbor with friends in a partition,
+        # the same scores as get_assignment()
+        friendly = np.flatnonzero(votes.sum(axis=1) > 0.0)
+        owner = pair_lonely[friendly]
+        scores = votes[friendly] - costs[owner].astype(np.float32)
+        previous = partition[pair_neighbor[friendly]]
+        rescored = np.flatnonzero(previous != UNMAPPED)
+        if linear:
+            scores[rescored, previous[rescored]] += np.float32(alpha)
+        else:
+            own_sizes = sizes[owner[rescored], previous[rescored]] - weights[pair_neighbor[friendly][rescored]]
+            own_costs = self.marginal_costs(own_sizes, alpha).astype(np.float32)
+            scores[rescored, previous[rescored]] = votes[friendly][rescored, previous[rescored]] - own_costs
+        choice = scores.argmax(axis=1)
+        friend_counts = np.zeros((len(lonely), num_partitions), dtype=np.int64)
+        np.add.at(friend_counts, (owner, choice), 1)
+
+        # on equal counts, prefer the partition picked by the earliest neighbor
+        first_pick = np.full((len(lonely), num_partitions), len(friendly), dtype=np.int64)
+        np.minimum.at(first_pick, (owner, choice), np.arange(len(friendly)))
+        most_picked = friend_counts == friend_counts.max(axis=1, keepdims=True)
+        best_partition = np.where(most_picked, first_pick, len(friendly)).argmin(axis=1)
+
+        partition[lonely] = np.where(friend_counts.max(axis=1) > 0, best_partition, relocated)
 
     def node_has_friends_in_partitions(self, partition_scores):
         sum_scores = 0.0
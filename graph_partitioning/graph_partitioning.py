@@ -6,6 +6,9 @@ import numpy as np
 from builtins import ImportError
 
 from graph_partitioning import utils
+from graph_partitioning.array_graph import ArrayGraph, ArrivedSubgraph
+from graph_partitioning.graph_store import GraphStore
+from graph_partitioning.partition_metrics import PartitionMetrics
 
 #import graph_partitioning.metrics.dct_metrics as nmi_metrics
 from sklearn.metrics.cluster import normalized_mutual_info_score
@@ -20,6 +23,89 @@ class GraphPartitioning:
     UNMAPPED = -1
     _quiet = False
 
+    # Defaults for optional config settings
+
+    # Run FENNEL passes with the compiled CSR kernel rather than through networkx
+    FENNEL_CSR_ENABLED = False
+
+    # Number of threads used by the CSR FENNEL kernel, and how many nodes each
+    # thread assigns before partition sizes are synchronised between threads.
+    # See FennelPartitioner.fennel_parallel() for the bound on quality loss.
+    FENNEL_THREADS = 1
+    FENNEL_SYNC_INTERVAL = 1024
+
+    # Compute FENNEL votes for restream passes FENNEL_VOTE_BLOCK_SIZE nodes at a
+    # time with a sparse matrix product. Larger blocks are faster but each node
+    # sees older assignments of its neighbors.
+    FENNEL_BATCHED_VOTES_ENABLED = False
+    FENNEL_VOTE_BLOCK_SIZE = 1024
+
+    # Stop FENNEL restreaming early when the fraction of nodes that moved in a
+    # pass, or the relative change in edges cut between passes, is at most
+    # this value. A threshold of 0 only stops once a pass changes nothing,
+    # which gives the same assignments as running all num_iterations passes.
+    FENNEL_CONVERGENCE_THRESHOLD = 0.0
+    FENNEL_CUT_CONVERGENCE_THRESHOLD = 0.0
+
+    # After the first FENNEL pass, only re-score nodes with a neighbor that
+    # moved in the previous pass, and carry that set over between batches.
+    FENNEL_ACTIVE_SET_ENABLED = False
+
+    # Exponent of the FENNEL partition cost alpha x size^gamma. None keeps the
+    # original penalty of alpha per node already in the partition, which is
+    # gamma = 2 with alpha halved. When set, it must be greater than 1 and
+    # alpha is computed as m x k^(gamma - 1) / n^gamma.
+    FENNEL_GAMMA = None
+
+    # Stream the first FENNEL pass through a buffer of this many nodes, placing
+    # the node with the largest vote margin first. 0 assigns nodes in the
+    # order they arrive. Batches are then no longer reversed before streaming.
+    FENNEL_BUFFER_SIZE = 0
+
+    # Directory where parsed METIS files are cached, keyed by the hash of their
+    # contents. None reads DATA_FILENAME from scratch every time. Use
+    # utils.clear_metis_cache() to remove cached files.
+    GRAPH_CACHE_DIRECTORY = None
+
+    # Hold the graph in an ArrayGraph, which stores nodes, edges and their
+    # weights in arrays, rather than in a networkx graph. It is converted to
+    # networkx by clean_up() before the graph files are written.
+    ARRAY_GRAPH_ENABLED = False
+
+    # Directory of the graph_store.GraphStore of METIS files, see
+    # GraphStore.open_metis(). When set, the graph is an ArrayGraph over the
+    # memory-mapped arrays of the store, whatever ARRAY_GRAPH_ENABLED says,
+    # and only node and edge weights are held in memory.
+    GRAPH_STORE_DIRECTORY = None
+
+    # Format of DATA_FILENAME: 'METIS', 'EDGE_LIST' (such as the SNAP datasets,
+    # node ids are relabelled 0 to n - 1 in id order) or 'MATRIX_MARKET'. Edge
+    # lists and Matrix Market files are parsed in DATA_READER_PROCESSES
+    # processes, None uses every CPU.
+    DATA_FORMAT = 'METIS'
+    DATA_READER_PROCESSES = None
+
+    # Files written with the metrics, for the whole graph and every partition.
+    # GRAPH_FILE_FORMAT is 'GML', 'NPZ' (CSR arrays, much faster to write) or
+    # None to skip the graph file. Neither file is read by the metrics, only
+    # the OSLOM edge list which is always written.
+    GRAPH_FILE_FORMAT = 'GML'
+    ASSIGNMENTS_FILE_ENABLED = True
+
+    # Network permanence is computed by utils.run_max_perm(). When set, each
+    # sweep of MaxPerm visits and measures only this many random vertices of
+    # a graph, an approximation that bounds the cost on huge partitions.
+    # The samples are drawn with MAX_PERM_SEED, None draws different samples
+    # every run.
+    MAX_PERM_SAMPLE = None
+    MAX_PERM_SEED = 0
+
+    # Keep waste, cut ratio, edges cut, communication steps, RBSE and
+    # loneliness of the arrived subgraph up to date in a PartitionMetrics as
+    # nodes arrive and move, rather than computing them again every batch.
+    # Undirected graphs only.
+    INCREMENTAL_METRICS_ENABLED = False
+
     def __init__(self, *config, **kwargs):
         for dictionary in config:
             for key in dictionary:
@@ -30,7 +116,7 @@ class GraphPartitioning:
         if(self.verbose == 0):
             self._quiet = True
 
-        self.originalG = None
+        self.base_edge_weights = None
 
         self.compute_output_filenames()
 
@@ -40,13 +126,35 @@ class GraphPartitioning:
     def __exit__(self, *err):
         pass
 
+    def fennel_alpha(self, num_edges, num_nodes):
+        if self.FENNEL_GAMMA is None:
+            return num_edges * (self.num_partitions / num_nodes**2)
+        gamma = self.FENNEL_GAMMA
+        assert gamma > 1, "FENNEL_GAMMA must be greater than 1, got {}".format(gamma)
+        return num_edges * (self.num_partitions**(gamma - 1) / num_nodes**gamma)
+
     def load_network(self):
+        if self.DATA_FORMAT == 'EDGE_LIST' or self.DATA_FORMAT == 'MATRIX_MARKET':
+            if self.DATA_FORMAT == 'EDGE_LIST':
+                csr = utils.read_edge_list_csr(self.DATA_FILENAME, processes=self.DATA_READER_PROCESSES)
+            else:
+                csr = utils.read_matrix_market_csr(self.DATA_FILENAME, processes=self.DATA_READER_PROCESSES)
+            # nodes arrive in id order
+            self.G = ArrayGraph.from_csr(csr)
+            if not self.ARRAY_GRAPH_ENABLED:
+                self.G = self.G.to_networkx()
         # read METIS file
-        self.G = utils.read_metis(self.DATA_FILENAME)
+        elif self.GRAPH_STORE_DIRECTORY is not None:
+            self.G = ArrayGraph.from_store(GraphStore.open_metis(self.DATA_FILENAME, self.GRAPH_STORE_DIRECTORY))
+        elif self.ARRAY_GRAPH_ENABLED:
+            csr, node_order = utils.read_metis_csr(self.DATA_FILENAME, self.GRAPH_CACHE_DIRECTORY, node_order=True)
+            self.G = ArrayGraph.from_csr(csr, node_order)
+        else:
+            self.G = utils.read_metis(self.DATA_FILENAME, self.GRAPH_CACHE_DIRECTORY)
         self.initial_number_of_nodes = self.G.number_of_nodes() # used for computing metrics
 
         # Alpha value used in prediction model
-        self.prediction_model_alpha = self.G.number_of_edges() * (self.num_partitions / self.G.number_of_nodes()**2)
+        self.prediction_model_alpha = self.fennel_alpha(self.G.number_of_edges(), self.G.number_of_nodes())
 
         if self.use_one_shot_alpha:
             self.prediction_model_alpha = self.one_shot_alpha
@@ -83,17 +191,14 @@ class GraphPartitioning:
             with open(self.PREDICTION_LIST_FILE, 'r') as plf:
                 self.predicted_displacement_weights = [float(line.rstrip('\n')) for line in plf]
 
-        # preserve original node/edge weight when modification functions are applied
-        if self.graph_modification_functions:
-            node_weights = {n[0]: n[1]['weight'] for n in self.G.nodes_iter(data=True)}
-            nx.set_node_attributes(self.G, 'weight_orig', node_weights)
-
-            edge_weights = {(e[0], e[1]): e[2]['weight'] for e in self.G.edges_iter(data=True)}
-            nx.set_edge_attributes(self.G, 'weight_orig', edge_weights)
-
-        # make a copy of the original graph since we may alter the graph later on
-        # and may want to refer to information from the original graph
-        self.originalG = self.G.copy()
+        # preserve original edge weights when modification functions are applied,
+        # the graph keeps the modified weights
+        if self.graph_modification_functions and isinstance(self.G, ArrayGraph):
+            # indexed by edge id, edges added later have no original weight
+            self.base_edge_weights = self.G.edge_array('weight').copy()
+            self.base_edge_weights.setflags(write=False)
+        elif self.graph_modification_functions:
+            self.base_edge_weights = {(e[0], e[1]): e[2]['weight'] for e in self.G.edges_iter(data=True)}
 
     def init_partitioner(self):
         self.prediction_model_algorithm = None
@@ -106,12 +211,32 @@ class GraphPartitioning:
             from graph_partitioning import fennel
 
             if self.PREDICTION_MODEL_ALGORITHM == 'FENNEL':
-                self.prediction_model_algorithm = fennel.FennelPartitioner(self.prediction_model_alpha, self.FENNEL_FRIEND_OF_A_FRIEND_ENABLED)
+                self.prediction_model_algorithm = fennel.FennelPartitioner(self.prediction_model_alpha, self.FENNEL_FRIEND_OF_A_FRIEND_ENABLED,
+                                                                           CSR_ENABLED=self.FENNEL_CSR_ENABLED,
+                                                                           THREADS=self.FENNEL_THREADS,
+                                                                           SYNC_INTERVAL=self.FENNEL_SYNC_INTERVAL,
+                                                                           BATCHED_VOTES_ENABLED=self.FENNEL_BATCHED_VOTES_ENABLED,
+                                                                           VOTE_BLOCK_SIZE=self.FENNEL_VOTE_BLOCK_SIZE,
+                                                                           CONVERGENCE_THRESHOLD=self.FENNEL_CONVERGENCE_THRESHOLD,
+                                                                           CUT_CONVERGENCE_THRESHOLD=self.FENNEL_CUT_CONVERGENCE_THRESHOLD,
+                                                                           ACTIVE_SET_ENABLED=self.FENNEL_ACTIVE_SET_ENABLED,
+                                                                           GAMMA=self.FENNEL_GAMMA,
+                                                                           BUFFER_SIZE=self.FENNEL_BUFFER_SIZE)
                 if self.verbose > 0:
                     print("FENNEL partitioner loaded for generating PREDICTION MODEL.")
 
             if self.PARTITIONER_ALGORITHM == 'FENNEL':
-                self.partition_algorithm = fennel.FennelPartitioner(FRIEND_OF_FRIEND_ENABLED=self.FENNEL_FRIEND_OF_A_FRIEND_ENABLED)
+                self.partition_algorithm = fennel.FennelPartitioner(FRIEND_OF_FRIEND_ENABLED=self.FENNEL_FRIEND_OF_A_FRIEND_ENABLED,
+                                                                   CSR_ENABLED=self.FENNEL_CSR_ENABLED,
+                                                                   THREADS=self.FENNEL_THREADS,
+                                                                   SYNC_INTERVAL=self.FENNEL_SYNC_INTERVAL,
+                                                                   BATCHED_VOTES_ENABLED=self.FENNEL_BATCHED_VOTES_ENABLED,
+                                                                   VOTE_BLOCK_SIZE=self.FENNEL_VOTE_BLOCK_SIZE,
+                                                                   CONVERGENCE_THRESHOLD=self.FENNEL_CONVERGENCE_THRESHOLD,
+                                                                   CUT_CONVERGENCE_THRESHOLD=self.FENNEL_CUT_CONVERGENCE_THRESHOLD,
+                                                                   ACTIVE_SET_ENABLED=self.FENNEL_ACTIVE_SET_ENABLED,
+                                                                   GAMMA=self.FENNEL_GAMMA,
+                                                                   BUFFER_SIZE=self.FENNEL_BUFFER_SIZE)
                 if self.verbose > 0:
                     print("FENNEL partitioner loaded for making shelter assignments.")
 
@@ -119,6 +244,22 @@ class GraphPartitioning:
                 # compute the node leverage centrality scores for the whole graph
                 self.fennel_centrality_reordered_nodes = utils.leverage_centrality(self.G)
 
+        if self.PREDICTION_MODEL_ALGORITHM == 'LDG' or self.PARTITIONER_ALGORITHM == 'LDG':
+
+            import pyximport
+            pyximport.install()
+            from graph_partitioning import ldg
+
+            if self.PREDICTION_MODEL_ALGORITHM == 'LDG':
+                self.prediction_model_algorithm = ldg.LdgPartitioner()
+                if self.verbose > 0:
+                    print("LDG partitioner loaded for generating PREDICTION MODEL.")
+
+            if self.PARTITIONER_ALGORITHM == 'LDG':
+                self.partition_algorithm = ldg.LdgPartitioner()
+                if self.verbose > 0:
+                    print("LDG partitioner loaded for making shelter assignments.")
+
         if self.PREDICTION_MODEL_ALGORITHM == 'SCOTCH':
 
             #sys.path.insert(0, self.SCOTCH_PYLIB_REL_PATH)
@@ -174,9 +315,9 @@ class GraphPartitioning:
 
 
         if self.prediction_model_algorithm == None:
-            raise NoPartitionerException("Prediction model partitioner not specified or incorrect. Available partitioners are 'FENNEL' or 'SCOTCH'.")
+            raise NoPartitionerException("Prediction model partitioner not specified or incorrect. Available partitioners are 'FENNEL', 'LDG', 'SCOTCH' or 'PATOH'.")
         if self.partition_algorithm == None:
-            raise NoPartitionerException("Assignment partitioner not specified or incorrect. Available partitioners is 'FENNEL'.")
+            raise NoPartitionerException("Assignment partitioner not specified or incorrect. Available partitioners are 'FENNEL' or 'LDG'.")
 
     def reset(self):
 
@@ -184,8 +325,14 @@ class GraphPartitioning:
         self.assignments_prediction_model = np.repeat(np.int32(self.UNMAPPED), self.G.number_of_nodes())
         self.fixed = np.repeat(np.int32(self.UNMAPPED), self.G.number_of_nodes())
         self.nodes_arrived = []
+        # grown as nodes arrive when the graph is an ArrayGraph
+        self.arrived_subgraph = None
+        # PartitionMetrics of the arrived subgraph when INCREMENTAL_METRICS_ENABLED
+        self.metrics = None
         self.virtual_nodes = []
         self.virtual_edges = []
+        # FENNEL passes actually run for the prediction model and each batch
+        self.fennel_passes_run = []
 
 
     def prediction_model(self):
@@ -197,19 +344,25 @@ class GraphPartitioning:
             self.apply_graph_prediction_weights()
 
         if self.PREDICTION_MODEL:
-            with open(self.PREDICTION_MODEL, "r") as inf:
-                self.assignments = np.fromiter(inf.readlines(), dtype=np.int32)
-                self.assignments_prediction_model = np.array(self.assignments, copy=True)
+            # binary prediction models are memory mapped and checked against the graph
+            self.assignments = utils.read_assignments(self.PREDICTION_MODEL, self.DATA_FILENAME)
+            self.assignments_prediction_model = np.array(self.assignments, copy=True)
         else:
             if self.graph_modification_functions:
                 self.G = self._edge_expansion(self.G)
             self.assignments = self.prediction_model_algorithm.generate_prediction_model(self.G, self.num_iterations, self.num_partitions, self.assignments, self.fixed)
             self.assignments_prediction_model = np.array(self.assignments, copy=True)
 
+            if self.PREDICTION_MODEL_ALGORITHM == 'FENNEL':
+                self.fennel_passes_run.append(self.prediction_model_algorithm.passes_run)
+
         if self.verbose > 0:
             print("PREDICTION MODEL")
             print("----------------\n")
 
+            if self.fennel_passes_run:
+                print("FENNEL passes run: {} of {}\n".format(self.fennel_passes_run[-1], self.num_iterations))
+
         run_metrics = [self._print_score()]
         self._print_assignments()
 
@@ -231,6 +384,18 @@ class GraphPartitioning:
 
         return run_metrics
 
+    def write_prediction_model(self, filepath, text=False):
+        """
+        Saves the prediction model assignments for the PREDICTION_MODEL
+        setting, in the binary format of utils.write_assignments_binary()
+        or as text with one partition per line.
+        """
+        if text:
+            utils.savePredictionFile(filepath, self.assignments_prediction_model)
+        else:
+            utils.write_assignments_binary(filepath, self.assignments_prediction_model,
+                                           self.num_partitions, self.DATA_FILENAME)
+
     def init_virtual_nodes(self):
         print("Creating virtual nodes and assigning edges based on prediction model")
 
@@ -267,22 +432,35 @@ class GraphPartitioning:
         if graph == None:
             graph = self.G
 
-        # waste, cut_ratio
-        x = utils.score(graph, self.assignments, self.num_partitions)
+        # the metrics of the arrived subgraph are kept up to date as nodes are assigned
+        metrics = self.metrics if graph is not self.G else None
 
-        edges_cut, steps, cut_edges = utils.base_metrics(graph, self.assignments)
+        # waste, cut_ratio
+        if metrics is not None:
+            x = metrics.score()
+            edges_cut, steps = metrics.edges_cut, metrics.steps
+        else:
+            x = utils.score(graph, self.assignments, self.num_partitions)
+            edges_cut, steps, cut_edges = utils.base_metrics(graph, self.assignments)
 
         #q_qds_conductance = utils.louvainModularityComQuality(graph, self.assignments, self.num_partitions)
         # non-overlapping metrics
         q_qds_conductance = utils.infomapModularityComQuality(graph, self.assignments, self.num_partitions)
 
-        loneliness = utils.loneliness_score_wavg(graph, self.loneliness_score_param, self.assignments, self.num_partitions)
+        if metrics is not None:
+            loneliness = metrics.loneliness_score()
+        else:
+            loneliness = utils.loneliness_score_wavg(graph, self.loneliness_score_param, self.assignments, self.num_partitions)
         #print('loneliness', loneliness)
         #max_perm = utils.run_max_perm(graph)
-        max_perm = utils.wavg_max_perm(graph, self.assignments, self.num_partitions)
+        max_perm = utils.wavg_max_perm(graph, self.assignments, self.num_partitions, self.MAX_PERM_SAMPLE,
+                                       self.MAX_PERM_SEED)
 
-        rbse_list = utils.ratherBeSomewhereElseList(graph, self.assignments, self.num_partitions)
-        rbse = utils.ratherBeSomewhereElseMetric(rbse_list)
+        if metrics is not None:
+            rbse = metrics.rbse_score()
+        else:
+            rbse_list = utils.ratherBeSomewhereElseList(graph, self.assignments, self.num_partitions)
+            rbse = utils.ratherBeSomewhereElseMetric(rbse_list)
 
         #nmi_score = nmi_metrics.nmi(np.array([self.assignments_prediction_model, self.assignments]))
         nmi_assignments = self.assignments.tolist()
@@ -337,6 +515,8 @@ class GraphPartitioning:
                 print("Assign first {} arrivals using prediction model, then discard\n".format(cut_off_value))
 
         # fix arrivals
+        nodes_fixed = np.count_nonzero(self.fixed == 1)
+        arrived = []
         for a in self.arrival_order:
             # check if node needs a shelter
             if self.simulated_arrival_list[a] == 0:
@@ -346,18 +526,23 @@ class GraphPartitioning:
             if self.graph_modification_functions and self.alter_arrived_node_weight_to_100:
                 self.G.node[a]['weight'] = 100
 
-            nodes_fixed = len([o for o in self.fixed if o == 1])
             if nodes_fixed >= cut_off_value:
                 break
+            nodes_fixed += self.fixed[a] != 1
             self.fixed[a] = 1
-            self.nodes_arrived.append(a)
+            arrived.append(a)
 
         # remove nodes not fixed, ie. discard prediction model
         for i in range(0, len(self.assignments)):
             if self.fixed[i] == -1:
                 self.assignments[i] = -1
 
-        GSub = self.G.subgraph(self.nodes_arrived)
+        GSub = self._arrived_subgraph(arrived)
+        self.nodes_arrived += arrived
+
+        if self.INCREMENTAL_METRICS_ENABLED and self.compute_metrics_enabled and not self.G.is_directed():
+            self.metrics = PartitionMetrics(self.G, self.num_partitions, self.loneliness_score_param, len(self.assignments))
+            self.metrics.add(self.nodes_arrived, self.assignments)
 
         run_metrics = [self._print_score(GSub)]
         self._print_assignments()
@@ -375,17 +560,22 @@ class GraphPartitioning:
         if(self.edge_expansion_enabled == False):
             return G
 
+        if isinstance(G, ArrayGraph):
+            return self._edge_expansion_arrays(G)
+
+        # weight changes of the edges between arrived nodes, for self.metrics
+        reweighted = []
+
         # Update edge weights for nodes that have an assigned probability of displacement
         for edge in self.G.edges_iter(data=True):
             left = edge[0]
             right = edge[1]
+            old_weight = edge[2].get('weight', 1.0)
 
+            # virtual nodes have no original weight
             edge_weight = 1.0
-            try:
-                edge_weight = edge[2]['weight_orig']
-            except Exception as err:
-                # this may due to the fact that virtual nodes have no original weight
-                pass
+            if self.base_edge_weights is not None:
+                edge_weight = self.base_edge_weights.get((left, right), 1.0)
 
             w1 = float(G.node[left]['weight'])
             w2 = float(G.node[right]['weight'])
@@ -421,6 +611,63 @@ class GraphPartitioning:
                 # change the emphasis of the prediction model
                 edge[2]['weight'] = edge[2]['weight'] * self.prediction_model_emphasis
 
+            if self.metrics is not None and edge[2]['weight'] != old_weight:
+                reweighted.append((left, right, old_weight, edge[2]['weight']))
+
+        if reweighted:
+            self.metrics.reweight_edges(*zip(*reweighted))
+
+        return G
+
+    def _edge_expansion_arrays(self, G):
+        """
+        _edge_expansion() for an ArrayGraph, on all edges at once
+        """
+        edges, left, right = G.edge_ids()
+
+        # virtual edges have no original weight
+        edge_weight = np.ones(len(edges))
+        if self.base_edge_weights is not None:
+            original = edges < len(self.base_edge_weights)
+            edge_weight[original] = self.base_edge_weights[edges[original]]
+            edge_weight[np.isnan(edge_weight)] = 1.0
+
+        node_weights = G.node_array('weight')
+        w1 = node_weights[left]
+        w2 = node_weights[right]
+
+        # edge expansion
+        if self.EDGE_EXPANSION_MODE == 'minimum':
+            weights = np.minimum(w1, w2)
+        elif self.EDGE_EXPANSION_MODE == 'maximum':
+            weights = np.maximum(w1, w2)
+        elif self.EDGE_EXPANSION_MODE == 'product':
+            weights = w1 * w2
+        elif self.EDGE_EXPANSION_MODE == 'product_squared':
+            weights = (w1 * w2) ** 2
+        elif self.EDGE_EXPANSION_MODE == 'sqrt_product':
+            weights = (w1 * w2) ** 0.5
+        elif self.EDGE_EXPANSION_MODE == 'average':
+            weights = (w1 + w2) * 0.5
+        elif self.EDGE_EXPANSION_MODE == 'total':
+            weights = w1 + w2
+        else:
+            # new edge weight
+            weights = (w1 * edge_weight) * (w2 * edge_weight)
+
+        # change the emphasis of the prediction model
+        arrived = np.zeros(len(node_weights), dtype=bool)
+        arrived[self.nodes_arrived] = True
+        emphasis = arrived[left] | arrived[right]
+        weights[emphasis] = weights[emphasis] * self.prediction_model_emphasis
+
+        if self.metrics is not None:
+            old_weights = G.edge_array('weight')[edges]
+            old_weights[np.isnan(old_weights)] = 1.0
+            changed = old_weights != weights
+            self.metrics.reweight_edges(left[changed], right[changed], old_weights[changed], weights[changed])
+
+        G.edge_array('weight')[edges] = weights
         return G
 
 
@@ -484,6 +731,23 @@ class GraphPartitioning:
         return run_metrics
 
 
+    def _arrived_subgraph(self, batch):
+        """
+        The subgraph induced by self.nodes_arrived and batch, the nodes that
+        are arriving and are not in self.nodes_arrived yet.
+        """
+        if not isinstance(self.G, ArrayGraph):
+            return self.G.subgraph(self.nodes_arrived + batch)
+        if self.arrived_subgraph is None or self.arrived_subgraph.graph is not self.G:
+            self.arrived_subgraph = ArrivedSubgraph(self.G)
+            self.arrived_subgraph.add(self.nodes_arrived)
+        self.arrived_subgraph.add(batch)
+        if self.sliding_window:
+            # nodes stay in the batch over several calls, and its order can
+            # change between them
+            return self.arrived_subgraph.subgraph(np.concatenate((self.nodes_arrived, batch)).astype(np.int64))
+        return self.arrived_subgraph.subgraph()
+
     def process_batch(self, batch_arrived, assign_all=False):
         # re-order batch_arrived using a FENNEL re-ordering algorithm, if required and configured to do so
         # TODO add configuration for this
@@ -492,7 +756,7 @@ class GraphPartitioning:
                 reordered_batch = utils.reorder_nodes_based_on_leverage_centrality(self.fennel_centrality_reordered_nodes, batch_arrived)
                 #print('batch reordering', batch_arrived, reordered_batch)
                 batch_arrived = reordered_batch
-            else:
+            elif self.FENNEL_BUFFER_SIZE == 0:
                 batch_arrived = batch_arrived[::-1]
 
         # GRAPH MODIFICATION FUNCTIONS
@@ -511,16 +775,28 @@ class GraphPartitioning:
                                                 len(total_arrived),
                                                 k)
 
-                for node in self.G.nodes_iter():
-                    if self.alter_arrived_node_weight_to_100 and node in total_arrived:
-                        pass # weight would have been set previously
-                    else:
-                        self.G.node[node]['weight'] = int(gam_weights[node] * 100)
+                if isinstance(self.G, ArrayGraph):
+                    nodes = self.G.nodes_array()
+                    if self.alter_arrived_node_weight_to_100:
+                        nodes = nodes[~np.isin(nodes, total_arrived)]
+                    self.G.node_array('weight')[nodes] = (np.asarray(gam_weights)[nodes] * 100).astype(int)
+                    if self.metrics is not None:
+                        self.metrics.reweight_nodes(total_arrived, self.G.node_array('weight')[total_arrived])
+                else:
+                    arrived = set(total_arrived)
+                    for node in self.G.nodes_iter():
+                        if self.alter_arrived_node_weight_to_100 and node in arrived:
+                            pass # weight would have been set previously
+                        else:
+                            self.G.node[node]['weight'] = int(gam_weights[node] * 100)
+                    if self.metrics is not None:
+                        self.metrics.reweight_nodes(total_arrived, [self.G.node[node]['weight'] for node in total_arrived])
 
             self.G = self._edge_expansion(self.G)
 
         # make a subgraph of all arrived nodes
-        Gsub = self.G.subgraph(self.nodes_arrived + batch_arrived)
+        Gsub = self._arrived_subgraph(batch_arrived)
+        batch_nodes = list(batch_arrived)
 
         # recalculate alpha
         if Gsub.is_directed():
@@ -530,8 +806,8 @@ class GraphPartitioning:
             edges_arrived = Gsub.number_of_edges()
 
         if self.PARTITIONER_ALGORITHM == 'FENNEL':
-            nodes_fixed = len([o for o in self.fixed if o == 1])
-            alpha = (edges_arrived) * (self.num_partitions / (nodes_fixed + len(batch_arrived))**2)
+            nodes_fixed = np.count_nonzero(self.fixed == 1)
+            alpha = self.fennel_alpha(edges_arrived, nodes_fixed + len(batch_arrived))
 
             if self.use_one_shot_alpha:
                 alpha = self.one_shot_alpha
@@ -555,6 +831,11 @@ class GraphPartitioning:
                                                                 self.assignments,
                                                                 self.fixed)
 
+        if self.PARTITIONER_ALGORITHM == 'FENNEL':
+            self.fennel_passes_run.append(self.partition_algorithm.passes_run)
+            if self.verbose > 1:
+                print("FENNEL passes run: {} of {}".format(self.fennel_passes_run[-1], self.num_iterations))
+
         if self.sliding_window and not assign_all:
             # assign first node
             n = batch_arrived.pop(0)
@@ -576,6 +857,10 @@ class GraphPartitioning:
                 if self.fixed[i] != 1:
                     self.assignments[i] = -1
 
+        if self.metrics is not None:
+            self.metrics.update(self.assignments)
+            self.metrics.add(batch_nodes, self.assignments)
+
         return [self._print_score(Gsub)]
 
 
@@ -606,19 +891,15 @@ class GraphPartitioning:
                 print("Nodes: {}".format(self.G.number_of_nodes()))
                 print("Edges: {}".format(self.G.number_of_edges()))
 
+        # the graph files are written with networkx
+        if isinstance(self.G, ArrayGraph):
+            self.G = self.G.to_networkx()
+
 
         # Add partition attribute to nodes
         for i in range(0, len(self.assignments)):
             self.G.add_nodes_from([i], partition=str(self.assignments[i]))
 
-        # Remove original node/edge weights
-        for node in self.G.nodes_iter(data=True):
-            if 'weight_orig' in node[1]:
-                del node[1]['weight_orig']
-        for edge in self.G.edges_iter(data=True):
-            if 'weight_orig' in edge[2]:
-                del edge[2]['weight_orig']
-
         # Freeze Graph from further modification
         self.G = nx.freeze(self.G)
 
@@ -677,7 +958,9 @@ class GraphPartitioning:
         file_oslom = utils.write_graph_files(self.OUTPUT_DIRECTORY,
                                              "{}-all".format(self.metrics_filename),
                                              self.G,
-                                             quiet=True)
+                                             quiet=True,
+                                             graph_format=self.GRAPH_FILE_FORMAT,
+                                             write_assignments=self.ASSIGNMENTS_FILE_ENABLED)
 
         # original scoring algorithm
         scoring = utils.score(self.G, self.assignments, self.num_partitions)
@@ -694,7 +977,7 @@ class GraphPartitioning:
         })
 
         # MaxPerm
-        max_perm = utils.run_max_perm(self.G)
+        max_perm = utils.run_max_perm(self.G, sample=self.MAX_PERM_SAMPLE, seed=self.MAX_PERM_SEED)
         graph_metrics.update({"network_permanence": max_perm})
 
         # Community Quality metrics
@@ -771,10 +1054,13 @@ class GraphPartitioning:
             file_oslom = utils.write_graph_files(self.OUTPUT_DIRECTORY,
                                                  "{}-p{}".format(self.metrics_filename, p),
                                                  Gsub,
-                                                 quiet=True)
+                                                 quiet=True,
+                                                 graph_format=self.GRAPH_FILE_FORMAT,
+                                                 write_assignments=self.ASSIGNMENTS_FILE_ENABLED)
 
             # MaxPerm
-            max_perm = utils.run_max_perm(Gsub, relabel_nodes=True)
+            max_perm = utils.run_max_perm(Gsub, relabel_nodes=True, sample=self.MAX_PERM_SAMPLE,
+                                          seed=self.MAX_PERM_SEED)
             partition_nonoverlapping_metrics.update({"network_permanence": max_perm})
 
             # Modularity
@@ -807,6 +1093,14 @@ class GraphPartitioning:
             utils.write_metrics_csv(csv_file, partition_nonoverlapping_fieldnames, partition_nonoverlapping_metrics)
 
     def apply_graph_prediction_weights(self):
+        if isinstance(self.G, ArrayGraph):
+            weights = np.array(self.predicted_displacement_weights, dtype=np.float64)
+            weights[weights == 0] = 1.0
+            nodes = self.G.nodes_array()
+            nodes = nodes[nodes < len(weights)]
+            self.G.node_array('weight')[nodes] = weights[nodes]
+            return
+
         for i, weight in enumerate(self.predicted_displacement_weights):
             try:
                 if(weight == 0):
@@ -816,6 +1110,10 @@ class GraphPartitioning:
                 pass
 
     def remove_graph_prediction_weights(self):
+        if isinstance(self.G, ArrayGraph):
+            self.G.node_array('weight')[self.G.nodes_array()] = 1.0
+            return
+
         for node in self.G.nodes():
             try:
                 self.G.node[node]['weight'] = 1.0
@@ -0,0 +1,254 @@
+import os
+import shutil
+
+import numpy as np
+
+import graph_partitioning.utils as gputils
+
+class GraphStore():
+    """
+    Undirected graph whose CSR arrays live in memory-mapped .npy files in a
+    directory, so only the pages that are touched are loaded.
+
+    The arrays are the (indptr, indices, edge_weights, node_weights) tuple of
+    utils.graph_to_csr(), which returns them as they are for a GraphStore.
+    The FENNEL and LDG partitioners and utils.bincount_assigned() read the
+    graph through them without building a networkx graph. Node ids run from
+    0 to number_of_nodes() - 1 and nodes are streamed in id order, unlike the
+    graph of utils.read_metis() which streams them in order of first mention.
+
+    The store also holds the id of the edge of every entry and the order the
+    nodes were added in, so array_graph.ArrayGraph.from_store() can build a
+    graph over the same memory maps.
+    """
+
+    ARRAYS = ('indptr', 'indices', 'edge_weights', 'node_weights')
+    GRAPH_ARRAYS = ('entry_edges', 'node_order')
+
+    # entries held in memory at a time when numbering the edges
+    BLOCK_SIZE = 1 << 22
+
+    def __init__(self, directory):
+        self.directory = directory
+        # copy-on-write because typed memoryviews in the kernels need writable
+        # buffers, nothing writes to them so the pages stay shared with the file
+        self.indptr, self.indices, self.edge_weights, self.node_weights, self.entry_edges, self.node_order = (
+            np.load(os.path.join(directory, name + ".npy"), mmap_mode='c') for name in self.ARRAYS + self.GRAPH_ARRAYS)
+        meta = np.load(os.path.join(directory, "meta.npy"))
+        self._num_edges = int(meta[0])
+        self._num_edge_ids = int(meta[1])
+
+    @classmethod
+    def from_csr(cls, csr, directory, num_edges=None, nodes=None):
+        """
+        Writes the CSR arrays to directory. num_edges defaults to the number
+        of entries over 2, which is right when there are no self loops. nodes
+        is the order the nodes were added in, defaults to id order.
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = lambda name: os.path.join(directory, name + ".npy")
+        for name, array in zip(cls.ARRAYS, csr):
+            np.save(path(name), array)
+        if nodes is None:
+            nodes = np.arange(len(csr[0]) - 1)
+        np.save(path("node_order"), np.asarray(nodes, dtype=np.int64))
+        num_edge_ids = cls._number_edges(directory)
+        if num_edges is None:
+            num_edges = len(csr[1]) // 2
+        np.save(path("meta"), np.array([num_edges, num_edge_ids], dtype=np.int64))
+        return cls(directory)
+
+    @classmethod
+    def from_graph(cls, graph, directory):
+        return cls.from_csr(gputils.graph_to_csr(graph), directory, graph.number_of_edges(), graph.nodes())
+
+    @classmethod
+    def from_metis(cls, DATA_FILENAME, directory, chunk_size=gputils.METIS_CHUNK_SIZE):
+        """
+        Converts a METIS graph file, plain or compressed, without holding its
+        edges in memory. The file is read twice: once to count the neighbors
+        of every node, then to copy them into the memory-mapped arrays. Each
+        row keeps the neighbors in the order the file lists them, so the file
+        must list every edge from both ends as METIS requires.
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = lambda name: os.path.join(directory, name + ".npy")
+
+        chunks = gputils.iter_metis(DATA_FILENAME, chunk_size)
+        m_nodes, m_edges, has_edge_weights, has_node_weights = next(chunks)
+        degrees = []
+        node_weights = []
+        node_order = []
+        mentioned = np.zeros(m_nodes, dtype=bool)
+        for first_line, lines, rows, neighbors, edge_weights, weights in chunks:
+            degrees.append(np.bincount(rows - first_line, minlength=lines))
+            node_weights.append(weights)
+            # nodes in the order utils.read_metis() adds them
+            order = gputils._metis_node_order(lines, rows, neighbors, first_line)
+            order = order[~mentioned[order]]
+            mentioned[order] = True
+            node_order.append(order)
+        degrees = np.concatenate(degrees) if degrees else np.zeros(0, dtype=np.int64)
+        node_weights = np.concatenate(node_weights) if node_weights else np.zeros(0, dtype=np.int64)
+        assert (m_nodes == len(degrees)), "Expected {} nodes, file contains {} nodes".format(m_nodes, len(degrees))
+        np.save(path("node_order"), np.concatenate(node_order) if node_order else np.zeros(0, dtype=np.int64))
+
+        # the partitioning kernels use int32 offsets
+        assert degrees.sum() <= np.iinfo(np.int32).max, "Too many edges for int32 offsets"
+        indptr = np.lib.format.open_memmap(path("indptr"), mode='w+', dtype=np.int32, shape=(m_nodes + 1,))
+        indptr[0] = 0
+        np.cumsum(degrees, out=indptr[1:])
+        np.save(path("node_weights"), node_weights.astype(np.float64))
+
+        num_entries = int(indptr[-1])
+        indices = np.lib.format.open_memmap(path("indices"), mode='w+', dtype=np.int32, shape=(num_entries,))
+        weights = np.lib.format.open_memmap(path("edge_weights"), mode='w+', dtype=np.float64, shape=(num_entries,))
+        chunks = gputils.iter_metis(DATA_FILENAME, chunk_size)
+        next(chunks)
+        for first_line, lines, rows, neighbors, edge_weights, node_weight in chunks:
+            start = indptr[first_line]
+            indices[start:start + len(neighbors)] = neighbors
+            weights[start:start + len(neighbors)] = edge_weights
+        for array in (indptr, indices, weights):
+            array.flush()
+        del indptr, indices, weights
+
+        num_edge_ids = cls._number_edges(directory)
+        np.save(path("meta"), np.array([m_edges, num_edge_ids], dtype=np.int64))
+        return cls(directory)
+
+    @classmethod
+    def _number_edges(cls, directory):
+        """
+        Writes the edge id of every entry of the CSR arrays in directory to
+        entry_edges.npy and returns the number of edges. Edges are numbered
+        in the order of their entries (u, v) with u <= v, and the entry
+        (v, u) gets the id of (u, v), found by binary search in a copy of row
+        u sorted by neighbor. Rows are taken BLOCK_SIZE entries at a time in
+        a single pass, row u always comes before row v, so only a block of
+        the arrays is held in memory.
+        """
+        path = lambda name: os.path.join(directory, name + ".npy")
+        indptr = np.load(path("indptr"), mmap_mode='r')
+        indices = np.load(path("indices"), mmap_mode='r')
+        num_nodes = len(indptr) - 1
+        num_entries = len(indices)
+        entry_edges = np.lib.format.open_memmap(path("entry_edges"), mode='w+', dtype=np.int32, shape=(num_entries,))
+        # every row sorted by neighbor, with the edge id of the entries (u, v)
+        # with u <= v and -1 for the others
+        sorted_indices = np.lib.format.open_memmap(path("sorted_indices"), mode='w+', dtype=np.int32,
+                                                   shape=(num_entries,))
+        sorted_edges = np.lib.format.open_memmap(path("sorted_edges"), mode='w+', dtype=np.int32, shape=(num_entries,))
+
+        num_edges = 0
+        first = 0
+        while first < num_nodes:
+            last = max(first + 1, int(np.searchsorted(indptr, indptr[first] + cls.BLOCK_SIZE, side='right')) - 1)
+            last = min(last, num_nodes)
+            start = int(indptr[first])
+            stop = int(indptr[last])
+            rows = np.repeat(np.arange(first, last, dtype=np.int64), np.diff(indptr[first:last + 1]))
+            neighbors = indices[start:stop].astype(np.int64)
+
+            # the entries that number the edges
+            upper = neighbors >= rows
+            edges = np.full(len(rows), -1, dtype=np.int64)
+            edges[upper] = num_edges + np.arange(np.count_nonzero(upper))
+            num_edges += np.count_nonzero(upper)
+            entry_edges[start + np.flatnonzero(upper)] = edges[upper]
+
+            sorter = np.lexsort((neighbors, rows))
+            sorted_indices[start:stop] = neighbors[sorter]
+            sorted_edges[start:stop] = edges[sorter]
+
+            # the other entries, their edges are numbered in an earlier row
+            lower = np.flatnonzero(~upper)
+            target = rows[lower]
+            row = neighbors[lower]
+            low = indptr[row].astype(np.int64)
+            high = indptr[row + 1].astype(np.int64)
+            end = high.copy()
+            searching = low < high
+            while searching.any():
+                middle = (low + high) // 2
+                smaller = searching & (sorted_indices[np.where(searching, middle, 0)] < target)
+                low = np.where(smaller, middle + 1, low)
+                high = np.where(searching & ~smaller, middle, high)
+                searching = low < high
+            found = (low < end)
+            found[found] = sorted_indices[low[found]] == target[found]
+            assert found.all(), "Every edge must be listed from both ends"
+            entry_edges[start + lower] = sorted_edges[low]
+            first = last
+
+        entry_edges.flush()
+        del sorted_indices, sorted_edges
+        os.remove(path("sorted_indices"))
+        os.remove(path("sorted_edges"))
+        return num_edges
+
+    @classmethod
+    def open_metis(cls, DATA_FILENAME, cache_dir):
+        """
+        Opens the store of DATA_FILENAME in its entry of the METIS cache in
+        cache_dir, converting the file the first time. See
+        utils.metis_cache_entry() for how entries are named and removed.
+        """
+        directory = os.path.join(gputils.metis_cache_entry(DATA_FILENAME, cache_dir), "store")
+        if os.path.isfile(os.path.join(directory, "meta.npy")) and all(
+                os.path.isfile(os.path.join(directory, name + ".npy")) for name in cls.GRAPH_ARRAYS):
+            return cls(directory)
+        # meta.npy is written last, anything else is left over from a failed conversion
+        shutil.rmtree(directory, ignore_errors=True)
+        return cls.from_metis(DATA_FILENAME, directory)
+
+    def csr(self, num_nodes=None, nodes=None):
+        """
+        The CSR arrays, padded with empty rows up to num_nodes. The memory
+        maps are returned as they are unless padding is needed, so the rows
+        of every node are filled even when nodes is given.
+        """
+        indptr = self.indptr
+        node_weights = self.node_weights
+        if num_nodes is not None and num_nodes > self.number_of_nodes():
+            pad = num_nodes - self.number_of_nodes()
+            indptr = np.concatenate((indptr, np.repeat(indptr[-1:], pad)))
+            node_weights = np.concatenate((node_weights, np.zeros(pad)))
+        return (indptr, self.indices, self.edge_weights, node_weights)
+
+    def number_of_nodes(self):
+        return len(self.indptr) - 1
+
+    def number_of_edges(self):
+        return self._num_edges
+
+    def number_of_edge_ids(self):
+        """
+        Length of the edge ids in entry_edges, which counts each edge listed
+        more than once in a row as several edges.
+        """
+        return self._num_edge_ids
+
+    def __len__(self):
+        return self.number_of_nodes()
+
+    def __contains__(self, node):
+        return 0 <= node < self.number_of_nodes()
+
+    def nodes_iter(self):
+        return iter(range(self.number_of_nodes()))
+
+    def nodes(self):
+        return list(self.nodes_iter())
+
+    def is_directed(self):
+        return False
+
+    def neighbors(self, node):
+        return self.indices[self.indptr[node]:self.indptr[node + 1]].tolist()
+
+    def degree(self, node):
+        return int(self.indptr[node + 1] - self.indptr[node])
+
+    def node_weight(self, node):
+        return float(self.node_weights[node])
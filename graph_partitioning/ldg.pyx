@@ -0,0 +1,143 @@
+import numpy as np
+cimport cython
+from utils import graph_to_csr
+
+cdef int UNMAPPED = -1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int ldg_stream(int[::] order,
+                    int[::] indptr,
+                    int[::] indices,
+                    double[::] edge_weights,
+                    double[::] node_weights,
+                    int num_partitions,
+                    int[::] partition,
+                    int[::] fixed,
+                    double partition_capacity,
+                    double[::] partition_sizes,
+                    float[::] partition_votes) nogil:
+    '''
+    One LDG pass over the nodes in order, skipping fixed nodes.
+    partition_sizes is kept up to date as nodes are placed.
+    '''
+    cdef int i = 0
+    cdef int j = 0
+    cdef int arg = 0
+    cdef int node = 0
+    cdef int right_node = 0
+    cdef int max_arg = 0
+    cdef float max_val = 0
+    cdef float val = 0
+    cdef double weight = 0.0
+
+    for i in range(order.shape[0]):
+        node = order[i]
+        if fixed[node] != UNMAPPED:
+            continue
+
+        for arg in range(num_partitions):
+            partition_votes[arg] = 0.0
+        for j in range(indptr[node], indptr[node + 1]):
+            right_node = indices[j]
+            if partition[right_node] != UNMAPPED:
+                partition_votes[partition[right_node]] += edge_weights[j]
+
+        # take the node out of its partition from a previous pass before deciding
+        weight = node_weights[node]
+        if partition[node] != UNMAPPED:
+            partition_sizes[partition[node]] -= weight
+
+        # votes x remaining capacity after adding the node
+        max_arg = 0
+        max_val = 0
+        for arg in range(num_partitions):
+            val = partition_votes[arg] * (partition_capacity - partition_sizes[arg] - weight)
+            if arg == 0 or val > max_val:
+                max_arg = arg
+                max_val = val
+
+        if max_val <= 0:
+            # No neighbors (or multiple maxed out) so "randomly" select the
+            # next partition with room, or the smallest if all are full
+            max_arg = UNMAPPED
+            for j in range(num_partitions):
+                arg = (i + j) % num_partitions
+                if partition_sizes[arg] + weight < partition_capacity:
+                    max_arg = arg
+                    break
+            if max_arg == UNMAPPED:
+                max_arg = 0
+                for arg in range(1, num_partitions):
+                    if partition_sizes[arg] < partition_sizes[max_arg]:
+                        max_arg = arg
+
+        partition_sizes[max_arg] += weight
+        partition[node] = max_arg
+
+    return 0
+
+
+def linear_deterministic_greedy(tuple csr,
+                                int[::] order,
+                                int num_partitions,
+                                int[::] partition,
+                                int[::] fixed,
+                                double[::] partition_sizes,
+                                double partition_capacity):
+    """
+    This algorithm favors a cluster if it has many neighbors of a node, but
+    penalizes the cluster if it is close to capacity.
+
+    csr: (indptr, indices, edge_weights, node_weights) as returned by utils.graph_to_csr().
+    order: Nodes in the order they are streamed.
+    num_partitions: How many partitions we are breaking the graph into.
+    partition: The partition from a previous run, updated in place. Used for restreaming.
+    fixed: To denote which nodes in the partition have been locked in place.
+    partition_sizes: Total node weight in each partition, updated in place.
+    partition_capacity: Target total node weight of a partition.
+
+    Returns: The partition.
+    """
+    cdef int[::] indptr = csr[0]
+    cdef int[::] indices = csr[1]
+    cdef double[::] edge_weights = csr[2]
+    cdef double[::] node_weights = csr[3]
+    cdef float[::] partition_votes = np.zeros(num_partitions, dtype=np.float32)
+
+    with nogil:
+        ldg_stream(order, indptr, indices, edge_weights, node_weights, num_partitions,
+                   partition, fixed, partition_capacity, partition_sizes, partition_votes)
+
+    return np.asarray(partition)
+
+
+class LdgPartitioner():
+
+    def generate_prediction_model(self,
+                                  object graph,
+                                  int num_iterations,
+                                  int num_partitions,
+                                  int [::] assignments,
+                                  int [::] fixed):
+        '''
+        Streams the nodes of graph num_iterations times with LDG. The graph is
+        converted to CSR arrays and the partition sizes are counted once per
+        call, then kept up to date by the kernel. Capacity is the total node
+        weight of graph over num_partitions.
+        '''
+        csr = graph_to_csr(graph, len(assignments))
+        node_weights = csr[3]
+
+        order = np.fromiter(graph.nodes_iter(), dtype=np.int32)
+        assigned = np.flatnonzero(np.asarray(assignments) != UNMAPPED)
+        partition_sizes = np.bincount(np.asarray(assignments)[assigned], weights=node_weights[assigned],
+                                      minlength=num_partitions).astype(np.float64)
+        partition_capacity = node_weights.sum() / num_partitions
+
+        for i in range(num_iterations):
+            linear_deterministic_greedy(csr, order, num_partitions, assignments, fixed,
+                                        partition_sizes, partition_capacity)
+
+        return np.asarray(assignments)
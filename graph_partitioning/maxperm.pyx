@@ -0,0 +1,230 @@
+import numpy as np
+cimport cython
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef double vertex_permanence(int v,
+                              int[::] indptr,
+                              int[::] indices,
+                              int[::] label,
+                              int[::] counts,
+                              int[::] touched,
+                              signed char[::] internal) nogil:
+    '''
+    Permanence of v in its community:
+    I(v) / (E_max(v) x D(v)) - (1 - C_in(v)), where I(v) is the number of
+    neighbors in the community, E_max(v) the largest number of neighbors in
+    one other community (1 if there are none), D(v) the degree and C_in(v)
+    the clustering coefficient of the neighbors in the community. Self loops
+    are ignored and isolated vertices have a permanence of 0.
+    '''
+    cdef int i = 0
+    cdef int j = 0
+    cdef int u = 0
+    cdef int c = 0
+    cdef int degree = 0
+    cdef int inside = 0
+    cdef int num_touched = 0
+    cdef int e_max = 0
+    cdef long links = 0
+    cdef double clustering = 0.0
+
+    for i in range(indptr[v], indptr[v + 1]):
+        u = indices[i]
+        if u == v:
+            continue
+        degree += 1
+        if label[u] == label[v]:
+            inside += 1
+            internal[u] = 1
+        else:
+            c = label[u]
+            if counts[c] == 0:
+                touched[num_touched] = c
+                num_touched += 1
+            counts[c] += 1
+
+    for i in range(num_touched):
+        if counts[touched[i]] > e_max:
+            e_max = counts[touched[i]]
+        counts[touched[i]] = 0
+    if e_max == 0:
+        e_max = 1
+
+    if inside > 1:
+        # every link between two internal neighbors is seen from both ends
+        for i in range(indptr[v], indptr[v + 1]):
+            u = indices[i]
+            if internal[u]:
+                for j in range(indptr[u], indptr[u + 1]):
+                    if indices[j] != u and internal[indices[j]]:
+                        links += 1
+        clustering = <double>links / (<double>inside * (inside - 1))
+
+    for i in range(indptr[v], indptr[v + 1]):
+        internal[indices[i]] = 0
+
+    if degree == 0:
+        return 0.0
+    return <double>inside / (<double>e_max * degree) - (1.0 - clustering)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double local_permanence(int v,
+                             int[::] indptr,
+                             int[::] indices,
+                             int[::] label,
+                             int[::] counts,
+                             int[::] touched,
+                             signed char[::] internal) nogil:
+    '''
+    Permanence of v and its neighbors, the vertices a move of v changes
+    '''
+    cdef int i = 0
+    cdef double total = vertex_permanence(v, indptr, indices, label, counts, touched, internal)
+
+    for i in range(indptr[v], indptr[v + 1]):
+        if indices[i] != v:
+            total += vertex_permanence(indices[i], indptr, indices, label, counts, touched, internal)
+    return total
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int move_vertex(int v,
+                     int[::] indptr,
+                     int[::] indices,
+                     int[::] label,
+                     int[::] counts,
+                     int[::] touched,
+                     signed char[::] internal,
+                     signed char[::] tried) nogil:
+    '''
+    Moves v to the community of a neighbor if that increases the permanence
+    of v and its neighbors. Returns 1 if v moved.
+    '''
+    cdef int i = 0
+    cdef int c = 0
+    cdef int own = label[v]
+    cdef int best_label = own
+    cdef double best = 0.0
+    cdef double value = 0.0
+
+    if vertex_permanence(v, indptr, indices, label, counts, touched, internal) >= 1.0:
+        # already in a clique with no external neighbors
+        return 0
+
+    best = local_permanence(v, indptr, indices, label, counts, touched, internal)
+    tried[own] = 1
+    for i in range(indptr[v], indptr[v + 1]):
+        c = label[indices[i]]
+        if tried[c]:
+            continue
+        tried[c] = 1
+        label[v] = c
+        value = local_permanence(v, indptr, indices, label, counts, touched, internal)
+        if value > best:
+            best = value
+            best_label = c
+        label[v] = own
+
+    for i in range(indptr[v], indptr[v + 1]):
+        tried[label[indices[i]]] = 0
+    tried[own] = 0
+
+    label[v] = best_label
+    return best_label != own
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def permanence(indptr, indices, label, nodes=None):
+    '''
+    Mean permanence of nodes, defaults to every vertex, for undirected CSR
+    arrays with vertices 0 to n - 1 and the community label of every vertex
+    in 0 to n - 1.
+    '''
+    cdef int[::] c_indptr = np.ascontiguousarray(indptr, dtype=np.int32)
+    cdef int[::] c_indices = np.ascontiguousarray(indices, dtype=np.int32)
+    cdef int[::] c_label = np.ascontiguousarray(label, dtype=np.int32)
+    cdef int num_nodes = len(indptr) - 1
+    cdef int[::] counts = np.zeros(num_nodes, dtype=np.int32)
+    cdef int[::] touched = np.zeros(num_nodes, dtype=np.int32)
+    cdef signed char[::] internal = np.zeros(num_nodes, dtype=np.int8)
+    cdef int[::] c_nodes = np.ascontiguousarray(np.arange(num_nodes) if nodes is None else nodes, dtype=np.int32)
+    cdef int i = 0
+    cdef double total = 0.0
+
+    if len(c_nodes) == 0:
+        return 0.0
+    with nogil:
+        for i in range(len(c_nodes)):
+            total += vertex_permanence(c_nodes[i], c_indptr, c_indices, c_label, counts, touched, internal)
+    return total / len(c_nodes)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def max_perm(indptr, indices, int max_iterations, sample=None, seed=None):
+    '''
+    Finds communities by maximising permanence as in MaxPerm (Chakraborty et
+    al., "On the permanence of vertices in network communities", KDD 2014).
+    Every vertex starts in its own community, then each sweep moves vertices
+    to the community of a neighbor when that increases the permanence of the
+    vertex and its neighbors. Sweeps stop when the mean permanence no longer
+    increases, undoing the last sweep, or after max_iterations.
+
+    sample: If set and smaller than the number of vertices, each sweep only
+            visits that many vertices chosen at random and the mean
+            permanence is measured on a random sample of that size, which
+            bounds the work per sweep on huge graphs. Sweeps are kept when
+            they raise the permanence of that sample, so the permanence
+            returned is measured on a fresh sample instead.
+    seed: Seed of the random samples.
+
+    Returns: (network permanence, community label of every vertex)
+    '''
+    cdef int[::] c_indptr = np.ascontiguousarray(indptr, dtype=np.int32)
+    cdef int[::] c_indices = np.ascontiguousarray(indices, dtype=np.int32)
+    cdef int num_nodes = len(indptr) - 1
+    cdef int[::] label = np.arange(num_nodes, dtype=np.int32)
+    cdef int[::] counts = np.zeros(num_nodes, dtype=np.int32)
+    cdef int[::] touched = np.zeros(num_nodes, dtype=np.int32)
+    cdef signed char[::] internal = np.zeros(num_nodes, dtype=np.int8)
+    cdef signed char[::] tried = np.zeros(num_nodes, dtype=np.int8)
+    cdef int[::] order
+    cdef int[::] previous
+    cdef int i = 0
+    cdef int iteration = 0
+
+    if num_nodes == 0:
+        return (0.0, np.asarray(label))
+
+    sampled = sample is not None and sample < num_nodes
+    rng = np.random.RandomState(seed)
+    order = np.arange(num_nodes, dtype=np.int32)
+    measured = None
+    if sampled:
+        measured = rng.choice(num_nodes, sample, replace=False)
+    best = permanence(c_indptr, c_indices, label, measured)
+
+    for iteration in range(max_iterations):
+        if sampled:
+            order = rng.choice(num_nodes, sample, replace=False).astype(np.int32)
+        previous = np.array(label)
+        with nogil:
+            for i in range(len(order)):
+                move_vertex(order[i], c_indptr, c_indices, label, counts, touched, internal, tried)
+        value = permanence(c_indptr, c_indices, label, measured)
+        if value <= best:
+            # keep the communities of the best sweep
+            label[:] = previous
+            break
+        best = value
+
+    if sampled:
+        best = permanence(c_indptr, c_indices, label, rng.choice(num_nodes, sample, replace=False))
+    return (best, np.asarray(label))
@@ -0,0 +1,236 @@
+import numpy as np
+
+class PartitionMetrics():
+    """
+    The metrics of an assignment that only depend on the partitions of each
+    node's neighbors: waste, cut ratio, edges cut, communication steps, RBSE
+    and loneliness. They are computed for the subgraph induced by the member
+    nodes and kept up to date as nodes join the subgraph, move to another
+    partition or change weight. Each change costs time proportional to the
+    degree of the node, instead of the size of the subgraph.
+
+    Every node stores how many of its member neighbors are in each partition
+    and the total weight of the edges to them. Column 0 is for unassigned
+    neighbors and column p + 1 for partition p. Member nodes must not be
+    removed from the graph. Weight changes to member nodes, or to edges
+    between members, must be passed to reweight_nodes() and reweight_edges().
+    Undirected graphs only.
+    """
+
+    # relative difference below which partition edge weights count as equal
+    RBSE_TOLERANCE = 1e-9
+
+    def __init__(self, graph, num_partitions, loneliness_score_param, num_nodes=0):
+        self.graph = graph
+        self.num_partitions = num_partitions
+        self.loneliness_score_param = loneliness_score_param
+
+        self.member = np.zeros(0, dtype=bool)
+        self.assignments = np.zeros(0, dtype=np.int32)
+        self.node_weights = np.zeros(0, dtype=np.float64)
+        self.counts = np.zeros((0, num_partitions + 1), dtype=np.int64)
+        self.weights = np.zeros((0, num_partitions + 1), dtype=np.float64)
+        # what every node adds to the totals below
+        self.node_steps = np.zeros(0, dtype=np.int64)
+        self.node_loneliness = np.zeros(0, dtype=np.float64)
+        self.node_rbse = np.zeros(0, dtype=bool)
+        self._grow(num_nodes)
+
+        self.num_nodes = 0
+        self.num_edges = 0
+        self.edges_cut = 0
+        self.steps = 0
+        self.rbse = 0
+        self.loneliness = 0.0
+        self.partition_nodes = np.zeros(num_partitions + 1, dtype=np.int64)
+        self.partition_weights = np.zeros(num_partitions + 1, dtype=np.float64)
+
+    def _grow(self, num_nodes):
+        pad = num_nodes - len(self.member)
+        if pad <= 0:
+            return
+        self.member = np.concatenate((self.member, np.zeros(pad, dtype=bool)))
+        self.assignments = np.concatenate((self.assignments, np.full(pad, -1, dtype=np.int32)))
+        self.node_weights = np.concatenate((self.node_weights, np.zeros(pad)))
+        self.counts = np.concatenate((self.counts, np.zeros((pad, self.num_partitions + 1), dtype=np.int64)))
+        self.weights = np.concatenate((self.weights, np.zeros((pad, self.num_partitions + 1))))
+        self.node_steps = np.concatenate((self.node_steps, np.zeros(pad, dtype=np.int64)))
+        self.node_loneliness = np.concatenate((self.node_loneliness, np.zeros(pad)))
+        self.node_rbse = np.concatenate((self.node_rbse, np.zeros(pad, dtype=bool)))
+
+    def _neighbors(self, node):
+        """
+        The member neighbors of node and the weights of the edges to them,
+        node itself included when it has a self loop and is a member
+        """
+        for neighbor, data in self.graph.adj[node].items():
+            if self.member[neighbor]:
+                yield neighbor, data.get('weight', 1.0)
+
+    def _refresh(self, nodes):
+        """
+        Recomputes what nodes add to the steps, RBSE and loneliness totals
+        from their rows
+        """
+        nodes = np.unique(np.asarray(nodes, dtype=np.int64))
+        nodes = nodes[self.member[nodes]]
+        rows = np.arange(len(nodes))
+        own = self.assignments[nodes] + 1
+        counts = self.counts[nodes]
+        weights = self.weights[nodes]
+        assigned = own > 0
+
+        # a node communicates once with every other partition its neighbors are in
+        steps = (counts > 0).sum(axis=1) - (counts[rows, own] > 0)
+
+        internal = counts[rows, own]
+        loneliness = np.where(assigned, 1 - (1 / (internal + 1) ** self.loneliness_score_param), 0.0)
+
+        # rather be somewhere else: another partition holds more edge weight.
+        # The sums are updated by adding and subtracting weights, so sums that
+        # only differ by rounding count as equal. There is always at least one
+        # partition column, so the maximum of every row is defined
+        other = weights[:, 1:].copy()
+        other[rows[assigned], own[assigned] - 1] = -np.inf
+        current = weights[rows, own]
+        rbse = assigned & (other.max(axis=1) > current + self.RBSE_TOLERANCE * np.maximum(np.abs(current), 1.0))
+
+        self.steps += int(steps.sum() - self.node_steps[nodes].sum())
+        self.loneliness += loneliness.sum() - self.node_loneliness[nodes].sum()
+        self.rbse += int(np.count_nonzero(rbse) - np.count_nonzero(self.node_rbse[nodes]))
+        self.node_steps[nodes] = steps
+        self.node_loneliness[nodes] = loneliness
+        self.node_rbse[nodes] = rbse
+
+    def add(self, nodes, assignments):
+        """
+        Adds nodes to the subgraph with their partitions in assignments.
+        Nodes that are already members are skipped.
+        """
+        self._grow(len(assignments))
+        for node in nodes:
+            if self.member[node]:
+                continue
+            own = int(assignments[node]) + 1
+            weight = self.graph.node[node].get('weight', 1)
+            self.member[node] = True
+            self.assignments[node] = own - 1
+            self.node_weights[node] = weight
+            self.num_nodes += 1
+            self.partition_nodes[own] += 1
+            self.partition_weights[own] += weight
+
+            touched = [node]
+            for neighbor, weight in self._neighbors(node):
+                other = self.assignments[neighbor] + 1
+                self.counts[node, other] += 1
+                self.weights[node, other] += weight
+                self.num_edges += 1
+                if neighbor != node:
+                    self.counts[neighbor, own] += 1
+                    self.weights[neighbor, own] += weight
+                    self.edges_cut += int(other != own)
+                    touched.append(neighbor)
+            self._refresh(touched)
+
+    def assign(self, nodes, assignments):
+        """
+        Moves member nodes to their partitions in assignments.
+        """
+        for node in nodes:
+            if not self.member[node]:
+                continue
+            old = self.assignments[node] + 1
+            new = int(assignments[node]) + 1
+            if old == new:
+                continue
+            self.assignments[node] = new - 1
+            self.partition_nodes[old] -= 1
+            self.partition_nodes[new] += 1
+            self.partition_weights[old] -= self.node_weights[node]
+            self.partition_weights[new] += self.node_weights[node]
+
+            touched = [node]
+            for neighbor, weight in self._neighbors(node):
+                self.counts[neighbor, old] -= 1
+                self.counts[neighbor, new] += 1
+                self.weights[neighbor, old] -= weight
+                self.weights[neighbor, new] += weight
+                if neighbor != node:
+                    other = self.assignments[neighbor] + 1
+                    self.edges_cut += int(other == old) - int(other == new)
+                    touched.append(neighbor)
+            self._refresh(touched)
+
+    def update(self, assignments):
+        """
+        Moves the member nodes whose partition differs in assignments, such
+        as the assignments returned by a partitioner.
+        """
+        self._grow(len(assignments))
+        assignments = np.asarray(assignments)
+        moved = np.flatnonzero(self.member[:len(assignments)] & (self.assignments[:len(assignments)] != assignments))
+        self.assign(moved.tolist(), assignments)
+
+    def reweight_nodes(self, nodes, weights):
+        """
+        Sets the weights of nodes, non-members are skipped.
+        """
+        for node, weight in zip(nodes, weights):
+            if node < len(self.member) and self.member[node]:
+                own = self.assignments[node] + 1
+                self.partition_weights[own] += weight - self.node_weights[node]
+                self.node_weights[node] = weight
+
+    def reweight_edges(self, left, right, old_weights, weights):
+        """
+        Changes the weights of the edges (left[i], right[i]) from
+        old_weights[i] to weights[i]. Each edge is listed once and edges
+        with a non-member end are skipped.
+        """
+        left = np.asarray(left, dtype=np.int64)
+        right = np.asarray(right, dtype=np.int64)
+        delta = np.asarray(weights, dtype=np.float64) - np.asarray(old_weights, dtype=np.float64)
+        inside = (left < len(self.member)) & (right < len(self.member))
+        inside[inside] = self.member[left[inside]] & self.member[right[inside]]
+        changed = inside & (delta != 0)
+        left = left[changed]
+        right = right[changed]
+        delta = delta[changed]
+
+        np.add.at(self.weights, (left, self.assignments[right] + 1), delta)
+        # a self loop is a single entry in its row
+        pair = left != right
+        np.add.at(self.weights, (right[pair], self.assignments[left[pair]] + 1), delta[pair])
+        self._refresh(np.concatenate((left, right)))
+
+    def score(self):
+        """
+        (waste, cut ratio, edges cut) as returned by utils.score()
+        """
+        balance = self.partition_weights[1:]
+        if self.num_nodes > 0:
+            balance = balance / self.num_nodes
+        waste = (np.max(balance) - balance).sum()
+        cut_ratio = self.edges_cut / self.num_edges if self.num_edges > 0 else 0.0
+        return (waste, cut_ratio, self.edges_cut)
+
+    def rbse_score(self):
+        """
+        Fraction of the assigned nodes that would rather be somewhere else,
+        as utils.ratherBeSomewhereElseMetric()
+        """
+        assigned = self.num_nodes - self.partition_nodes[0]
+        if assigned == 0:
+            return 0.0
+        return float(self.rbse) / float(assigned)
+
+    def loneliness_score(self):
+        """
+        utils.loneliness_score_wavg(): the loneliness of every assigned node
+        in the subgraph of its partition, averaged over the assigned nodes
+        """
+        assigned = self.num_nodes - self.partition_nodes[0]
+        if assigned == 0:
+            return 0.0
+        return self.loneliness / assigned
@@ -1,11 +1,14 @@
+import io
 import os
 import csv
 import gzip
+import hashlib
 import shutil
 import tempfile
 import random
 import platform
 import itertools
+import multiprocessing
 import operator
 import subprocess
 import community
@@ -16,85 +19,388 @@ from graph_partitioning.tools.infomap import infomap #TODO how would this work o
 
 BIN_DIRECTORY = os.path.join(os.path.dirname(__file__), "..", "bin")
 
-def read_metis(DATA_FILENAME):
+# bump when the parsed arrays change, so old cache entries are not used
+METIS_CACHE_VERSION = 1
+_METIS_ARRAYS = ('meta', 'rows', 'neighbors', 'edge_weights', 'node_weights')
+_CSR_ARRAYS = ('indptr', 'indices', 'csr_edge_weights', 'csr_node_weights')
+
+# bytes of decompressed text parsed at a time
+METIS_CHUNK_SIZE = 1 << 24
+
+def open_compressed(filename):
+    """
+    Opens filename for reading bytes, decompressing gzip, bz2 and xz files on
+    the fly. The format is detected from the first bytes of the file.
+    """
+    with open(filename, "rb") as f:
+        magic = f.read(6)
+    if magic[:2] == b'\x1f\x8b':
+        return gzip.open(filename, "rb")
+    if magic[:3] == b'BZh':
+        import bz2
+        return bz2.open(filename, "rb")
+    if magic == b'\xfd7zXZ\x00':
+        import lzma
+        return lzma.open(filename, "rb")
+    return open(filename, "rb")
+
+
+def _parse_metis_chunk(body, has_edge_weights, has_node_weights):
+    """
+    Tokenizes complete node lines of a METIS file with NumPy.
+
+    Returns: (lines, rows, neighbors, edge_weights, node_weights) with rows
+    counted from the first line of body.
+    """
+    if b'%' in body:
+        # ignore comments
+        body = b'\n'.join(line for line in body.split(b'\n') if not line.startswith(b'%'))
+
+    # line of every token, from the positions where a token starts
+    chars = np.frombuffer(body, dtype=np.uint8)
+    space = (chars == ord(' ')) | (chars == ord('\t')) | (chars == ord('\r')) | (chars == ord('\n'))
+    starts = np.flatnonzero(~space & np.concatenate(([True], space[:-1])))
+    newlines = np.flatnonzero(chars == ord('\n'))
+    lines = len(newlines)
+    if len(body) > 0 and body[-1:] != b'\n':
+        lines += 1
+    token_line = np.searchsorted(newlines, starts)
+
+    tokens = np.fromstring(body, dtype=np.int64, sep=' ') if len(starts) else np.zeros(0, dtype=np.int64)
+    assert len(tokens) == len(starts), "Could not parse METIS file"
+
+    # position of every token within its line
+    per_line = np.bincount(token_line, minlength=lines)
+    within = np.arange(len(tokens)) - (np.cumsum(per_line) - per_line)[token_line]
+
+    node_weights = np.ones(lines, dtype=np.int64)
+    if has_node_weights:
+        first = within == 0
+        node_weights[token_line[first]] = tokens[first]
+        within = within - 1
+        tokens = tokens[~first]
+        token_line = token_line[~first]
+        within = within[~first]
+
+    if has_edge_weights:
+        assert np.all(np.bincount(token_line, minlength=lines) % 2 == 0), "Edge without a weight"
+        neighbors = tokens[within % 2 == 0] - 1
+        edge_weights = tokens[within % 2 == 1]
+        rows = token_line[within % 2 == 0]
+    else:
+        neighbors = tokens - 1
+        edge_weights = np.ones(len(tokens), dtype=np.int64)
+        rows = token_line
+
+    return (lines, rows, neighbors, edge_weights, node_weights)
 
-    G = nx.Graph()
 
-    # add node weights from METIS file
-    with open(DATA_FILENAME, "r") as metis:
+def iter_metis(DATA_FILENAME, chunk_size=METIS_CHUNK_SIZE):
+    """
+    Reads a METIS graph file, plain or compressed, chunk_size bytes at a
+    time so the text is never held in memory as a whole.
+
+    Yields (m_nodes, m_edges, has_edge_weights, has_node_weights) from the
+    first line, then (first_line, lines, rows, neighbors, edge_weights,
+    node_weights) for every chunk: the chunk covers node lines first_line to
+    first_line + lines - 1, rows/neighbors/edge_weights hold one entry per
+    neighbor listed in file order and node_weights one entry per line. Node
+    ids start from 0.
+    """
+    with open_compressed(DATA_FILENAME) as metis:
+
+        # read meta data from first line
+        first_line = metis.readline()
+        while first_line[:1] == b'%':
+            # ignore comments
+            first_line = metis.readline()
+        first_line = first_line.split()
 
-        n = 0
-        first_line = None
+        m_nodes = int(first_line[0])
+        m_edges = int(first_line[1])
         has_edge_weights = False
         has_node_weights = False
-        for i, line in enumerate(metis):
-            if line[0] == '%':
-                # ignore comments
-                continue
+        if len(first_line) > 2:
+            # FMT has the following meanings:
+            #  0  the graph has no weights (in this case, you can omit FMT)
+            #  1  the graph has edge weights
+            # 10  the graph has node weights
+            # 11  the graph has both edge and node weights
+            file_format = int(first_line[2])
+            if file_format == 0:
+                pass
+            elif file_format == 1:
+                has_edge_weights = True
+            elif file_format == 10:
+                has_node_weights = True
+            elif file_format == 11:
+                has_edge_weights = True
+                has_node_weights = True
+            else:
+                assert False, "File format not supported"
 
-            if not first_line:
-                # read meta data from first line
-                first_line = line.split()
-                m_nodes = int(first_line[0])
-                m_edges = int(first_line[1])
-                if len(first_line) > 2:
-                    # FMT has the following meanings:
-                    #  0  the graph has no weights (in this case, you can omit FMT)
-                    #  1  the graph has edge weights
-                    # 10  the graph has node weights
-                    # 11  the graph has both edge and node weights
-                    file_format = first_line[2]
-                    if int(file_format) == 0:
-                        pass
-                    elif int(file_format) == 1:
-                        has_edge_weights = True
-                    elif int(file_format) == 10:
-                        has_node_weights = True
-                    elif int(file_format) == 11:
-                        has_edge_weights = True
-                        has_node_weights = True
-                    else:
-                        assert False, "File format not supported"
+        yield (m_nodes, m_edges, has_edge_weights, has_node_weights)
+
+        lines = 0
+        for body in _iter_line_chunks(metis, chunk_size):
+            chunk_lines, rows, neighbors, edge_weights, node_weights = _parse_metis_chunk(
+                body, has_edge_weights, has_node_weights)
+            yield (lines, chunk_lines, rows + lines, neighbors, edge_weights, node_weights)
+            lines += chunk_lines
+
+
+def _iter_line_chunks(f, chunk_size):
+    """
+    Reads f chunk_size bytes at a time, yielding only complete lines. The
+    last line does not need to end with a newline.
+    """
+    remainder = b''
+    while True:
+        chunk = f.read(chunk_size)
+        body = remainder + chunk
+        if chunk:
+            # only yield complete lines, keep the rest for the next chunk
+            end = body.rfind(b'\n') + 1
+            body, remainder = body[:end], body[end:]
+            if not body:
                 continue
+        elif not body:
+            break
+        else:
+            remainder = b''
+        yield body
 
-            # METIS starts node count from 1, here we start from 0 by
-            # subtracting 1 in the edge list and incrementing 'n' after
-            # processing the line.
-            if line.strip():
-                e = line.split()
-                if has_edge_weights and has_node_weights:
-                    if len(e) > 2:
-                        # create weighted edge list:
-                        #  [(1, 2, {'weight':'2'}), (1, 3, {'weight':'8'})]
-                        edges_split = list(zip(*[iter(e[1:])] * 2))
-                        edge_list = [(n, int(v[0]) - 1, {'weight': int(v[1])}) for v in edges_split]
-
-                        G.add_edges_from(edge_list)
-                        G.node[n]['weight'] = int(e[0])
-                    else:
-                        # no edges
-                        G.add_nodes_from([n], weight=int(e[0]))
 
-                elif has_edge_weights and not has_node_weights:
-                    if len(e) > 0:
-                        edges_split = list(zip(*[iter(e)] * 2))
-                        edge_list = [(n, int(v[0]) - 1, {'weight': int(v[1])}) for v in edges_split]
+def _parse_metis(DATA_FILENAME, chunk_size=METIS_CHUNK_SIZE):
+    """
+    Reads a whole METIS graph file with iter_metis().
 
-                        G.add_edges_from(edge_list)
-                        G.node[n]['weight'] = 1.0
-                    else:
-                        G.add_nodes_from([n], weight=1.0)
-
-                elif not has_edge_weights and has_node_weights:
-                    pass
-                else:
-                    edge_list = [(n, int(v) - 1, {'weight':1.0}) for v in e]
-                    G.add_edges_from(edge_list)
-                    G.node[n]['weight'] = 1.0
-            else:
-                # blank line indicates no node weight
-                G.add_nodes_from([n], weight=1.0)
-            n += 1
+    Returns: (m_nodes, m_edges, has_edge_weights, has_node_weights, lines,
+    rows, neighbors, edge_weights, node_weights) where lines is the number of
+    node lines, rows/neighbors/edge_weights hold one entry per neighbor listed
+    in the file in file order, with node ids starting from 0, and
+    node_weights holds one entry per node line.
+    """
+    chunks = iter_metis(DATA_FILENAME, chunk_size)
+    m_nodes, m_edges, has_edge_weights, has_node_weights = next(chunks)
+
+    lines = 0
+    parsed = []
+    for first_line, chunk_lines, rows, neighbors, edge_weights, node_weights in chunks:
+        parsed.append((rows, neighbors, edge_weights, node_weights))
+        lines += chunk_lines
+
+    if parsed:
+        rows, neighbors, edge_weights, node_weights = (np.concatenate(a) for a in zip(*parsed))
+    else:
+        rows, neighbors, edge_weights, node_weights = (np.zeros(0, dtype=np.int64) for i in range(4))
+
+    return (m_nodes, m_edges, has_edge_weights, has_node_weights, lines,
+            rows, neighbors, edge_weights, node_weights)
+
+
+def metis_cache_entry(DATA_FILENAME, cache_dir):
+    """
+    Directory in cache_dir holding the parsed arrays of DATA_FILENAME. The
+    name is the SHA-1 of the file contents, so editing the file gives a new
+    entry and stale entries are never read.
+    """
+    return os.path.join(cache_dir, "metis-v{}-{}".format(METIS_CACHE_VERSION, file_hash(DATA_FILENAME).hex()))
+
+
+def file_hash(filename):
+    """
+    SHA-1 digest of the contents of filename, as bytes
+    """
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def clear_metis_cache(cache_dir, DATA_FILENAME=None):
+    """
+    Removes the cache entry of DATA_FILENAME, or every entry in cache_dir.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    if DATA_FILENAME is not None:
+        entries = [metis_cache_entry(DATA_FILENAME, cache_dir)]
+    else:
+        entries = [os.path.join(cache_dir, e) for e in os.listdir(cache_dir) if e.startswith("metis-")]
+    for entry in entries:
+        shutil.rmtree(entry, ignore_errors=True)
+
+
+def _load_cached(entry, names):
+    # memory maps the arrays, None if any is missing or unreadable
+    try:
+        return tuple(np.load(os.path.join(entry, name + ".npy"), mmap_mode='r') for name in names)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _store_cached(entry, arrays):
+    os.makedirs(entry, exist_ok=True)
+    for name, array in arrays.items():
+        # write then rename, so readers never see a partial file
+        fd, tmp = tempfile.mkstemp(suffix=".npy", dir=entry)
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, np.asarray(array))
+        os.replace(tmp, os.path.join(entry, name + ".npy"))
+
+
+def _load_metis(DATA_FILENAME, entry=None):
+    """
+    _parse_metis() through the cache entry, if given
+    """
+    if entry is not None:
+        cached = _load_cached(entry, _METIS_ARRAYS)
+        if cached is not None:
+            meta = cached[0]
+            return (int(meta[0]), int(meta[1]), bool(meta[2]), bool(meta[3]), int(meta[4])) + cached[1:]
+
+    parsed = _parse_metis(DATA_FILENAME)
+    if entry is not None:
+        meta = np.array(parsed[:5], dtype=np.int64)
+        _store_cached(entry, dict(zip(_METIS_ARRAYS, (meta,) + parsed[5:])))
+    return parsed
+
+
+def _metis_csr(m_nodes, m_edges, has_edge_weights, has_node_weights, lines,
+               rows, neighbors, edge_weights, node_weights):
+    """
+    Builds the CSR arrays of read_metis_csr() from the output of _parse_metis()
+    """
+    num_nodes = max(lines, int(neighbors.max()) + 1 if len(neighbors) else 0)
+    indptr, indices, weights, num_edges = _undirected_csr(num_nodes, rows, neighbors, edge_weights)
+
+    # sanity check
+    assert (m_nodes == num_nodes), "Expected {} nodes, file contains {} nodes".format(m_nodes, num_nodes)
+    assert (m_edges == num_edges), "Expected {} edges, file contains {} edges".format(m_edges, num_edges)
+
+    # nodes only seen as neighbors have no weight, which counts as 1
+    csr_node_weights = np.ones(num_nodes, dtype=np.float64)
+    csr_node_weights[:lines] = node_weights
+
+    return (indptr, indices, weights, csr_node_weights)
+
+
+def _undirected_csr(num_nodes, rows, neighbors, edge_weights):
+    """
+    CSR arrays of the undirected graph with an edge for every (rows[i],
+    neighbors[i]) entry. An edge listed more than once keeps its last weight.
+
+    Returns: (indptr, indices, edge_weights, num_edges)
+    """
+    # group the entries of each undirected edge, in file order
+    key = np.minimum(rows, neighbors) * num_nodes + np.maximum(rows, neighbors)
+    by_edge = np.argsort(key, kind='stable')
+    sorted_key = key[by_edge]
+    group_start = np.flatnonzero(np.concatenate(([True], sorted_key[1:] != sorted_key[:-1])))[:len(key)]
+    group_end = np.concatenate((group_start[1:], [len(key)]))[:len(group_start)].astype(np.int64)
+    edges = sorted_key[group_start]
+    first_seen = by_edge[group_start]
+    weight = edge_weights[by_edge[group_end - 1]]
+
+    # both directions of every edge, self loops once, each row in the
+    # order its edges first appear in the file
+    low = edges // num_nodes
+    high = edges % num_nodes
+    loop = low == high
+    source = np.concatenate((low, high[~loop]))
+    target = np.concatenate((high, low[~loop]))
+    position = np.concatenate((first_seen, first_seen[~loop]))
+    weight = np.concatenate((weight, weight[~loop]))
+    order = np.argsort(source * len(key) + position, kind='stable')
+
+    indptr = np.zeros(num_nodes + 1, dtype=np.int32)
+    np.cumsum(np.bincount(source, minlength=num_nodes), out=indptr[1:])
+
+    return (indptr, target[order].astype(np.int32), weight[order].astype(np.float64), len(edges))
+
+
+def _metis_node_order(lines, rows, neighbors, first_line=0):
+    """
+    Node ids in the order they are first mentioned in a parsed METIS file,
+    or in the chunk of lines starting at first_line. Every node line mentions
+    the node itself followed by its neighbors.
+    """
+    line_nodes = first_line + np.arange(lines)
+    per_line = np.bincount(rows - first_line, minlength=lines)
+    appearance = np.empty(lines + len(neighbors), dtype=np.int64)
+    own = np.arange(lines) + np.concatenate(([0], np.cumsum(per_line)[:-1]))
+    appearance[own] = line_nodes
+    appearance[np.setdiff1d(np.arange(len(appearance)), own, assume_unique=True)] = neighbors
+    unique, first = np.unique(appearance, return_index=True)
+    return unique[np.argsort(first, kind='stable')]
+
+
+def read_metis_csr(DATA_FILENAME, cache_dir=None, node_order=False):
+    """
+    Reads a METIS graph file (FMT 0, 1, 10 or 11) straight into CSR arrays,
+    without building a networkx graph. The arrays are the same as
+    graph_to_csr(read_metis(DATA_FILENAME)): edges are made undirected, an
+    edge listed more than once keeps its last weight and neighbors are in the
+    order networkx would add them.
+
+    cache_dir: If given, the arrays are stored there the first time the file
+               is read and memory mapped from then on, see metis_cache_entry().
+    node_order: Also return the node ids in the order read_metis() adds them,
+                which is the order the partitioners stream them in.
+
+    Returns: (indptr, indices, edge_weights, node_weights), or a tuple of
+    those arrays and the node order when node_order is set.
+    """
+    entry = None
+    csr = None
+    if cache_dir is not None:
+        entry = metis_cache_entry(DATA_FILENAME, cache_dir)
+        csr = _load_cached(entry, _CSR_ARRAYS)
+
+    if csr is None or node_order:
+        parsed = _load_metis(DATA_FILENAME, entry)
+    if csr is None:
+        csr = _metis_csr(*parsed)
+        if entry is not None:
+            _store_cached(entry, dict(zip(_CSR_ARRAYS, csr)))
+
+    if node_order:
+        return (csr, _metis_node_order(parsed[4], parsed[5], parsed[6]))
+    return csr
+
+
+def read_metis(DATA_FILENAME, cache_dir=None):
+    """
+    Reads a METIS graph file into a networkx graph. Node and edge weights are
+    ints when the file has them and 1.0 otherwise. Nodes are added in the
+    order they first appear in the file.
+
+    cache_dir: If given, the parsed file is stored there the first time it is
+               read and memory mapped from then on, see metis_cache_entry().
+    """
+    entry = None
+    if cache_dir is not None:
+        entry = metis_cache_entry(DATA_FILENAME, cache_dir)
+    (m_nodes, m_edges, has_edge_weights, has_node_weights, lines,
+     rows, neighbors, edge_weights, node_weights) = _load_metis(DATA_FILENAME, entry)
+
+    # METIS starts node count from 1, node ids here start from 0
+    node_order = _metis_node_order(lines, rows, neighbors)
+
+    if not has_node_weights:
+        node_weights = [1.0] * lines
+    else:
+        node_weights = node_weights.tolist()
+    if not has_edge_weights:
+        edge_weights = [1.0] * len(neighbors)
+    else:
+        edge_weights = edge_weights.tolist()
+
+    G = nx.Graph()
+    G.add_nodes_from((n, {'weight': node_weights[n]}) if n < lines else n for n in node_order.tolist())
+    G.add_edges_from((u, v, {'weight': w}) for u, v, w in zip(rows.tolist(), neighbors.tolist(), edge_weights))
 
     # sanity check
     assert (m_nodes == G.number_of_nodes()), "Expected {} nodes, networkx graph contains {} nodes".format(m_nodes, G.number_of_nodes())
@@ -103,7 +409,180 @@ def read_metis(DATA_FILENAME):
     return G
 
 
+def _parse_edge_chunk(body):
+    """
+    Tokenizes complete lines of an edge list, one "source target [weight]"
+    entry per line. Lines starting with # or % are comments.
+
+    Returns: (sources, targets, weights) as read, weights is None when the
+    lines have no weight column.
+    """
+    if b'#' in body or b'%' in body:
+        # ignore comments
+        body = b'\n'.join(line for line in body.split(b'\n') if not line.lstrip().startswith((b'#', b'%')))
+
+    lines = [line for line in body.split(b'\n', 2)[:2] if line.strip()]
+    columns = len(lines[0].split()) if lines else 2
+    assert columns in (2, 3), "Edge list lines need a source, a target and an optional weight"
+    # ids are read as ints unless there are weights, which may not be
+    values = np.fromstring(body, dtype=np.int64 if columns == 2 else np.float64, sep=' ')
+    assert len(values) % columns == 0, "Could not parse edge list, lines have different numbers of columns"
+
+    values = values.reshape(-1, columns)
+    weights = values[:, 2] if columns == 3 else None
+    return (values[:, 0].astype(np.int64), values[:, 1].astype(np.int64), weights)
+
+
+def _parse_edge_range(args):
+    # reads bytes start to end of a file and parses them, in a worker process
+    filename, start, end = args
+    with open(filename, "rb") as f:
+        f.seek(start)
+        return _parse_edge_chunk(f.read(end - start))
+
+
+def _line_ranges(filename, start, chunk_size):
+    """
+    Splits filename from byte start to its end into ranges of about
+    chunk_size bytes that end after a newline.
+    """
+    size = os.path.getsize(filename)
+    ranges = []
+    with open(filename, "rb") as f:
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((filename, start, end))
+            start = end
+    return ranges
+
+
+def _parse_edges(DATA_FILENAME, start=0, processes=None, chunk_size=METIS_CHUNK_SIZE):
+    """
+    Parses the edge list in DATA_FILENAME from byte start with
+    _parse_edge_chunk(). Plain files are split into byte ranges that are
+    parsed in a pool of processes, compressed files are read in order and
+    their chunks parsed in the pool.
+
+    Returns: (sources, targets, weights) in file order, weights is None when
+    the file has no weight column.
+    """
+    with open_compressed(DATA_FILENAME) as f:
+        compressed = not isinstance(f, io.BufferedReader)
+
+    if compressed:
+        def chunks():
+            with open_compressed(DATA_FILENAME) as f:
+                f.read(start)
+                for body in _iter_line_chunks(f, chunk_size):
+                    yield body
+        tasks = chunks()
+        parse = _parse_edge_chunk
+    else:
+        tasks = _line_ranges(DATA_FILENAME, start, chunk_size)
+        parse = _parse_edge_range
+
+    if processes == 1 or (not compressed and len(tasks) < 2):
+        parsed = [parse(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            # imap keeps the chunks in file order
+            parsed = list(pool.imap(parse, tasks))
+
+    parsed = [chunk for chunk in parsed if len(chunk[0])]
+    if not parsed:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), None)
+    assert len(set(chunk[2] is None for chunk in parsed)) == 1, "Some edges have a weight and some do not"
+    sources, targets = (np.concatenate(a) for a in list(zip(*parsed))[:2])
+    weights = None if parsed[0][2] is None else np.concatenate([chunk[2] for chunk in parsed])
+    return (sources, targets, weights)
+
+
+def _edges_csr(num_nodes, sources, targets, weights):
+    # undirected CSR arrays of parsed edges, every node has a weight of 1
+    if weights is None:
+        weights = np.ones(len(sources), dtype=np.float64)
+    indptr, indices, edge_weights, num_edges = _undirected_csr(num_nodes, sources, targets, weights)
+    return (indptr, indices, edge_weights, np.ones(num_nodes, dtype=np.float64))
+
+
+def read_edge_list_csr(DATA_FILENAME, relabel=True, node_ids=False, processes=None, chunk_size=METIS_CHUNK_SIZE):
+    """
+    Reads an edge list, such as the SNAP datasets, into the CSR arrays of
+    read_metis_csr(). Every line is "source target" or "source target weight"
+    separated by whitespace, lines starting with # or % are comments and the
+    file may be compressed. Edges are made undirected, an edge listed more
+    than once keeps its last weight, edges without a weight have a weight of
+    1.0 and so does every node.
+
+    relabel: Number the nodes 0 to n - 1 in order of their ids in the file.
+             Otherwise the ids are used as they are and ids that are not
+             mentioned are nodes without edges.
+    node_ids: Also return the id in the file of every node.
+    processes: Number of processes parsing the file, defaults to the number
+               of CPUs.
+    chunk_size: Bytes parsed by a process at a time.
+
+    Returns: (indptr, indices, edge_weights, node_weights), or a tuple of
+    those arrays and the file ids when node_ids is set.
+    """
+    sources, targets, weights = _parse_edges(DATA_FILENAME, 0, processes, chunk_size)
+
+    if relabel:
+        ids, labels = np.unique(np.concatenate((sources, targets)), return_inverse=True)
+        sources, targets = labels[:len(sources)], labels[len(sources):]
+    else:
+        assert len(sources) == 0 or min(sources.min(), targets.min()) >= 0, "Node ids must not be negative"
+        ids = np.arange(max(sources.max(), targets.max()) + 1 if len(sources) else 0)
+
+    csr = _edges_csr(len(ids), sources, targets, weights)
+    if node_ids:
+        return (csr, ids)
+    return csr
+
+
+def read_matrix_market_csr(DATA_FILENAME, processes=None, chunk_size=METIS_CHUNK_SIZE):
+    """
+    Reads a Matrix Market coordinate file into the CSR arrays of
+    read_metis_csr(). Row i and column j are nodes i - 1 and j - 1 of an
+    undirected graph, the entries are its edges and their values the edge
+    weights, 1.0 for pattern matrices. An edge listed more than once, as in
+    unsymmetric matrices, keeps its last weight. The file is parsed in a pool
+    of processes like read_edge_list_csr().
+    """
+    with open_compressed(DATA_FILENAME) as mtx:
+        banner = mtx.readline()
+        start = len(banner)
+        banner = banner.lower().split()
+        assert banner[:2] == [b'%%matrixmarket', b'matrix'], "Not a Matrix Market file"
+        assert banner[2] == b'coordinate', "Only coordinate Matrix Market files are supported"
+        assert banner[3] in (b'real', b'integer', b'pattern'), "Complex Matrix Market files are not supported"
+
+        size = mtx.readline()
+        start += len(size)
+        while size.startswith(b'%') or not size.strip():
+            # ignore comments
+            size = mtx.readline()
+            start += len(size)
+        m_rows, m_columns, m_entries = (int(x) for x in size.split())
+
+    sources, targets, weights = _parse_edges(DATA_FILENAME, start, processes, chunk_size)
+
+    # sanity check
+    assert (m_entries == len(sources)), "Expected {} entries, file contains {} entries".format(m_entries, len(sources))
+
+    return _edges_csr(max(m_rows, m_columns), sources - 1, targets - 1, weights)
+
+
 def bincount_assigned(graph, assignments, num_partitions):
+    if hasattr(graph, 'csr'):
+        # array backed graphs
+        node_weights = graph.csr(len(assignments))[3]
+        assignments = np.asarray(assignments)
+        assigned = np.flatnonzero(assignments >= 0)
+        return np.bincount(assignments[assigned], weights=node_weights[assigned], minlength=num_partitions).tolist()
+
     parts = [0] * num_partitions
     for n in graph.nodes_iter(data=True):
         node = n[0]
@@ -117,6 +596,118 @@ def bincount_assigned(graph, assignments, num_partitions):
     return parts
 
 
+def graph_to_csr(graph, num_nodes=None, nodes=None):
+    """
+    Converts a networkx graph into CSR arrays indexed by node id.
+
+    num_nodes: Number of rows, defaults to the largest node id + 1. Pass the
+               length of the assignments vector when graph is a subgraph.
+    nodes: Only fill in the neighbors of these nodes, the other rows are left
+           empty. Defaults to every node in graph.
+
+    Returns: (indptr, indices, edge_weights, node_weights). Nodes that are not
+    in graph have no neighbors and a node weight of 0. Neighbors are unique,
+    for directed graphs both successors and predecessors are included.
+
+    Graphs that already hold CSR arrays, such as GraphStore and ArrayGraph,
+    provide them through their csr() method and are not converted.
+    """
+    if hasattr(graph, 'csr'):
+        return graph.csr(num_nodes, nodes)
+
+    if num_nodes is None:
+        num_nodes = max(graph.nodes_iter(), default=-1) + 1
+
+    degree = np.zeros(num_nodes, dtype=np.int32)
+    node_weights = np.zeros(num_nodes, dtype=np.float64)
+    for node, data in graph.nodes_iter(data=True):
+        node_weights[node] = data.get('weight', 1)
+    if nodes is None:
+        nodes = graph.nodes_iter()
+
+    neighbors = {}
+    for node in nodes:
+        if graph.is_directed():
+            adj = dict(graph.pred[node])
+            adj.update(graph.succ[node])
+        else:
+            adj = graph.adj[node]
+        neighbors[node] = adj
+        degree[node] = len(adj)
+
+    indptr = np.zeros(num_nodes + 1, dtype=np.int32)
+    np.cumsum(degree, out=indptr[1:])
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    edge_weights = np.empty(indptr[-1], dtype=np.float64)
+    for node, adj in neighbors.items():
+        start = indptr[node]
+        indices[start:start + len(adj)] = list(adj.keys())
+        edge_weights[start:start + len(adj)] = [d.get('weight', 1.0) for d in adj.values()]
+
+    return (indptr, indices, edge_weights, node_weights)
+
+
+def edges_cut_csr(indptr, indices, assignments):
+    """
+    Number of edges between two assigned nodes in different partitions, for
+    undirected CSR arrays where each edge is stored in both directions.
+    """
+    assignments = np.asarray(assignments)
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    left = assignments[rows]
+    right = assignments[indices]
+    cut = (left >= 0) & (right >= 0) & (left != right)
+    return int(np.count_nonzero(cut)) // 2
+
+
+def csr_positions(indptr, nodes):
+    """
+    Returns the positions in indices of the neighbor lists of nodes,
+    concatenated in the order of nodes.
+    """
+    nodes = np.asarray(nodes)
+    starts = indptr[nodes]
+    lengths = indptr[nodes + 1] - starts
+    total = lengths.sum()
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    # position of every neighbor within its row
+    within = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + within
+
+
+def csr_neighbors(indptr, indices, nodes):
+    """
+    Returns the concatenated neighbor lists of nodes, with repeats.
+    """
+    return indices[csr_positions(indptr, nodes)]
+
+
+def csr_rows_changed(old, new):
+    """
+    Compares two sets of CSR arrays with the same number of rows, as returned
+    by graph_to_csr(). Returns a boolean array marking the nodes whose weight,
+    neighbors or edge weights differ.
+    """
+    old_indptr, old_indices, old_edge_weights, old_node_weights = old
+    new_indptr, new_indices, new_edge_weights, new_node_weights = new
+
+    old_degree = np.diff(old_indptr)
+    new_degree = np.diff(new_indptr)
+    changed = (old_degree != new_degree) | (old_node_weights != new_node_weights)
+
+    # compare rows of equal length element by element
+    rows = np.flatnonzero(~changed & (new_degree > 0))
+    lengths = new_degree[rows]
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    old_pos = np.repeat(old_indptr[rows], lengths) + within
+    new_pos = np.repeat(new_indptr[rows], lengths) + within
+    differs = (old_indices[old_pos] != new_indices[new_pos]) | (old_edge_weights[old_pos] != new_edge_weights[new_pos])
+    changed[np.repeat(rows, lengths)[differs]] = True
+
+    return changed
+
+
 rpy2_loaded = False
 base = None
 utils = None
@@ -175,9 +766,14 @@ def score(graph, assignment, num_partitions=None):
         balance = np.bincount(assignment) / len(assignment)
     waste = (np.max(balance) - balance).sum()
 
-    left_edge_assignment = assignment.take([x[0] for x in graph.edges()]) #edges[:,0])
-    right_edge_assignment = assignment.take([x[1] for x in graph.edges()]) #edges[:,1])
-    mismatch = (left_edge_assignment != right_edge_assignment).sum()
+    if graph.is_directed():
+        left_edge_assignment = assignment.take([x[0] for x in graph.edges()]) #edges[:,0])
+        right_edge_assignment = assignment.take([x[1] for x in graph.edges()]) #edges[:,1])
+        mismatch = (left_edge_assignment != right_edge_assignment).sum()
+    else:
+        rows, neighbors, left, right = _csr_partitions(graph, assignment)
+        # every edge is stored in both directions, self loops are never cut
+        mismatch = np.count_nonzero(left != right) // 2
     if graph.number_of_edges() > 0:
         cut_ratio = mismatch / graph.number_of_edges()
     else:
@@ -186,6 +782,19 @@ def score(graph, assignment, num_partitions=None):
     return (waste, cut_ratio, mismatch)
 
 
+def _csr_partitions(graph, assignments):
+    """
+    The neighbor entries of an undirected graph from graph_to_csr(), with one
+    row per assignment, and the partitions of both ends of every entry.
+
+    Returns: (rows, neighbors, left_partitions, right_partitions)
+    """
+    assignments = np.asarray(assignments)
+    indptr, indices = graph_to_csr(graph, len(assignments))[:2]
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    return (rows, indices, assignments[rows], assignments[indices])
+
+
 def base_metrics(G, assignments=None):
     """
     This algorithm calculates the number of edges cut and scores the communication steps. It gets
@@ -194,9 +803,12 @@ def base_metrics(G, assignments=None):
     Communication steps described on slide 11:
     https://www.cs.fsu.edu/~engelen/courses/HPC-adv/GraphPartitioning.pdf
     """
+    if assignments is not None and not G.is_directed():
+        return _base_metrics_csr(G, assignments)
+
     steps = 0
     edges_cut = 0
-    seen = []
+    seen = set()
     cut_edges = []
     for n in G.nodes_iter():
         partition_seen = []
@@ -216,8 +828,8 @@ def base_metrics(G, assignments=None):
 
             if (n,right) not in seen:
                 # dealing with undirected graphs
-                seen.append((n,right))
-                seen.append((right,n))
+                seen.add((n,right))
+                seen.add((right,n))
 
                 if left_partition != right_partition:
                     # right node in different partition
@@ -230,180 +842,134 @@ def base_metrics(G, assignments=None):
 
     return (edges_cut, steps, cut_edges)
 
-def infomapModularityComQuality(G, assignments, num_partitions):
-    p = get_partition_population(G, assignments, num_partitions)
-    partition_population = [p[x][0] for x in p]
-    partition_score = list(range(0, num_partitions))
-
-    temp_dir = tempfile.mkdtemp()
-    #print('infomapModularityComQuality dir', temp_dir)
-
-    partition_metrics = [0.0, 0.0, 0.0]
-    total_nodes = 0
-
-    for p in range(0, num_partitions):
-        #print('partition', p)
-        nodes = [i for i,x in enumerate(assignments) if x == p]
-        Gsub = G.subgraph(nodes)
-        # communities = {communityID:[communityNodes],...}
-        communityNodes = infomapCommunityDetection(Gsub)
-        sorted_nodes = sorted(nodes)
-
-        network_path = os.path.join(temp_dir, 'network_' + str(p) + '.txt')
-        community_path = os.path.join(temp_dir, 'community_' + str(p) + '.txt')
-
-        # write the network file
-        with open(network_path, 'w+') as f:
-            # write node_id other_node_id edge_weight
-            for node in sorted_nodes:
-
-                try:
-                    neighs = Gsub.neighbors(node)
-                except Exception as e:
-                    print('Gsub neighbors error: node, nodes, sorted_nodes Gsub.nodes()', node, nodes, sorted_nodes, Gsub.nodes(), G.nodes())
-
-                for neighbor in Gsub.neighbors(node):
-                    weight = 1
-                    try:
-                        weight = int(G.edge[node][neighbor]['weight'])
-                    except Exception as err:
-                        pass
-                    f.write(str(node) + " " + str(neighbor) + " " + str(weight) + "\n")
-
-        # collect nodes for each community
-        #communityNodes = {}
-        #for node in sorted_nodes:
-        #    nodeCommunity = communities[node]
-        #    if nodeCommunity in communityNodes:
-        #        communityNodes[nodeCommunity].append(node)
-        #    else:
-        #        communityNodes[nodeCommunity] = [node]
-
-        # write the communities file
-        with open(community_path, 'w+') as f:
-            for key in sorted(communityNodes.keys()):
-                s = ''
-                for node in sorted(communityNodes[key]):
-                    if len(s):
-                        s = s + " "
-                    s = s + str(node)
-                f.write(s + '\n')
-        # run ComQuality
-        com_qual_path = os.path.join(BIN_DIRECTORY, "ComQualityMetric")
-        com_qual_log = os.path.join(temp_dir, 'quality.log')
-        args = ["java", "CommunityQualityUpdated", "-weighted", network_path, community_path]
 
-        with open(com_qual_log, "w+") as logwriter:
-            retval = subprocess.call(
-                args, cwd=com_qual_path,
-                stdout=logwriter, stderr=subprocess.STDOUT)
-
-        n_nodes = len(nodes)
-        total_nodes = total_nodes + n_nodes
-        # return metrics
-        with open(com_qual_log, "r") as fp:
-            metrics = {}
-            for line in fp:
-                m = [p.strip() for p in line.split(',')]
-                metrics.update(dict(map(lambda y:y.split(' = '), m)))
-            partition_metrics[0] += float(metrics['Q']) * (1.0 * n_nodes)
-            partition_metrics[1] += float(metrics['Qds']) * (1.0 * n_nodes)
-            partition_metrics[2] += float(metrics['conductance']) * (1.0 * n_nodes)
-
-    if total_nodes:
-        partition_metrics[0] = partition_metrics[0] / (1.0 * total_nodes)
-        partition_metrics[1] = partition_metrics[1] / (1.0 * total_nodes)#4.0
-        partition_metrics[2] = partition_metrics[2] / (1.0 * total_nodes)#4.0
+def _base_metrics_csr(G, assignments):
+    """
+    base_metrics() of an undirected graph computed over its CSR arrays, with
+    the cut edges in the same order
+    """
+    rows, neighbors, left, right = _csr_partitions(G, assignments)
+    foreign = left != right
+
+    # a node communicates once with every partition its neighbors are in
+    if np.any(foreign):
+        low = right[foreign].min()
+        span = int(right[foreign].max()) - int(low) + 1
+        steps = len(np.unique(rows[foreign] * span + (right[foreign] - low)))
     else:
-        partition_metrics[0] = 0.0
-        partition_metrics[1] = 0.0
-        partition_metrics[2] = 0.0
-    #partition_metrics[0] = partition_metrics[0] / (1.0 * num_partitions)
-    #partition_metrics[1] = partition_metrics[1] / (1.0 * num_partitions)#4.0
-    #partition_metrics[2] = partition_metrics[2] / (1.0 * num_partitions)#4.0
+        steps = 0
 
-    shutil.rmtree(temp_dir)
-
-    return [partition_metrics[0], partition_metrics[1], partition_metrics[2]]
+    # each cut edge is listed from the end that comes first in the graph
+    if hasattr(G, 'nodes_array'):
+        nodes = G.nodes_array()
+    else:
+        nodes = np.fromiter(G.nodes_iter(), dtype=np.int64)
+    position = np.zeros(len(assignments), dtype=np.int64)
+    position[nodes] = np.arange(len(nodes))
+    first = foreign & (position[rows] < position[neighbors])
+    source = rows[first]
+    order = np.argsort(position[source], kind='stable')
+    cut_edges = list(zip(source[order].tolist(), neighbors[first][order].tolist()))
 
+    return (len(cut_edges), steps, cut_edges)
 
-def louvainModularityComQuality(G, assignments, num_partitions):
-    p = get_partition_population(G, assignments, num_partitions)
-    partition_population = [p[x][0] for x in p]
-    partition_score = list(range(0, num_partitions))
+def community_quality(G, communities):
+    """
+    Modularity (Q), modularity density (Qds) and conductance of communities
+    in G, computed as ComQualityMetric's CommunityQualityUpdated -weighted
+    does: edge weights are truncated to ints, self loops are ignored and
+    conductance is averaged over the communities.
 
-    temp_dir = tempfile.mkdtemp()
-    #print('louvainModularityComQuality dir', temp_dir)
+    communities: {community id: [nodes]}, ids are taken in sorted order and
+                 every node with an edge must be in a community.
 
+    Returns: (Q, Qds, conductance), NaN where the Java tool divides by zero.
+    """
+    indptr, indices, edge_weights, node_weights = graph_to_csr(G)
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    keep = rows != indices
+    rows = rows[keep]
+    indices = indices[keep]
+    weights = np.trunc(edge_weights[keep])
+
+    # community of every node, a node listed twice stays in the last one
+    num_coms = len(communities)
+    label = np.full(len(indptr) - 1, -1, dtype=np.int64)
+    sizes = np.zeros(num_coms, dtype=np.float64)
+    for i, key in enumerate(sorted(communities.keys())):
+        nodes = np.asarray(communities[key], dtype=np.int64)
+        nodes = nodes[nodes < len(label)]
+        label[nodes] = i
+        sizes[i] = len(set(communities[key]))
+    left = label[rows]
+    right = label[indices]
+    assert np.all(left >= 0) and np.all(right >= 0), "Every node with an edge needs a community"
+
+    # total weight and count of the entries between every pair of communities
+    pairs, inverse = np.unique(left * max(num_coms, 1) + right, return_inverse=True)
+    pair_weight = np.bincount(inverse, weights=weights, minlength=len(pairs))
+    pair_count = np.bincount(inverse, minlength=len(pairs))
+    i = pairs // max(num_coms, 1)
+    j = pairs % max(num_coms, 1)
+    intra = i == j
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        total_weight = np.float64(weights.sum())
+        win = np.bincount(i[intra], weights=pair_weight[intra], minlength=num_coms)
+        wout = np.bincount(i[~intra], weights=pair_weight[~intra], minlength=num_coms)
+        density = np.zeros(num_coms)
+        density[i[intra]] = pair_count[intra] / (sizes[i[intra]] * (sizes[i[intra]] - 1))
+        # split penalty, the weight to other communities times their density
+        sp = np.bincount(i[~intra], minlength=num_coms,
+                         weights=pair_weight[~intra] * (pair_count[~intra] / (sizes[i[~intra]] * sizes[j[~intra]])))
+
+        Q = (win / total_weight - ((win + wout) / total_weight) ** 2).sum()
+        Qds = ((win / total_weight) * density - (((win + wout) / total_weight) * density) ** 2 - sp / total_weight).sum()
+        conductance = np.where(wout == 0, 0.0, wout / (win + wout)).sum() / np.float64(num_coms)
+
+    return (float(Q), float(Qds), float(conductance))
+
+
+def _partition_community_quality(G, assignments, num_partitions, detect_communities, weighted=True):
+    """
+    community_quality() of the communities detect_communities() finds in
+    every partition, averaged over the partitions weighted by their number
+    of nodes, or unweighted
+    """
     partition_metrics = [0.0, 0.0, 0.0]
+    total_nodes = 0
+    assignments = np.asarray(assignments)
 
     for p in range(0, num_partitions):
-        #print('partition', p)
-        nodes = [i for i,x in enumerate(assignments) if x == p]
+        nodes = np.flatnonzero(assignments == p).tolist()
         Gsub = G.subgraph(nodes)
-        communities = community.best_partition(Gsub)
-        sorted_nodes = sorted(nodes)
+        quality = community_quality(Gsub, detect_communities(Gsub))
 
-        network_path = os.path.join(temp_dir, 'network_' + str(p) + '.txt')
-        community_path = os.path.join(temp_dir, 'community_' + str(p) + '.txt')
-
-        # write the network file
-        with open(network_path, 'w+') as f:
-            # write node_id other_node_id edge_weight
-            for node in sorted_nodes:
-                for neighbor in Gsub.neighbors(node):
-                    weight = 1
-                    try:
-                        weight = int(G.edge[node][neighbor]['weight'])
-                    except Exception as err:
-                        pass
-                    f.write(str(node) + " " + str(neighbor) + " " + str(weight) + "\n")
+        n_nodes = len(nodes) if weighted else 1
+        total_nodes = total_nodes + n_nodes
+        for m in range(0, 3):
+            partition_metrics[m] += quality[m] * (1.0 * n_nodes)
 
-        # collect nodes for each community
-        communityNodes = {}
-        for node in sorted_nodes:
-            nodeCommunity = communities[node]
-            if nodeCommunity in communityNodes:
-                communityNodes[nodeCommunity].append(node)
-            else:
-                communityNodes[nodeCommunity] = [node]
+    if total_nodes:
+        partition_metrics = [m / (1.0 * total_nodes) for m in partition_metrics]
+    else:
+        partition_metrics = [0.0, 0.0, 0.0]
 
-        # write the communities file
-        with open(community_path, 'w+') as f:
-            for key in sorted(communityNodes.keys()):
-                s = ''
-                for node in sorted(communityNodes[key]):
-                    if len(s):
-                        s = s + " "
-                    s = s + str(node)
-                f.write(s + '\n')
-        # run ComQuality
-        com_qual_path = os.path.join(BIN_DIRECTORY, "ComQualityMetric")
-        com_qual_log = os.path.join(temp_dir, 'quality.log')
-        args = ["java", "CommunityQualityUpdated", "-weighted", network_path, community_path]
+    return partition_metrics
 
-        with open(com_qual_log, "w+") as logwriter:
-            retval = subprocess.call(
-                args, cwd=com_qual_path,
-                stdout=logwriter, stderr=subprocess.STDOUT)
 
-        # return metrics
-        with open(com_qual_log, "r") as fp:
-            metrics = {}
-            for line in fp:
-                m = [p.strip() for p in line.split(',')]
-                metrics.update(dict(map(lambda y:y.split(' = '), m)))
-            partition_metrics[0] += float(metrics['Q'])
-            partition_metrics[1] += float(metrics['Qds'])
-            partition_metrics[2] += float(metrics['conductance'])
+def infomapModularityComQuality(G, assignments, num_partitions):
+    return _partition_community_quality(G, assignments, num_partitions, infomapCommunityDetection)
 
-    partition_metrics[0] = partition_metrics[0] / (1.0 * num_partitions)
-    partition_metrics[1] = partition_metrics[1] / (1.0 * num_partitions)#4.0
-    partition_metrics[2] = partition_metrics[2] / (1.0 * num_partitions)#4.0
 
-    shutil.rmtree(temp_dir)
+def louvainModularityComQuality(G, assignments, num_partitions):
+    def louvain_communities(Gsub):
+        communityNodes = {}
+        for node, nodeCommunity in community.best_partition(Gsub).items():
+            communityNodes.setdefault(nodeCommunity, []).append(node)
+        return communityNodes
 
-    return [partition_metrics[0], partition_metrics[1], partition_metrics[2]]
+    return _partition_community_quality(G, assignments, num_partitions, louvain_communities, weighted=False)
 
 def modularityComQuality(G, assignments, num_partitions):
     p = get_partition_population(G, assignments, num_partitions)
@@ -598,7 +1164,7 @@ def loneliness_score_wavg(G, loneliness_score_param, assignments, num_partitions
     #return np.average(partition_score, weights=partition_population)
     return average
 
-def wavg_max_perm(G, assignments, num_partitions):
+def wavg_max_perm(G, assignments, num_partitions, sample=None, seed=None):
     partition_nodes = {}
     for node in G.nodes():
         assignment = assignments[node]
@@ -613,7 +1179,7 @@ def wavg_max_perm(G, assignments, num_partitions):
         gsub = G.subgraph(partition_nodes[partition])
         n_nodes = len(partition_nodes[partition])
 
-        partition_max_perm = float(run_max_perm(gsub))
+        partition_max_perm = run_max_perm(gsub, sample=sample, seed=seed)
         #print('pmp', partition_max_perm)
         partition_max_perm = n_nodes * partition_max_perm
         score = score + partition_max_perm
@@ -625,52 +1191,42 @@ def wavg_max_perm(G, assignments, num_partitions):
         return score / total
     return 0.0
 
-def run_max_perm(G, relabel_nodes=False):
-    max_perm = 0.0
-    temp_dir = tempfile.mkdtemp()
-    edges_filename = os.path.join(temp_dir, "edges-maxperm.txt")
-
-    # MaxPerm requires nodes in sequential order
-    relabel_nodes = True # Do the relabel as maxperm wants nodes labelled 0...n-1 where n = G.number_of_nodes()
-    Gcopy = None
-    if relabel_nodes:
-        #mapping = dict(zip(G.nodes(), range(0, len(G.nodes()))))
-        #print("mapping", mapping)
-
-        nodes = sorted(G.nodes())
-        nodeMapping = {}
-        for i, n in enumerate(nodes):
-            #nx.relabel_nodes(G, {n:i}, copy=False)
-            nodeMapping[n] = i
-        #Gcopy = nx.relabel_nodes(G, nodeMapping, copy=True)
-        Gcopy = nx.Graph()
-        for node in G.nodes():
-            Gcopy.add_node(nodeMapping[node])
-            for edge in G.neighbors(node):
-                Gcopy.add_edge(nodeMapping[node], nodeMapping[edge])
-
-    # write edge list in a format for MaxPerm, tab delimited
-    with open(edges_filename, "w") as outf:
-        outf.write("{}\t{}\n".format(Gcopy.number_of_nodes(), Gcopy.number_of_edges()))
-        for e in sorted(Gcopy.edges_iter()):
-            outf.write("{}\t{}\n".format(*e))
-
-    # cat edge list into MaxPerm bin
-    with open(edges_filename, "r") as edge_file:
-        args = [os.path.join(BIN_DIRECTORY, "MaxPerm", "MaxPerm")]
-        with open(os.devnull, "w") as devnull:
-            retval = subprocess.call(
-                args, cwd=temp_dir, stdin=edge_file,
-                stdout=devnull)
+# Upper bound on the sweeps of run_max_perm(), it usually stops well before
+MAX_PERM_ITERATIONS = 20
 
-    # parse the output file to get the permanence metric
-    with open(os.path.join(temp_dir, "output.txt"), "r") as fp:
-        for i, line in enumerate(fp):
-            if "Network Permanence" in line:
-                max_perm = line.split()[3]
-                break
-    shutil.rmtree(temp_dir)
-    return max_perm
+def run_max_perm(G, relabel_nodes=False, sample=None, max_iterations=MAX_PERM_ITERATIONS, seed=None):
+    """
+    Network permanence of the communities found by MaxPerm on G, computed
+    in-process by maxperm.pyx over the CSR arrays of G.
+
+    relabel_nodes: Kept for compatibility, nodes are always relabelled 0 to
+                   n - 1 in sorted order as the MaxPerm binary required.
+    sample: Number of vertices visited and measured per sweep, see
+            maxperm.max_perm(). None visits every vertex.
+    seed: Seed of the samples, None draws different samples every call.
+    """
+    import pyximport
+    pyximport.install()
+    from graph_partitioning import maxperm
+
+    ids = np.array(sorted(G.nodes()), dtype=np.int64)
+    if len(ids) == 0:
+        return 0.0
+    indptr, indices = graph_to_csr(G)[:2]
+    positions = csr_positions(indptr, ids)
+    rows = np.repeat(np.arange(len(ids)), indptr[ids + 1] - indptr[ids])
+    neighbors = indices[positions]
+
+    # keep the edges inside G, graphs backed by arrays can list more
+    columns = np.minimum(np.searchsorted(ids, neighbors), len(ids) - 1)
+    inside = ids[columns] == neighbors
+    rows = rows[inside]
+    columns = columns[inside]
+
+    compact_indptr = np.zeros(len(ids) + 1, dtype=np.int32)
+    np.cumsum(np.bincount(rows, minlength=len(ids)), out=compact_indptr[1:])
+    max_perm, labels = maxperm.max_perm(compact_indptr, columns.astype(np.int32), max_iterations, sample, seed)
+    return float(max_perm)
 
 
 def run_community_metrics(output_path, data_filename, edges_oslom_filename):
@@ -791,8 +1347,69 @@ def write_assignment_file(outfolder, filepath, assignments):
     if not os.path.exists(outfolder):
         os.makedirs(outfolder)
     with open(filepath, 'w+') as outF:
-        for i, assignment in enumerate(assignments):
-            outF.write(str(i) + " " + str(assignment) + "\n")
+        outF.writelines("%s %s\n" % a for a in enumerate(assignments))
+
+
+# binary assignment files are a header followed by one int32 per node
+ASSIGNMENTS_MAGIC = b'GPASSIGN'
+ASSIGNMENTS_VERSION = 1
+_ASSIGNMENTS_HEADER = np.dtype([('magic', 'S8'), ('version', '<u4'), ('num_partitions', '<i4'),
+                                ('num_nodes', '<i8'), ('graph_hash', 'u1', 20), ('reserved', 'V20')])
+
+def write_assignments_binary(filepath, assignments, num_partitions, DATA_FILENAME=None):
+    """
+    Writes assignments in the binary format read by read_assignments(). The
+    header holds the number of nodes, num_partitions and the file_hash() of
+    DATA_FILENAME, when given, so the assignments can be checked against the
+    graph they were computed for.
+    """
+    assignments = np.asarray(assignments)
+    header = np.zeros(1, dtype=_ASSIGNMENTS_HEADER)
+    header['magic'] = ASSIGNMENTS_MAGIC
+    header['version'] = ASSIGNMENTS_VERSION
+    header['num_partitions'] = num_partitions
+    header['num_nodes'] = len(assignments)
+    if DATA_FILENAME is not None:
+        header['graph_hash'] = np.frombuffer(file_hash(DATA_FILENAME), dtype=np.uint8)
+
+    with open(filepath, 'wb') as f:
+        f.write(header.tobytes())
+        assignments.astype('<i4').tofile(f)
+
+
+def read_assignments(filepath, DATA_FILENAME=None):
+    """
+    Reads the assignments of every node from a file written by
+    write_assignments_binary(), or from a text file with one partition per
+    line, optionally preceded by the node id as written by
+    write_assignment_file().
+
+    Binary files are memory mapped copy-on-write, so nothing is read until it
+    is used and the array can be modified without changing the file. If
+    DATA_FILENAME is given and the file holds a graph hash, it must match the
+    hash of DATA_FILENAME.
+
+    Returns: an int32 array of assignments
+    """
+    with open(filepath, 'rb') as f:
+        magic = f.read(len(ASSIGNMENTS_MAGIC))
+        if magic != ASSIGNMENTS_MAGIC:
+            f.seek(0)
+            assignments = np.loadtxt(f, dtype=np.int32, ndmin=2)
+            return np.ascontiguousarray(assignments[:, -1])
+        f.seek(0)
+        header = np.fromfile(f, dtype=_ASSIGNMENTS_HEADER, count=1)
+
+    assert len(header) == 1, "Truncated assignments file"
+    assert header['version'][0] == ASSIGNMENTS_VERSION, "Assignments file version {} not supported".format(header['version'][0])
+    graph_hash = header['graph_hash'][0].tobytes()
+    if DATA_FILENAME is not None and any(graph_hash):
+        assert graph_hash == file_hash(DATA_FILENAME), "Assignments were not computed for {}".format(DATA_FILENAME)
+
+    num_nodes = int(header['num_nodes'][0])
+    if num_nodes == 0:
+        return np.zeros(0, dtype=np.int32)
+    return np.memmap(filepath, dtype='<i4', mode='c', offset=_ASSIGNMENTS_HEADER.itemsize, shape=(num_nodes,))
 
 def write_partition_file(outfolder, filepath, assignments, partition):
     if not os.path.exists(outfolder):
@@ -802,8 +1419,17 @@ def write_partition_file(outfolder, filepath, assignments, partition):
             if(assignment == partition):
                 outF.write(str(i) + " " + str(assignment) + "\n")
 
-def write_graph_files(output_path, data_filename, G, quiet=False, relabel_nodes=False):
+def write_graph_files(output_path, data_filename, G, quiet=False, relabel_nodes=False,
+                      graph_format='GML', write_assignments=True):
+    """
+    Writes the graph, the partition of every node and the tab delimited edge
+    list read by run_community_metrics(), whose filename is returned.
 
+    graph_format: 'GML' writes the graph with networkx, 'NPZ' writes the
+                  graph_to_csr() arrays, the node ids and their partitions to
+                  a NumPy .npz file, None skips the graph file.
+    write_assignments: Write the partition of every node to a text file.
+    """
     if not os.path.exists(output_path):
         os.makedirs(output_path)
     if not os.path.exists(os.path.join(output_path, 'oslom')):
@@ -811,26 +1437,41 @@ def write_graph_files(output_path, data_filename, G, quiet=False, relabel_nodes=
     if not os.path.exists(os.path.join(output_path, 'graphs')):
         os.makedirs(os.path.join(output_path, 'graphs'))
 
-    # write to GML file
-    gml_filename = os.path.join(output_path, 'graphs', data_filename + "-graph.gml")
-    nx.write_gml(G, gml_filename)
-
-    # write assignments into a file with a single column
-    assignments_filename = os.path.join(output_path, 'graphs', data_filename + "-assignments.txt")
-    with open(assignments_filename, "w") as outf:
-        for n in G.nodes_iter(data=True):
-            outf.write("{}\n".format(n[1]["partition"]))
+    written = []
+    if graph_format or write_assignments:
+        partitions = [n[1]["partition"] for n in G.nodes_iter(data=True)]
+
+    if graph_format == 'GML':
+        # write to GML file
+        graph_filename = os.path.join(output_path, 'graphs', data_filename + "-graph.gml")
+        nx.write_gml(G, graph_filename)
+        written.append("GML file: {}".format(graph_filename))
+    elif graph_format == 'NPZ':
+        graph_filename = os.path.join(output_path, 'graphs', data_filename + "-graph.npz")
+        indptr, indices, edge_weights, node_weights = graph_to_csr(G)
+        np.savez(graph_filename, indptr=indptr, indices=indices, edge_weights=edge_weights,
+                 node_weights=node_weights, nodes=np.fromiter(G.nodes_iter(), dtype=np.int64),
+                 partitions=np.array(partitions, dtype=np.int32))
+        written.append("graph arrays: {}".format(graph_filename))
+    elif graph_format is not None:
+        assert False, "Graph file format not supported"
+
+    if write_assignments:
+        # write assignments into a file with a single column
+        assignments_filename = os.path.join(output_path, 'graphs', data_filename + "-assignments.txt")
+        with open(assignments_filename, "w") as outf:
+            outf.writelines("%s\n" % p for p in partitions)
+        written.append("assignments: {}".format(assignments_filename))
 
     # write edge list in a format for OSLOM, tab delimited
     edges_oslom_filename = os.path.join(output_path, 'oslom', data_filename + "-edges-oslom.txt")
     with open(edges_oslom_filename, "w") as outf:
-        for e in G.edges_iter(data=True):
-            outf.write("{}\t{}\t{}\n".format(e[0], e[1], e[2]["weight"]))
+        outf.writelines("%s\t%s\t%s\n" % (e[0], e[1], e[2]["weight"]) for e in G.edges_iter(data=True))
+    written.append("edge list (for OSLOM): {}".format(edges_oslom_filename))
 
     if not quiet:
-        print("Writing GML file: {}".format(gml_filename))
-        print("Writing assignments: {}".format(assignments_filename))
-        print("Writing edge list (for OSLOM): {}".format(edges_oslom_filename))
+        for w in written:
+            print("Writing {}".format(w))
 
     return edges_oslom_filename
 
@@ -866,62 +1507,44 @@ from sklearn.metrics import f1_score
 from scipy.optimize import linear_sum_assignment
 
 def fscores2(predictionModel, assignments, num_partitions):
-    prediction = np.array(predictionModel, copy=True)
-    batch = np.array(assignments, copy=True)
-
-    pm = []
-    btch = []
-    for i, partition in enumerate(batch):
-        if partition >= 0:
-            pm.append(prediction[i])
-            btch.append(partition)
-
-    prediction = np.array(pm)
-    batch = np.array(btch)
-
-    #print('computing fscores', len(prediction), len(batch))
-
-    fscore = f1_score(prediction, batch, average='weighted')
-    #fscore = 0.0
-
-    fscorematrix = []
-    for i in range(0, num_partitions):
-        fi = []
-        fi_correct = []
-        for j in range(0, num_partitions):
-            batch_ij = relabelArray(batch, i, j)
-            #fi.append(1.0 - 0.0)
-            #print("fmatrix", len(prediction), len(batch_ij))
-            fi.append(1.0 - f1_score(prediction, batch_ij, average='weighted'))
-        fscorematrix.append(fi)
-
-    cost = np.array(fscorematrix)
-    row_ind, col_ind = linear_sum_assignment(cost)
-
-    relabelled_batch = batch
-
-    relabel_done = {}
-    for i, row in enumerate(row_ind):
-        # check if done already
-        col = col_ind[i]
-        if col == row:
-            continue
-
-        if(col < row):
-            if col in relabel_done:
-                #if row in relabel_done[col]:
-                continue
-            relabel_done[col] = row
-        else:
-            if row in relabel_done:
-                continue
-            relabel_done[row] = col
-        relabelled_batch = relabelArray(relabelled_batch, row, col_ind[i])
-
-    #print("computing fscores relabelled", len(prediction), len(relabelled_batch))
-    fscore_relabelled = f1_score(prediction, relabelled_batch, average='weighted')
-    #fscore_relabelled = 0.0
-    return(fscore, fscore_relabelled)
+    """
+    Weighted F1 score of the assignments of the arrived nodes against the
+    prediction model, as f1_score(prediction, assignments, average='weighted'),
+    and the best weighted F1 score over all relabellings of the partitions
+    of the assignments.
+
+    Both come from the contingency table C of the two assignments, with
+    C[i, j] nodes in partition i of the prediction model and partition j of
+    the assignments. With r and c its row and column sums and N nodes,
+    relabelling partition j as i adds 2 C[i, j] r[i] / (r[i] + c[j]) / N to
+    the score, so the best relabelling is the linear sum assignment of these
+    terms.
+    """
+    prediction = np.asarray(predictionModel)
+    batch = np.asarray(assignments)
+    arrived = batch >= 0
+    prediction = prediction[arrived]
+    batch = batch[arrived]
+
+    if len(batch) == 0:
+        return (0.0, 0.0)
+
+    # nodes outside the partitions count towards N but can never match
+    predicted = (prediction >= 0) & (prediction < num_partitions)
+    inside = predicted & (batch < num_partitions)
+    table = np.bincount(prediction[inside] * num_partitions + batch[inside],
+                        minlength=num_partitions * num_partitions).reshape(num_partitions, num_partitions)
+    rows = np.bincount(prediction[predicted], minlength=num_partitions)[:, None]
+    columns = np.bincount(batch, minlength=num_partitions)[None, :num_partitions]
+
+    terms = np.zeros((num_partitions, num_partitions))
+    np.divide(2.0 * table * rows, rows + columns, out=terms, where=table > 0)
+    terms /= len(batch)
+
+    fscore = np.trace(terms)
+    row_ind, col_ind = linear_sum_assignment(-terms)
+    fscore_relabelled = terms[row_ind, col_ind].sum()
+    return (float(fscore), float(fscore_relabelled))
 
 def fscores(predictionModel, assignments, num_partitions):
     prediction = np.array(predictionModel, copy=True)
@@ -1055,7 +1678,7 @@ def infomapCommunityDetection(graph):
     #print('Calling infomap detection for nodes', graph.nodes())
 
     infomapWrapper = infomap.Infomap("--two-level --silent")
-    graph_nodes = graph.nodes()
+    graph_nodes = set(graph.nodes())
 
     # build infomap network from networkX graph
     for e in graph.edges_iter():
@@ -1134,5 +1757,4 @@ def ratherBeSomewhereElseList(graph, assignments, num_partitions):
 
 def savePredictionFile(outFilePath, assignments):
     with open(outFilePath, 'w+') as f:
-        for partition in assignments:
-            f.write(str(partition) + '\n')
+        f.writelines("%s\n" % partition for partition in assignments)